@@ -1,6 +1,7 @@
 # -*- coding: utf-8 -*-
 # (c) 2022 Brian Scholer (@briantist)
 
+import atexit
 import logging
 import warnings
 
@@ -9,7 +10,10 @@ from werkzeug.middleware.proxy_fix import ProxyFix
 from configargparse import ArgParser, ArgumentError, Action
 from artifactory import ArtifactoryPath
 
-from .utilities import DateTimeIsoFormatJSONProvider
+from . import constants as C
+from .utilities import DateTimeIsoFormatJSONProvider, SingleFlight, SessionRegistry
+from .collection_index import CollectionIndex, CollectionIndexRefresher
+from .upstream import MemoryCache, UpstreamRevalidator, CacheWriter
 
 from .api import create_blueprint as create_api_blueprint
 from .download import bp as download
@@ -26,6 +30,38 @@ def create_app(**config):
     app.register_blueprint(create_api_blueprint(app))
     app.register_blueprint(download)
 
+    app.extensions[C.EXTENSION_SINGLE_FLIGHT] = SingleFlight()
+
+    if app.config.get('HTTP_KEEP_ALIVE', True):
+        pool_maxsize = max(app.config.get('HTTP_POOL_MAXSIZE') or 0, app.config.get('DISCOVERY_CONCURRENCY') or 0)
+        app.extensions[C.EXTENSION_SESSIONS] = SessionRegistry(pool_maxsize=pool_maxsize)
+
+    refresh_interval = app.config.get('COLLECTION_INDEX_REFRESH_INTERVAL')
+    if app.config.get('COLLECTION_INDEX_TTL') or refresh_interval:
+        index = app.extensions[C.EXTENSION_COLLECTION_INDEX] = CollectionIndex.from_config(app.config)
+
+        if refresh_interval:
+            refresher = CollectionIndexRefresher(app, index, refresh_interval, app.config.get('COLLECTION_INDEX_REFRESH_JITTER', 0))
+            app.extensions[C.EXTENSION_COLLECTION_INDEX_REFRESHER] = refresher
+            refresher.start()
+
+    memory_cache_entries = app.config.get('CACHE_MEMORY_ENTRIES')
+    if memory_cache_entries:
+        app.extensions[C.EXTENSION_UPSTREAM_MEMORY_CACHE] = MemoryCache(
+            memory_cache_entries,
+            app.config.get('CACHE_MEMORY_BYTES', 64 * 1024 * 1024),
+        )
+
+    stale_seconds = app.config.get('CACHE_STALE_WHILE_REVALIDATE')
+    if stale_seconds:
+        app.extensions[C.EXTENSION_UPSTREAM_REVALIDATOR] = UpstreamRevalidator(app, stale_seconds)
+
+    write_queue_size = app.config.get('CACHE_WRITE_BEHIND')
+    if write_queue_size:
+        writer = app.extensions[C.EXTENSION_CACHE_WRITER] = CacheWriter(app, write_queue_size)
+        writer.start()
+        atexit.register(writer.close)
+
     @app.before_request
     def log():
         if app.config.get('LOG_HEADERS'):
@@ -94,10 +130,27 @@ def create_configured_app(run=False, parse_known_only=True, parse_allow_abbrev=F
     parser.add_argument('--log-body', action='store_true', env_var='GALACTORY_LOG_BODY', help='Log the body of every request (DEBUG level only).')
     parser.add_argument('--proxy-upstream', type=lambda x: str(x).rstrip('/') + '/', env_var='GALACTORY_PROXY_UPSTREAM', help='If set, then find, pull and cache results from the specified galaxy server in addition to local.')
     parser.add_argument('-npns', '--no-proxy-namespace', action='append', default=[], env_var='GALACTORY_NO_PROXY_NAMESPACE', help='Requests for this namespace should never be proxied. Can be specified multiple times.')
+    parser.add_argument('--upstream-page-concurrency', default=4, type=int, env_var='GALACTORY_UPSTREAM_PAGE_CONCURRENCY', help='When a proxied upstream response has more than one page, the remaining pages are fetched and cached with it. This is the number of those pages requested at the same time.')
     parser.add_argument('--cache-minutes', default=60, type=int, env_var='GALACTORY_CACHE_MINUTES', help='The time period that a cache entry should be considered valid.')
+    parser.add_argument('--negative-cache-minutes', default=0, type=int, env_var='GALACTORY_NEGATIVE_CACHE_MINUTES', help='If set to a positive number, cache upstream "not found" responses for this many minutes, in the same places as other upstream cache entries, so that lookups of collections that do not exist upstream are not sent upstream every time. Set to 0 to disable negative caching.')
     parser.add_argument('--cache-read', action=_StrBool, default=True, env_var='GALACTORY_CACHE_READ', help='Look for upsteam caches and use their values.')
     parser.add_argument('--cache-write', action=_StrBool, default=True, env_var='GALACTORY_CACHE_WRITE', help='Populate the upstream cache in Artifactory. Should be false when no auth is provided or the auth has no permission to write.')
+    parser.add_argument('--cache-compression', type=str, env_var='GALACTORY_CACHE_COMPRESSION', choices=['none', 'gzip', 'brotli'], default='none', help='Compress upstream cache entries written to Artifactory. Entries are read whether or not they are compressed, but older versions of galactory cannot read compressed entries, so only enable this once every instance sharing the cache supports it.')
+    parser.add_argument('--cache-write-behind', default=0, type=int, env_var='GALACTORY_CACHE_WRITE_BEHIND', help='If set to a positive number, upstream cache entries are written to Artifactory by a background thread after the response is sent, from a queue of up to this many entries. Entries that do not fit in the queue are not written. The queue is flushed at shutdown. Set to 0 to write each entry before responding.')
+    parser.add_argument('--cache-memory-entries', default=0, type=int, env_var='GALACTORY_CACHE_MEMORY_ENTRIES', help='If set to a positive number, keep up to this many upstream cache entries in memory, in front of the cache in Artifactory, so that cache hits do not need a request to Artifactory. Has no effect when --cache-read is false. Set to 0 to disable the in-memory cache.')
+    parser.add_argument('--cache-memory-bytes', default=64 * 1024 * 1024, type=int, env_var='GALACTORY_CACHE_MEMORY_BYTES', help='The approximate maximum size, in bytes, of the upstream cache entries kept in memory.')
+    parser.add_argument('--cache-stale-while-revalidate', default=0, type=int, env_var='GALACTORY_CACHE_STALE_WHILE_REVALIDATE', help='If set to a positive number, an expired upstream cache entry is served right away for up to this many seconds past its expiry, while it is refreshed from the upstream in the background. Set to 0 to always wait for the upstream when an entry has expired.')
     parser.add_argument('--use-property-fallback', action='store_true', env_var='GALACTORY_USE_PROPERTY_FALLBACK', help='Set properties of an uploaded collection in a separate request after publshinng. Requires a Pro license of Artifactory. This feature is a workaround for an Artifactory proxy configuration error and may be removed in a future version.')
+    parser.add_argument('--use-aql', action='store_true', env_var='GALACTORY_USE_AQL', help='If set, discover collections with a single Artifactory Query Language (AQL) search instead of requesting the metadata of each artifact separately. AQL may not be available in all editions of Artifactory; if the query fails, galactory falls back to iterating the repository.')
+    parser.add_argument('--discovery-concurrency', default=1, type=int, env_var='GALACTORY_DISCOVERY_CONCURRENCY', help='The number of artifacts whose metadata is requested at the same time when discovering collections by iterating the repository. Has no effect when collections are discovered with AQL. Set to 1 to request them one at a time.')
+    parser.add_argument('--http-keep-alive', action=_StrBool, default=True, env_var='GALACTORY_HTTP_KEEP_ALIVE', help='Keep HTTP connections to Artifactory and the upstream open and reuse them between requests, with one shared session per credential. When false, every request opens new connections.')
+    parser.add_argument('--http-pool-maxsize', default=10, type=int, env_var='GALACTORY_HTTP_POOL_MAXSIZE', help='The maximum number of connections to each host that are kept open for reuse. Raised to --discovery-concurrency if that is higher.')
+    parser.add_argument('--collection-index-ttl', default=0, type=int, env_var='GALACTORY_COLLECTION_INDEX_TTL', help='If set to a positive number, keep an in-memory index of all collections, rebuilt when it is older than this many seconds. Requests that use their own Galaxy auth do not use the index. Set to 0 to disable the index.')
+    parser.add_argument('--collection-index-refresh-interval', default=0, type=int, env_var='GALACTORY_COLLECTION_INDEX_REFRESH_INTERVAL', help='If set to a positive number, rebuild the collection index in a background thread every this many seconds, so that requests never wait for a rebuild. Enables the collection index even if --collection-index-ttl is not set, and the TTL is not used. Set to 0 to disable background refreshing.')
+    parser.add_argument('--collection-index-refresh-jitter', default=0, type=int, env_var='GALACTORY_COLLECTION_INDEX_REFRESH_JITTER', help='Add a random delay of up to this many seconds to each background refresh interval, to spread out the load from multiple instances.')
+    parser.add_argument('--collection-index-full-refresh-interval', default=0, type=int, env_var='GALACTORY_COLLECTION_INDEX_FULL_REFRESH_INTERVAL', help='Requires --use-aql. If set to a positive number, refreshes of the collection index only look for artifacts that changed since the previous refresh, and a full rebuild of the index is done only every this many seconds. Set to 0 to always rebuild the full index.')
+    parser.add_argument('--collection-index-snapshot-read', action=_StrBool, default=False, env_var='GALACTORY_COLLECTION_INDEX_SNAPSHOT_READ', help='Load the collection index from a snapshot saved in Artifactory when starting, and instead of a full rebuild when another instance has saved a newer snapshot.')
+    parser.add_argument('--collection-index-snapshot-write', action=_StrBool, default=False, env_var='GALACTORY_COLLECTION_INDEX_SNAPSHOT_WRITE', help='Save a snapshot of the collection index to Artifactory after each full rebuild. The configured auth must have permission to write.')
     parser.add_argument('--health-check-custom-text', type=str, default='', env_var='GALACTORY_HEALTH_CHECK_CUSTOM_TEXT', help='Sets custom_text field for health check endpoint responses.')
     parser.add_argument('--api-version', action='append', choices=['v2', 'v3'], env_var='GALACTORY_API_VERSION', help='The API versions to serve. Can be set to limit functionality to specific versions only. Defaults to all supported versions.')
     parser.add_argument('--upload-format', type=str, env_var='GALACTORY_UPLOAD_FORMAT', choices=['base64', 'raw', 'auto'], default='auto', help='Galaxy accepts the uploaded collection tarball as either raw bytes or base64 encoded. Ansible 2.9 uploads raw bytes, later versions upload base64. By default galactory will try to auto-detect. Use this option to turn off auto-detection and force a specific format.')
@@ -172,10 +225,27 @@ def create_configured_app(run=False, parse_known_only=True, parse_allow_abbrev=F
         PUBLISH_SKIP_CONFIGURED_AUTH=publish_skip_configured_auth,
         SERVER_NAME=args.server_name,
         PREFERRED_URL_SCHEME=args.preferred_url_scheme,
+        UPSTREAM_PAGE_CONCURRENCY=args.upstream_page_concurrency,
         CACHE_MINUTES=args.cache_minutes,
+        NEGATIVE_CACHE_MINUTES=args.negative_cache_minutes,
         CACHE_READ=args.cache_read,
         CACHE_WRITE=args.cache_write,
+        CACHE_COMPRESSION=args.cache_compression,
+        CACHE_WRITE_BEHIND=args.cache_write_behind,
+        CACHE_MEMORY_ENTRIES=args.cache_memory_entries,
+        CACHE_MEMORY_BYTES=args.cache_memory_bytes,
+        CACHE_STALE_WHILE_REVALIDATE=args.cache_stale_while_revalidate,
         USE_PROPERTY_FALLBACK=args.use_property_fallback,
+        USE_AQL=args.use_aql,
+        DISCOVERY_CONCURRENCY=args.discovery_concurrency,
+        HTTP_KEEP_ALIVE=args.http_keep_alive,
+        HTTP_POOL_MAXSIZE=args.http_pool_maxsize,
+        COLLECTION_INDEX_TTL=args.collection_index_ttl,
+        COLLECTION_INDEX_REFRESH_INTERVAL=args.collection_index_refresh_interval,
+        COLLECTION_INDEX_REFRESH_JITTER=args.collection_index_refresh_jitter,
+        COLLECTION_INDEX_FULL_REFRESH_INTERVAL=args.collection_index_full_refresh_interval,
+        COLLECTION_INDEX_SNAPSHOT_READ=args.collection_index_snapshot_read,
+        COLLECTION_INDEX_SNAPSHOT_WRITE=args.collection_index_snapshot_write,
         HEALTH_CHECK_CUSTOM_TEXT=args.health_check_custom_text,
         API_VERSION=args.api_version,
         UPLOAD_FORMAT=args.upload_format,
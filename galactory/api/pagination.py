@@ -0,0 +1,147 @@
+# -*- coding: utf-8 -*-
+# (c) 2023 Brian Scholer (@briantist)
+
+import typing as t
+
+from flask import Request, Response, abort, url_for
+
+from .. import constants as C
+
+
+def _get_non_negative_int(request: Request, name: str, default: t.Optional[int] = None) -> t.Optional[int]:
+    value = request.args.get(name)
+    if value is None:
+        return default
+
+    try:
+        ret = int(value)
+    except ValueError:
+        ret = -1
+
+    if ret < 0:
+        abort(Response(f"Invalid value for '{name}': '{value}'", C.HTTP_BAD_REQUEST))
+
+    return ret
+
+
+def get_limit_offset(request: Request) -> t.Tuple[t.Optional[int], int]:
+    """
+    Returns the limit and offset requested for a v3 list endpoint.
+    When no limit is requested it is None, and all results are returned.
+    """
+    limit = _get_non_negative_int(request, 'limit')
+    offset = _get_non_negative_int(request, 'offset', default=0)
+
+    if limit == 0:
+        abort(Response("Invalid value for 'limit': '0'", C.HTTP_BAD_REQUEST))
+
+    return limit, offset
+
+
+def page_slice(limit: t.Optional[int], offset: int) -> slice:
+    return slice(offset, None if limit is None else offset + limit)
+
+
+def limit_offset_links(
+    request: Request,
+    endpoint: str,
+    count: int,
+    limit: t.Optional[int],
+    offset: int,
+    **values
+) -> t.Dict[str, t.Optional[str]]:
+    """
+    Returns the v3 links for the page of count results starting at offset.
+    The values are passed to url_for along with the query string of the request.
+    """
+    args = request.args.to_dict()
+
+    def _link(page_offset: int) -> str:
+        if limit is not None:
+            args.update(limit=limit, offset=page_offset)
+        return url_for(endpoint, _external=False, **args, **values)
+
+    if limit is None:
+        this_url = _link(0)
+        return {
+            'first': this_url,
+            'previous': None,
+            'next': None,
+            'last': this_url,
+        }
+
+    return {
+        'first': _link(0),
+        'previous': _link(max(offset - limit, 0)) if offset > 0 else None,
+        'next': _link(offset + limit) if offset + limit < count else None,
+        'last': _link(max(count - 1, 0) // limit * limit),
+    }
+
+
+def get_page(request: Request) -> t.Tuple[t.Optional[int], int]:
+    """
+    Returns the page size and 1-based page number requested for a v2 list endpoint.
+    When no page size is requested it is None, and all results are returned.
+    """
+    page_size = _get_non_negative_int(request, 'page_size')
+    page = _get_non_negative_int(request, 'page', default=1)
+
+    if page_size == 0:
+        abort(Response("Invalid value for 'page_size': '0'", C.HTTP_BAD_REQUEST))
+
+    if page == 0:
+        abort(Response("Invalid value for 'page': '0'", C.HTTP_BAD_REQUEST))
+
+    return page_size, page
+
+
+def page_number_slice(count: int, page_size: t.Optional[int], page: int) -> slice:
+    """
+    Returns the slice of count results for the requested page.
+    Aborts with a 404 if the page does not exist, the same as Galaxy does.
+    """
+    if page_size is None:
+        return slice(None)
+
+    if page > 1 and (page - 1) * page_size >= count:
+        abort(C.HTTP_NOT_FOUND)
+
+    return page_slice(page_size, (page - 1) * page_size)
+
+
+def page_number_links(
+    request: Request,
+    endpoint: str,
+    count: int,
+    page_size: t.Optional[int],
+    page: int,
+    scheme: t.Optional[str] = None,
+    **values
+) -> t.Dict[str, t.Optional[str]]:
+    """
+    Returns the v2 next and previous links for the page of count results.
+    The values are passed to url_for along with the query string of the request.
+    """
+    args = request.args.to_dict()
+    links = {
+        'next': None,
+        'next_link': None,
+        'previous': None,
+        'previous_link': None,
+    }
+
+    if page_size is None:
+        return links
+
+    def _links(name: str, page_number: int) -> None:
+        args.update(page=page_number, page_size=page_size)
+        links[name] = url_for(endpoint, _external=True, _scheme=scheme, **args, **values)
+        links[f"{name}_link"] = url_for(endpoint, _external=False, **args, **values)
+
+    if page * page_size < count:
+        _links('next', page + 1)
+
+    if page > 1:
+        _links('previous', page - 1)
+
+    return links
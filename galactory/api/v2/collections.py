@@ -1,20 +1,24 @@
 # -*- coding: utf-8 -*-
 # (c) 2022 Brian Scholer (@briantist)
 
-from semver import VersionInfo
+from itertools import islice
+
 from flask import Response, jsonify, abort, url_for, request, current_app
 
 from . import bp as v2
 from ... import constants as C
 from ...utilities import (
-    discover_collections,
     authorize,
+    combine_etags,
+    conditional_headers,
     _chunk_to_temp,
     upload_collection_from_hashed_tempfile,
     IncomingCollectionStream,
 )
+from ...models import parse_version, version_key
 from ...upstream import ProxyUpstream
-from ...models import CollectionCollection
+from ...collection_index import load_collections, load_collection_version
+from ..pagination import get_page, page_number_links, page_number_slice
 
 
 @v2.route('/collections')
@@ -23,10 +27,15 @@ def collections():
     repository = authorize(request, current_app.config['ARTIFACTORY_PATH'])
     scheme = current_app.config.get('PREFERRED_URL_SCHEME')
 
+    page_size, page = get_page(request)
+
     results = []
-    colcol = CollectionCollection.from_collections(discover_collections(repo=repository))
+    colcol = load_collections(request, repository)
+    headers = conditional_headers(request, colcol.etag)
+    fqcns = colcol.sorted_keys()
 
-    for colgroup in colcol.values():
+    for fqcn in fqcns[page_number_slice(len(fqcns), page_size, page)]:
+        colgroup = colcol[fqcn]
         result = {
             'href': url_for(
                 ".collection",
@@ -64,15 +73,12 @@ def collections():
         results.append(result)
 
     out = {
-        'count': len(results),
+        'count': len(fqcns),
         'results': results,
-        'next': None,
-        'next_link': None,
-        'previous': None,
-        'previous_link': None,
+        **page_number_links(request, ".collections", len(fqcns), page_size, page, scheme),
     }
 
-    return out
+    return out, headers
 
 
 @v2.route('/collections/<namespace>/<collection>')
@@ -91,7 +97,7 @@ def collection(namespace, collection):
         proxy = ProxyUpstream(repository, upstream, cache_read, cache_write, cache_minutes)
         upstream_result = proxy.proxy(request)
 
-    colcol = CollectionCollection.from_collections(discover_collections(repo=repository, namespace=namespace, name=collection))
+    colcol = load_collections(request, repository, namespace=namespace, name=collection)
 
 
     if not (colcol or upstream_result):
@@ -105,16 +111,18 @@ def collection(namespace, collection):
 
     if upstream_result:
         if colgroup is None:
-            return upstream_result
+            return upstream_result, conditional_headers(request, upstream_result.digest)
         else:
             try:
-                upstream_version = VersionInfo.parse(upstream_result['latest_version']['version'])
+                upstream_version = parse_version(upstream_result['latest_version']['version'])
             except (KeyError, ValueError):
                 # TODO: warn?
                 pass
             else:
                 if colgroup.latest < upstream_version:
-                    return upstream_result
+                    return upstream_result, conditional_headers(request, upstream_result.digest)
+
+    headers = conditional_headers(request, colgroup.etag)
 
     result = {
         'href': url_for(
@@ -150,13 +158,14 @@ def collection(namespace, collection):
             "version": colgroup.latest.version,
         },
     }
-    return result
+    return result, headers
 
 
 @v2.route('/collections/<namespace>/<collection>/versions')
 @v2.route('/collections/<namespace>/<collection>/versions/', endpoint='versions')
 def versions(namespace, collection):
     results = []
+    page_size, page = get_page(request)
     repository = authorize(request, current_app.config['ARTIFACTORY_PATH'])
     upstream = current_app.config['PROXY_UPSTREAM']
     no_proxy = current_app.config['NO_PROXY_NAMESPACES']
@@ -170,7 +179,7 @@ def versions(namespace, collection):
         proxy = ProxyUpstream(repository, upstream, cache_read, cache_write, cache_minutes)
         upstream_result = proxy.proxy(request)
 
-    collections = CollectionCollection.from_collections(discover_collections(repo=repository, namespace=namespace, name=collection))
+    collections = load_collections(request, repository, namespace=namespace, name=collection)
 
     if not (collections or upstream_result):
         abort(C.HTTP_NOT_FOUND)
@@ -178,38 +187,70 @@ def versions(namespace, collection):
     if len(collections) > 1:
         abort(C.HTTP_INTERNAL_SERVER_ERROR)
 
-    vers = set()
-    for col in collections.values():
-        for i in col.values():
-            results.append(
-                {
-                    'href': url_for(
-                        ".version",
-                        namespace=i.namespace,
-                        collection=i.name,
-                        version=i.version,
-                        _external=True,
-                        _scheme=scheme,
-                    ),
-                    'version': i.version,
-                }
-            )
-            vers.add(i.version)
+    colgroup = next(iter(collections.values()), None)
+    headers = conditional_headers(
+        request,
+        combine_etags(
+            None if colgroup is None else colgroup.etag,
+            upstream_result.digest if upstream_result else None,
+        ),
+    )
 
+    # Everything is ordered by version, highest first, but only the results for the requested page are built.
     if upstream_result:
+        # Local versions take precedence over upstream versions.
+        by_version = {} if colgroup is None else colgroup.versions
         for item in upstream_result['results']:
-            if item['version'] not in vers:
-                results.append(item)
+            try:
+                key = parse_version(item['version'])
+            except (KeyError, ValueError):
+                # TODO: warn?
+                continue
+            by_version.setdefault(key, item)
+
+        count = len(by_version)
+        ordered = sorted(by_version, key=version_key, reverse=True)
+        items = [by_version[key] for key in ordered[page_number_slice(count, page_size, page)]]
+    else:
+        # the group is already in order, so only the versions up to the end of the page are read
+        count = len(colgroup)
+        page_range = page_number_slice(count, page_size, page)
+        items = islice(colgroup.by_precedence(reverse=True), page_range.start, page_range.stop)
+
+    for i in items:
+        if isinstance(i, dict):
+            results.append(i)
+            continue
+
+        results.append(
+            {
+                'href': url_for(
+                    ".version",
+                    namespace=i.namespace,
+                    collection=i.name,
+                    version=i.version,
+                    _external=True,
+                    _scheme=scheme,
+                ),
+                'version': i.version,
+            }
+        )
 
     out = {
-        'count': len(results),
-        'next': None,
-        'next_link': None,
-        'previous': None,
-        'previous_link': None,
+        'count': count,
+        **page_number_links(
+            request,
+            ".versions",
+            count,
+            page_size,
+            page,
+            scheme,
+            namespace=namespace,
+            collection=collection,
+        ),
         'results': results,
     }
-    return out
+    return out, headers
 
 
 @v2.route('/collections/<namespace>/<collection>/versions/<version>')
@@ -223,12 +264,12 @@ def version(namespace, collection, version):
     cache_write = current_app.config['CACHE_WRITE']
     scheme = current_app.config.get('PREFERRED_URL_SCHEME')
 
-    try:
-        info = next(discover_collections(repository, namespace=namespace, name=collection, version=version))
-    except StopIteration:
+    info = load_collection_version(request, repository, namespace=namespace, name=collection, version=version)
+    if info is None:
         if upstream and (not no_proxy or namespace not in no_proxy):
             proxy = ProxyUpstream(repository, upstream, cache_read, cache_write, cache_minutes)
             upstream_result = proxy.proxy(request)
+            headers = conditional_headers(request, upstream_result.digest)
             upstream_result['download_url'] = url_for(
                 'download.download',
                 filename=upstream_result['artifact']['filename'],
@@ -236,10 +277,12 @@ def version(namespace, collection, version):
                 _scheme=scheme,
                 **{C.QUERY_DOWNLOAD_UPSTREAM_URL: upstream_result['download_url']},
             )
-            return upstream_result
+            return upstream_result, headers
         else:
             abort(C.HTTP_NOT_FOUND)
 
+    headers = conditional_headers(request, info.sha256, info.modified_datetime)
+
     out = {
         'artifact': {
             'filename': info.filename,
@@ -277,7 +320,7 @@ def version(namespace, collection, version):
         'metadata': info.collection_info,
         'version': info.version,
     }
-    return out
+    return out, headers
 
 
 @v2.route('/collections', methods=['POST'])
@@ -1,20 +1,24 @@
 # -*- coding: utf-8 -*-
 # (c) 2023 Brian Scholer (@briantist)
 
-from semver import VersionInfo
+from itertools import islice
+
 from flask import Response, jsonify, abort, url_for, request, current_app
 
 from . import bp as v3
 from ... import constants as C
 from ...utilities import (
-    discover_collections,
     authorize,
+    combine_etags,
+    conditional_headers,
     _chunk_to_temp,
     upload_collection_from_hashed_tempfile,
     IncomingCollectionStream,
 )
+from ...models import parse_version, version_key
 from ...upstream import ProxyUpstream
-from ...models import CollectionCollection
+from ...collection_index import load_collections, load_collection_version
+from ..pagination import get_limit_offset, limit_offset_links, page_slice
 
 
 @v3.route('/collections')
@@ -25,10 +29,15 @@ def collections():
     repository = authorize(request, current_app.config['ARTIFACTORY_PATH'])
     scheme = current_app.config.get('PREFERRED_URL_SCHEME')
 
+    limit, offset = get_limit_offset(request)
+
     results = []
-    colcol = CollectionCollection.from_collections(discover_collections(repo=repository))
+    colcol = load_collections(request, repository)
+    headers = conditional_headers(request, colcol.etag)
+    fqcns = colcol.sorted_keys()
 
-    for colgroup in colcol.values():
+    for fqcn in fqcns[page_slice(limit, offset)]:
+        colgroup = colcol[fqcn]
         result = {
             'href': url_for(
                 ".collection",
@@ -60,26 +69,15 @@ def collections():
         }
         results.append(result)
 
-    this_url = url_for(
-        ".collections",
-        _external=False,
-        **request.args
-    )
-
     out = {
         'meta': {
-            'count': len(results),
-        },
-        'links': { # FIXME
-            'first': this_url,
-            'previous': None,
-            'next': None,
-            'last': this_url,
+            'count': len(fqcns),
         },
+        'links': limit_offset_links(request, ".collections", len(fqcns), limit, offset),
         'data': results,
     }
 
-    return out
+    return out, headers
 
 
 @v3.route('/collections/<namespace>/<collection>')
@@ -100,7 +98,7 @@ def collection(namespace, collection):
         proxy = ProxyUpstream(repository, upstream, cache_read, cache_write, cache_minutes)
         upstream_result = proxy.proxy(request)
 
-    colcol = CollectionCollection.from_collections(discover_collections(repo=repository, namespace=namespace, name=collection))
+    colcol = load_collections(request, repository, namespace=namespace, name=collection)
 
 
     if not (colcol or upstream_result):
@@ -114,16 +112,18 @@ def collection(namespace, collection):
 
     if upstream_result:
         if colgroup is None:
-            return upstream_result
+            return upstream_result, conditional_headers(request, upstream_result.digest)
         else:
             try:
-                upstream_version = VersionInfo.parse(upstream_result['highest_version']['version'])
+                upstream_version = parse_version(upstream_result['highest_version']['version'])
             except (KeyError, ValueError):
                 # TODO: warn?
                 pass
             else:
                 if colgroup.latest < upstream_version:
-                    return upstream_result
+                    return upstream_result, conditional_headers(request, upstream_result.digest)
+
+    headers = conditional_headers(request, colgroup.etag)
 
     result = {
         'href': url_for(
@@ -154,7 +154,7 @@ def collection(namespace, collection):
             "version": colgroup.latest.version,
         },
     }
-    return result
+    return result, headers
 
 @v3.route('/collections/<namespace>/<collection>/versions')
 @v3.route('/collections/<namespace>/<collection>/versions/')
@@ -162,6 +162,7 @@ def collection(namespace, collection):
 @v3.route('/plugin/ansible/content/published/collections/index/<namespace>/<collection>/versions/', endpoint='versions')
 def versions(namespace, collection):
     results = []
+    limit, offset = get_limit_offset(request)
     repository = authorize(request, current_app.config['ARTIFACTORY_PATH'])
     upstream = current_app.config['PROXY_UPSTREAM']
     no_proxy = current_app.config['NO_PROXY_NAMESPACES']
@@ -175,7 +176,7 @@ def versions(namespace, collection):
         proxy = ProxyUpstream(repository, upstream, cache_read, cache_write, cache_minutes)
         upstream_result = proxy.proxy(request)
 
-    collections = CollectionCollection.from_collections(discover_collections(repo=repository, namespace=namespace, name=collection))
+    collections = load_collections(request, repository, namespace=namespace, name=collection)
 
     if not (collections or upstream_result):
         abort(C.HTTP_NOT_FOUND)
@@ -183,54 +184,74 @@ def versions(namespace, collection):
     if len(collections) > 1:
         abort(C.HTTP_INTERNAL_SERVER_ERROR)
 
-    vers = set()
-    for col in collections.values():
-        for i in col.values():
-            results.append(
-                {
-                    'href': url_for(
-                        ".version",
-                        namespace=i.namespace,
-                        collection=i.name,
-                        version=i.version,
-                        _external=False
-                    ),
-                    'version': i.version,
-                    'created_at': i.created,
-                    'updated_at': i.modified,
-                    'marks': [],
-                    'requires_ansible': None, # FIXME
-                }
-            )
-            vers.add(i.version)
+    colgroup = next(iter(collections.values()), None)
+    headers = conditional_headers(
+        request,
+        combine_etags(
+            None if colgroup is None else colgroup.etag,
+            upstream_result.digest if upstream_result else None,
+        ),
+    )
 
+    # Everything is ordered by version, highest first, but only the results for the requested page are built.
+    page_range = page_slice(limit, offset)
     if upstream_result:
+        # Local versions take precedence over upstream versions.
+        by_version = {} if colgroup is None else colgroup.versions
         for item in upstream_result['data']:
-            if item['version'] not in vers:
-                results.append(item)
-
-    this_url = url_for(
-        ".versions",
-        namespace=namespace,
-        collection=collection,
-        _external=False,
-        **request.args
-    )
+            try:
+                key = parse_version(item['version'])
+            except (KeyError, ValueError):
+                # TODO: warn?
+                continue
+            by_version.setdefault(key, item)
+
+        count = len(by_version)
+        page = [by_version[key] for key in sorted(by_version, key=version_key, reverse=True)[page_range]]
+    else:
+        # the group is already in order, so only the versions up to the end of the page are read
+        count = len(colgroup)
+        page = islice(colgroup.by_precedence(reverse=True), page_range.start, page_range.stop)
+
+    for i in page:
+        if isinstance(i, dict):
+            results.append(i)
+            continue
+
+        results.append(
+            {
+                'href': url_for(
+                    ".version",
+                    namespace=i.namespace,
+                    collection=i.name,
+                    version=i.version,
+                    _external=False
+                ),
+                'version': i.version,
+                'created_at': i.created,
+                'updated_at': i.modified,
+                'marks': [],
+                'requires_ansible': None, # FIXME
+            }
+        )
 
     out = {
         'meta': {
-            'count': len(results),
-        },
-        'links': { # FIXME
-            'first': this_url,
-            'previous': None,
-            'next': None,
-            'last': this_url,
+            'count': count,
         },
+        'links': limit_offset_links(
+            request,
+            ".versions",
+            count,
+            limit,
+            offset,
+            namespace=namespace,
+            collection=collection,
+        ),
         'data': results,
     }
 
-    return out
+    return out, headers
 
 
 @v3.route('/collections/<namespace>/<collection>/versions/<version>')
@@ -246,12 +267,12 @@ def version(namespace, collection, version):
     cache_write = current_app.config['CACHE_WRITE']
     scheme = current_app.config.get('PREFERRED_URL_SCHEME')
 
-    try:
-        info = next(discover_collections(repository, namespace=namespace, name=collection, version=version))
-    except StopIteration:
+    info = load_collection_version(request, repository, namespace=namespace, name=collection, version=version)
+    if info is None:
         if upstream and (not no_proxy or namespace not in no_proxy):
             proxy = ProxyUpstream(repository, upstream, cache_read, cache_write, cache_minutes)
             upstream_result = proxy.proxy(request)
+            headers = conditional_headers(request, upstream_result.digest)
             upstream_result['download_url'] = url_for(
                 'download.download',
                 filename=upstream_result['artifact']['filename'],
@@ -259,10 +280,12 @@ def version(namespace, collection, version):
                 _scheme=scheme,
                 **{C.QUERY_DOWNLOAD_UPSTREAM_URL: upstream_result['download_url']},
             )
-            return upstream_result
+            return upstream_result, headers
         else:
             abort(C.HTTP_NOT_FOUND)
 
+    headers = conditional_headers(request, info.sha256, info.modified_datetime)
+
     out = {
         'artifact': {
             'filename': info.filename,
@@ -304,7 +327,7 @@ def version(namespace, collection, version):
         'requires_ansible': None, # FIXME
         'marks': [],
     }
-    return out
+    return out, headers
 
 
 # not going to preserve the v2 paths for uploading
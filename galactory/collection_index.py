@@ -0,0 +1,513 @@
+# -*- coding: utf-8 -*-
+# (c) 2023 Brian Scholer (@briantist)
+
+import gzip
+import json
+import random
+import typing as t
+
+from io import BytesIO
+
+from threading import Lock, Thread, Event
+from time import perf_counter
+from datetime import datetime, timedelta
+
+from semver import VersionInfo
+from flask import current_app, Flask, Request
+from artifactory import ArtifactoryPath, ArtifactoryException
+
+from . import constants as C
+from .models import CollectionData, CollectionGroup, CollectionCollection
+from .utilities import (
+    discover_collections,
+    discover_collections_aql,
+    list_collection_filenames_aql,
+    configured_auth,
+    uses_configured_auth,
+    _session_with_retries,
+)
+
+
+_SNAPSHOT_FORMAT = 2
+_SNAPSHOT_FIELDS = [
+    'namespace',
+    'name',
+    'version',
+    'filename',
+    'sha256',
+    'size',
+    'mime_type',
+    'created_datetime',
+    'modified_datetime',
+    'collection_info',
+]
+_SNAPSHOT_DATETIME_FIELDS = {'created_datetime', 'modified_datetime'}
+
+
+def _collection_to_row(collection: CollectionData) -> list:
+    row = []
+    for field in _SNAPSHOT_FIELDS:
+        if field in _SNAPSHOT_DATETIME_FIELDS:
+            row.append(getattr(collection, field).isoformat())
+        elif field == 'collection_info':
+            # stored as a string, so that loading the snapshot doesn't parse every collection_info
+            row.append(collection.collection_info_json)
+        else:
+            row.append(getattr(collection, field))
+    return row
+
+
+def _collection_from_row(fields: t.List[str], row: list) -> CollectionData:
+    values = dict(zip(fields, row))
+    for field in _SNAPSHOT_DATETIME_FIELDS:
+        values[field] = datetime.fromisoformat(values[field])
+    return CollectionData(**values)
+
+
+def _discovery_options(config: t.Mapping[str, t.Any]) -> t.Dict[str, t.Any]:
+    return dict(
+        use_aql=config.get('USE_AQL', False),
+        concurrency=config.get('DISCOVERY_CONCURRENCY', 1),
+    )
+
+
+def _with_changes(
+    collections: CollectionCollection,
+    added: t.Iterable[CollectionData] = (),
+    removed: t.Iterable[t.Tuple[str, VersionInfo]] = (),
+) -> CollectionCollection:
+    """
+    Returns a copy of collections with the changes applied. Only the groups that
+    change are copied, so the original is never modified and can keep being read.
+    """
+    ret = collections.copy()
+    copied = set()
+
+    def _group(fqcn: str) -> CollectionGroup:
+        group = ret.get(fqcn)
+        if group is not None and fqcn not in copied:
+            group = ret[fqcn] = group.copy()
+            copied.add(fqcn)
+        return group
+
+    for fqcn, key in removed:
+        group = _group(fqcn)
+        if group is not None and key in group:
+            del group[key]
+            if not group:
+                del ret[fqcn]
+
+    for collection in added:
+        group = _group(collection.fqcn)
+        if group is None:
+            ret[collection.fqcn] = CollectionGroup.from_collection(collection)
+            copied.add(collection.fqcn)
+        else:
+            group.add(collection)
+
+    return ret
+
+
+def _exact_versions(collections: CollectionCollection) -> t.Dict[t.Tuple[str, str, str], CollectionData]:
+    return {
+        (collection.namespace, collection.name, collection.version): collection
+        for group in collections.values()
+        for collection in group.values()
+    }
+
+
+class CollectionIndex:
+    """
+    A process-wide, in-memory index of all of the collections in the repository.
+
+    The index is always built with the configured Artifactory auth, so it should
+    only be used to answer requests that would have used that same auth.
+
+    Rebuilds happen off to the side and the new index is swapped in when complete,
+    so readers keep getting the previous index while a rebuild runs. Without a
+    background refresher, the index is refreshed on access once it is older than its TTL.
+
+    When AQL is in use and a full refresh interval is set, refreshes in between
+    full rebuilds only query for artifacts modified since the newest one already
+    in the index, and for the names of all artifacts to find deletions.
+
+    The index can also be saved to and loaded from a snapshot in the repository,
+    so that new instances start with a warm index, and so that instances can skip
+    a full rebuild when another instance has saved a newer snapshot.
+    """
+    _snapshot_path = '_index'
+    _snapshot_name = 'collections.json.gz'
+    _generation_name = 'generation.json'
+
+    def __init__(
+        self,
+        repository: ArtifactoryPath,
+        ttl_seconds: int,
+        use_aql: bool = False,
+        concurrency: int = 1,
+        full_refresh_seconds: int = 0,
+        snapshot_read: bool = False,
+        snapshot_write: bool = False,
+    ) -> None:
+        self._repository = repository
+        self._ttl = timedelta(seconds=ttl_seconds)
+        self._use_aql = use_aql
+        self._concurrency = concurrency
+        self._full_refresh = timedelta(seconds=full_refresh_seconds)
+        self._snapshot_read = snapshot_read
+        self._snapshot_write = snapshot_write
+        self._generation = 0
+        self._lock = Lock()
+        self._rebuild_lock = Lock()
+        self._collections: CollectionCollection = None
+        self._versions: t.Dict[t.Tuple[str, str, str], CollectionData] = None
+        self._built: datetime = None
+        self._last_full: datetime = None
+        self._high_water_mark: datetime = None
+        self._pending: t.List[CollectionData] = None
+        self.background_refresh = False
+        self.last_rebuild_seconds: float = None
+
+    @classmethod
+    def from_config(cls, config: t.Mapping[str, t.Any]):
+        session = _session_with_retries(auth=configured_auth(config), pool_maxsize=config.get('DISCOVERY_CONCURRENCY'))
+        repository = ArtifactoryPath(config['ARTIFACTORY_PATH'], session=session)
+        return cls(
+            repository,
+            config.get('COLLECTION_INDEX_TTL', 0),
+            full_refresh_seconds=config.get('COLLECTION_INDEX_FULL_REFRESH_INTERVAL', 0),
+            snapshot_read=config.get('COLLECTION_INDEX_SNAPSHOT_READ', False),
+            snapshot_write=config.get('COLLECTION_INDEX_SNAPSHOT_WRITE', False),
+            **_discovery_options(config),
+        )
+
+    @property
+    def expired(self) -> bool:
+        return self._built is None or datetime.utcnow() >= self._built + self._ttl
+
+    @property
+    def high_water_mark(self) -> t.Optional[datetime]:
+        return self._high_water_mark
+
+    @property
+    def generation(self) -> int:
+        return self._generation
+
+    @property
+    def _needs_rebuild(self) -> bool:
+        if self._collections is None:
+            return True
+
+        # When a background refresher is keeping the index up to date,
+        # requests should never have to wait for a rebuild.
+        return not self.background_refresh and self.expired
+
+    @property
+    def _can_update(self) -> bool:
+        return (
+            self._use_aql
+            and bool(self._full_refresh)
+            and self._collections is not None
+            and self._high_water_mark is not None
+            and datetime.utcnow() < self._last_full + self._full_refresh
+        )
+
+    def invalidate(self) -> None:
+        self._built = None
+
+    def rebuild(self) -> CollectionCollection:
+        with self._rebuild_lock:
+            return self._rebuild()
+
+    def refresh(self) -> CollectionCollection:
+        with self._rebuild_lock:
+            return self._refresh()
+
+    def _refresh(self) -> CollectionCollection:
+        if self._snapshot_read and self._load_newer_snapshot() and not self._can_update:
+            return self._collections
+
+        if self._can_update:
+            try:
+                return self._update()
+            except ArtifactoryException as exc:
+                current_app.logger.warning("Incremental update of the collection index failed, rebuilding instead: %s", exc)
+
+        return self._rebuild()
+
+    def _swap(self, builder: t.Callable[[], CollectionCollection]) -> CollectionCollection:
+        with self._lock:
+            self._pending = []
+
+        try:
+            collections = builder()
+        except Exception:
+            with self._lock:
+                self._pending = None
+            raise
+
+        with self._lock:
+            # Collections added while building may not have been seen by the builder.
+            if self._pending:
+                collections = _with_changes(collections, added=self._pending)
+            self._pending = None
+            self._set_collections(collections)
+            self._built = datetime.utcnow()
+
+        return collections
+
+    def _set_collections(self, collections: CollectionCollection) -> None:
+        # Must be called with the lock held. The exact version lookup is built up front,
+        # so that it is never out of step with the collections it was built from.
+        self._versions = _exact_versions(collections)
+        self._collections = collections
+
+    def _rebuild(self) -> CollectionCollection:
+        start = perf_counter()
+        collections = self._swap(
+            lambda: CollectionCollection.from_collections(
+                discover_collections(self._repository, use_aql=self._use_aql, concurrency=self._concurrency)
+            )
+        )
+        self._last_full = self._built
+        self._high_water_mark = max(
+            (c.modified_datetime for group in collections.values() for c in group.values()),
+            default=None,
+        )
+
+        self.last_rebuild_seconds = perf_counter() - start
+        current_app.logger.info(
+            "Collection index rebuilt in %.3f seconds (%i collections, %i versions).",
+            self.last_rebuild_seconds,
+            len(collections),
+            sum(len(group) for group in collections.values()),
+        )
+
+        if self._snapshot_write:
+            self._save_snapshot(collections)
+
+        return collections
+
+    def _read_generation(self) -> t.Tuple[int, t.Optional[datetime]]:
+        path = self._repository / self._snapshot_path / self._generation_name
+        try:
+            with path.open() as f:
+                marker = json.load(f)
+            return marker['generation'], datetime.fromisoformat(marker['created'])
+        except (ArtifactoryException, OSError, ValueError, KeyError):
+            return 0, None
+
+    def _load_newer_snapshot(self) -> bool:
+        if self._collections is not None:
+            if self._can_update:
+                return False
+
+            # A full rebuild is due; skip it if another instance has saved a newer snapshot since our last one.
+            generation, created = self._read_generation()
+            if generation <= self._generation or created is None or created <= self._last_full:
+                return False
+
+        return self._load_snapshot()
+
+    def _load_snapshot(self) -> bool:
+        path = self._repository / self._snapshot_path / self._snapshot_name
+        try:
+            with path.open() as f:
+                snapshot = json.loads(gzip.decompress(f.read()))
+            metadata = snapshot['metadata']
+            if metadata['format'] != _SNAPSHOT_FORMAT:
+                raise ValueError(f"unsupported snapshot format {metadata['format']}")
+        except (ArtifactoryException, OSError, ValueError, KeyError) as exc:
+            current_app.logger.warning("Could not load the collection index snapshot: %s", exc)
+            return False
+
+        start = perf_counter()
+        fields = snapshot['fields']
+        collections = self._swap(
+            lambda: CollectionCollection.from_collections(_collection_from_row(fields, row) for row in snapshot['rows'])
+        )
+        self._generation = metadata['generation']
+        # The snapshot is as old as the scan that produced it.
+        self._built = self._last_full = datetime.fromisoformat(metadata['created'])
+        hwm = metadata.get('high_water_mark')
+        self._high_water_mark = None if hwm is None else datetime.fromisoformat(hwm)
+
+        current_app.logger.info(
+            "Collection index loaded from snapshot generation %i in %.3f seconds (%i collections).",
+            self._generation,
+            perf_counter() - start,
+            len(collections),
+        )
+
+        return True
+
+    def _save_snapshot(self, collections: CollectionCollection) -> None:
+        generation = max(self._generation, self._read_generation()[0]) + 1
+        created = self._last_full.isoformat()
+        snapshot = {
+            'metadata': {
+                'format': _SNAPSHOT_FORMAT,
+                'generation': generation,
+                'created': created,
+                'high_water_mark': None if self._high_water_mark is None else self._high_water_mark.isoformat(),
+            },
+            'fields': _SNAPSHOT_FIELDS,
+            'rows': [_collection_to_row(c) for group in collections.values() for c in group.values()],
+        }
+
+        path = self._repository / self._snapshot_path
+        try:
+            with BytesIO(gzip.compress(json.dumps(snapshot, separators=(',', ':')).encode())) as buffer:
+                (path / self._snapshot_name).deploy(buffer, quote_parameters=True)
+            # The marker is written after the snapshot, so it never points at a snapshot that doesn't exist yet.
+            with BytesIO(json.dumps({'generation': generation, 'created': created}).encode()) as buffer:
+                (path / self._generation_name).deploy(buffer, quote_parameters=True)
+        except ArtifactoryException as exc:
+            current_app.logger.warning("Could not save the collection index snapshot: %s", exc)
+        else:
+            self._generation = generation
+
+    def _update(self) -> CollectionCollection:
+        start = perf_counter()
+        changed = []
+        deleted = 0
+
+        def _build() -> CollectionCollection:
+            nonlocal deleted
+            # The queries and the read of the current collections happen inside the swap,
+            # so that collections added while they run are replayed onto the result.
+            current = self._collections
+            changed.extend(discover_collections_aql(self._repository, modified_since=self._high_water_mark))
+            present = list_collection_filenames_aql(self._repository)
+
+            changed_filenames = {c.filename for c in changed}
+            removed = []
+            for group in current.values():
+                for key, collection in group.items():
+                    if collection.filename not in present:
+                        deleted += 1
+                        removed.append((group.fqcn, key))
+                    elif collection.filename in changed_filenames:
+                        # re-deployed artifacts are removed first, in case their version changed
+                        removed.append((group.fqcn, key))
+
+            return _with_changes(current, added=changed, removed=removed)
+
+        collections = self._swap(_build)
+        self._high_water_mark = max((c.modified_datetime for c in changed), default=self._high_water_mark)
+
+        current_app.logger.info(
+            "Collection index updated in %.3f seconds (%i changed, %i removed).",
+            perf_counter() - start,
+            len(changed),
+            deleted,
+        )
+
+        return collections
+
+    def collections(self) -> CollectionCollection:
+        if self._needs_rebuild:
+            with self._rebuild_lock:
+                # another thread may have finished refreshing while we waited for the lock
+                if self._needs_rebuild:
+                    self._refresh()
+
+        return self._collections
+
+    def find(self, namespace: str = None, name: str = None) -> CollectionCollection:
+        collections = self.collections()
+
+        if namespace and name:
+            ret = CollectionCollection()
+            group = collections.get(f"{namespace}.{name}")
+            if group is not None:
+                ret.data[group.fqcn] = group
+            return ret
+
+        if not (namespace or name):
+            return collections
+
+        ret = CollectionCollection()
+        for fqcn, group in collections.items():
+            if (not namespace or group.namespace == namespace) and (not name or group.name == name):
+                ret.data[fqcn] = group
+        return ret
+
+    def get(self, namespace: str, name: str, version: str) -> t.Optional[CollectionData]:
+        self.collections()
+        return self._versions.get((namespace, name, version))
+
+    def add(self, collection: CollectionData) -> None:
+        with self._lock:
+            if self._pending is not None:
+                self._pending.append(collection)
+
+            if self._collections is None:
+                return
+
+            self._set_collections(_with_changes(self._collections, added=[collection]))
+
+
+class CollectionIndexRefresher(Thread):
+    """
+    A daemon thread that rebuilds a CollectionIndex on an interval,
+    with an optional random jitter added to each wait.
+    """
+    def __init__(self, app: Flask, index: CollectionIndex, interval_seconds: float, jitter_seconds: float = 0) -> None:
+        super().__init__(name='galactory-collection-index-refresher', daemon=True)
+        self._app = app
+        self._index = index
+        self._interval = interval_seconds
+        self._jitter = jitter_seconds
+        self._stop_event = Event()
+        index.background_refresh = True
+
+    def run(self) -> None:
+        with self._app.app_context():
+            while not self._stop_event.is_set():
+                try:
+                    self._index.refresh()
+                except Exception:
+                    # keep serving the previous index, and try again on the next interval
+                    self._app.logger.exception("Error rebuilding the collection index.")
+
+                self._stop_event.wait(self._interval + random.uniform(0, self._jitter))
+
+    def stop(self) -> None:
+        self._stop_event.set()
+
+
+def get_collection_index(request: Request) -> t.Optional[CollectionIndex]:
+    if not uses_configured_auth(request):
+        return None
+
+    return current_app.extensions.get(C.EXTENSION_COLLECTION_INDEX)
+
+
+def load_collections(
+    request: Request,
+    repository: ArtifactoryPath,
+    namespace: str = None,
+    name: str = None,
+) -> CollectionCollection:
+    index = get_collection_index(request)
+    if index is None:
+        collections = discover_collections(repository, namespace=namespace, name=name, **_discovery_options(current_app.config))
+        return CollectionCollection.from_collections(collections)
+
+    return index.find(namespace=namespace, name=name)
+
+
+def load_collection_version(
+    request: Request,
+    repository: ArtifactoryPath,
+    namespace: str,
+    name: str,
+    version: str,
+) -> t.Optional[CollectionData]:
+    index = get_collection_index(request)
+    if index is None:
+        collections = discover_collections(repository, namespace=namespace, name=name, version=version, **_discovery_options(current_app.config))
+        return next(collections, None)
+
+    return index.get(namespace, name, version)
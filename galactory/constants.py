@@ -3,7 +3,17 @@
 
 CONTENT_TYPE = {'Content-Type': 'application/json'}
 HTTP_OK = 200
+HTTP_NOT_MODIFIED = 304
+HTTP_BAD_REQUEST = 400
 HTTP_NOT_FOUND = 404
 HTTP_INTERNAL_SERVER_ERROR = 500
 
 QUERY_DOWNLOAD_UPSTREAM_URL = 'galactory_upstream_url'
+
+EXTENSION_COLLECTION_INDEX = 'galactory.collection_index'
+EXTENSION_COLLECTION_INDEX_REFRESHER = 'galactory.collection_index_refresher'
+EXTENSION_UPSTREAM_MEMORY_CACHE = 'galactory.upstream_memory_cache'
+EXTENSION_UPSTREAM_REVALIDATOR = 'galactory.upstream_revalidator'
+EXTENSION_SINGLE_FLIGHT = 'galactory.single_flight'
+EXTENSION_SESSIONS = 'galactory.sessions'
+EXTENSION_CACHE_WRITER = 'galactory.cache_writer'
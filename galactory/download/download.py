@@ -5,7 +5,7 @@ from flask import abort, request, current_app, send_file
 
 from . import bp as dl
 from .. import constants as C
-from ..utilities import authorize, _chunk_to_temp, upload_collection_from_hashed_tempfile
+from ..utilities import authorize, single_flight, _chunk_to_temp, upload_collection_from_hashed_tempfile
 from ..upstream import ProxyUpstream
 
 
@@ -31,12 +31,17 @@ def download(filename):
 
         proxy = ProxyUpstream(artifact, upstream, cache_read, cache_write, cache_minutes)
 
-        with proxy.proxy_download(request) as resp, _chunk_to_temp(None, iterator=resp.iter_content, close=cache_write) as tmp:
-            if not cache_write:
-                return send_file(tmp.handle, as_attachment=True, download_name=filename, etag=False)
+        if not cache_write:
+            # concurrent downloads of the same missing artifact share a single upstream download
+            return send_file(proxy.download(request), as_attachment=True, download_name=filename, etag=False)
 
-            upload_collection_from_hashed_tempfile(artifact, tmp, property_fallback=property_fallback)
+        def _cache_download():
+            with proxy.proxy_download(request) as resp, _chunk_to_temp(None, iterator=resp.iter_content) as tmp:
+                upload_collection_from_hashed_tempfile(artifact, tmp, property_fallback=property_fallback)
 
+        # concurrent downloads of the same missing artifact wait for a single upload to Artifactory,
+        # and then are all served from there
+        single_flight(('download', str(artifact)), _cache_download)
         stat = artifact.stat()
 
     return send_file(artifact.open(), as_attachment=True, download_name=artifact.name, last_modified=stat.mtime, etag=False)
@@ -2,39 +2,127 @@
 # (c) 2023 Brian Scholer (@briantist)
 
 import json
+import hashlib
 
 import typing as t
 from typing import ValuesView
 
 from semver import VersionInfo
+from bisect import bisect_left, insort
 from collections import UserDict
-from dataclasses import dataclass
-from functools import total_ordering, cached_property
+from heapq import merge
+from functools import total_ordering, cached_property, lru_cache
 from datetime import datetime
 
 from artifactory import ArtifactoryPath
 
+COLLECTION_MIME_TYPE = 'application/x-gzip'
+
+
+def _parse_aql_datetime(value: str) -> datetime:
+    # AQL returns UTC timestamps with a Z suffix, which fromisoformat doesn't accept before py3.11
+    return datetime.fromisoformat(value.replace('Z', '+00:00'))
+
+
+# Bounds the memory used by interned versions, while being large enough
+# that the versions in a typical repository are only parsed once.
+_VERSION_CACHE_SIZE = 16384
+
+
+@lru_cache(maxsize=_VERSION_CACHE_SIZE)
+def parse_version(version: str) -> VersionInfo:
+    """
+    Parses a semantic version string. The same string returns the same VersionInfo
+    object while it is in the cache, so repeated versions are parsed once and share memory.
+    """
+    return VersionInfo.parse(version)
+
+
+def version_key(version: VersionInfo) -> tuple:
+    """
+    A tuple that sorts in the same order as semantic version precedence, so that
+    versions can be sorted and compared without semver's rich comparisons.
+    Build metadata is ignored, the same as in semver.
+    """
+    prerelease = version.prerelease
+    if prerelease is None:
+        return (version.major, version.minor, version.patch, True, ())
+
+    # numeric identifiers have lower precedence than alphanumeric ones
+    identifiers = tuple((0, int(i), '') if i.isdigit() else (1, 0, i) for i in prerelease.split('.'))
+    return (version.major, version.minor, version.patch, False, identifiers)
+
+
+def _sort_key(version: VersionInfo) -> tuple:
+    # the ordering used by CollectionData and CollectionGroup, where all prereleases sort before all releases
+    return (version.prerelease is None, version_key(version))
+
+
+def _digest(parts: t.Iterable[str]) -> str:
+    h = hashlib.sha256()
+    for part in parts:
+        h.update(part.encode())
+        h.update(b'\0')
+    return h.hexdigest()
+
 
 @total_ordering
-@dataclass(eq=False, order=False)
 class CollectionData:
-    collection_info: dict
-    created_datetime: datetime
-    modified_datetime: datetime
-    namespace: str
-    name: str
-    filename: str
-    sha256: str
-    size: int
-    mime_type: str
-    version: str
+    """
+    The metadata of a single collection version.
+
+    Uses __slots__ and explicit memo fields instead of a __dict__, since the
+    collection index can hold a very large number of these. The collection_info
+    can be given as the raw JSON string from the artifact's properties, and is
+    only parsed the first time it is accessed.
+    """
+    __slots__ = (
+        'created_datetime',
+        'modified_datetime',
+        'namespace',
+        'name',
+        'filename',
+        'sha256',
+        'size',
+        'mime_type',
+        'version',
+        '_collection_info',
+        '_fqcn',
+        '_created',
+        '_modified',
+        '_semver',
+        '_sort_key',
+    )
+
+    def __init__(
+        self,
+        collection_info: t.Union[dict, str],
+        created_datetime: datetime,
+        modified_datetime: datetime,
+        namespace: str,
+        name: str,
+        filename: str,
+        sha256: str,
+        size: int,
+        mime_type: str,
+        version: str,
+    ) -> None:
+        self._collection_info = collection_info
+        self.created_datetime = created_datetime
+        self.modified_datetime = modified_datetime
+        self.namespace = namespace
+        self.name = name
+        self.filename = filename
+        self.sha256 = sha256
+        self.size = size
+        self.mime_type = mime_type
+        self.version = version
+        self._fqcn = self._created = self._modified = self._semver = self._sort_key = None
 
     @classmethod
     def from_artifactory_path(cls, *, path: ArtifactoryPath, properties: dict, stat: dict):
-        collection_info = json.loads(properties['collection_info'][0])
-
         return cls(
-            collection_info=collection_info,
+            collection_info=properties['collection_info'][0],
             created_datetime=stat.ctime,
             modified_datetime=stat.mtime,
             namespace=properties['namespace'][0],
@@ -46,6 +134,29 @@ class CollectionData:
             version=properties['version'][0],
         )
 
+    @classmethod
+    def from_aql_result(cls, result: dict):
+        properties = {}
+        for prop in result.get('properties', []):
+            properties.setdefault(prop['key'], []).append(prop.get('value'))
+
+        return cls(
+            collection_info=properties['collection_info'][0],
+            created_datetime=_parse_aql_datetime(result['created']),
+            modified_datetime=_parse_aql_datetime(result['modified']),
+            namespace=properties['namespace'][0],
+            name=properties['name'][0],
+            filename=result['name'],
+            sha256=result['sha256'],
+            size=int(result['size']),
+            # AQL does not expose the mime type, but collections are always gzipped tarballs.
+            mime_type=COLLECTION_MIME_TYPE,
+            version=properties['version'][0],
+        )
+
+    def __repr__(self) -> str:
+        return f"{self.__class__.__name__}(namespace={self.namespace!r}, name={self.name!r}, version={self.version!r}, sha256={self.sha256!r})"
+
     def __eq__(self, other) -> bool:
         # All of the comparable information is in the collection
         # tarball itself, so this should be a nice fast way of
@@ -59,45 +170,76 @@ class CollectionData:
             return NotImplemented
 
     def __lt__(self, other) -> bool:
-        this_is_prerelease = self.is_prerelease
-        this_version = self.semver
-
         if isinstance(other, VersionInfo):
-            other_is_prerelease = other.prerelease is not None
-            other_version = other
+            other_key = _sort_key(other)
         elif isinstance(other, CollectionData):
-            other_is_prerelease = other.is_prerelease
-            other_version = other.semver
             if self.name != other.name or self.namespace != other.namespace:
                 return False
+            other_key = other.sort_key
         else:
             return NotImplemented
 
-        # Both objects are prerelease versions, or both are not, so compare normally.
-        if this_is_prerelease == other_is_prerelease:
-            return this_version < other_version
+        # Prereleases are always less than releases, and otherwise
+        # versions compare by their semantic version precedence.
+        return self.sort_key < other_key
 
-        # One of the objects is not a prerelease and the other is.
-        # If self is a prerelease, then it is necessarily < the other.
-        return this_is_prerelease
+    @property
+    def collection_info(self) -> dict:
+        info = self._collection_info
+        if isinstance(info, str):
+            info = self._collection_info = json.loads(info)
+        return info
 
-    @cached_property
+    @collection_info.setter
+    def collection_info(self, value: t.Union[dict, str]) -> None:
+        self._collection_info = value
+
+    @property
+    def collection_info_json(self) -> str:
+        """
+        The collection_info as a JSON string, without parsing it if it hasn't been parsed yet.
+        """
+        info = self._collection_info
+        if isinstance(info, str):
+            return info
+        return json.dumps(info)
+
+    @property
     def fqcn(self) -> str:
-        return f"{self.namespace}.{self.name}"
+        fqcn = self._fqcn
+        if fqcn is None:
+            fqcn = self._fqcn = f"{self.namespace}.{self.name}"
+        return fqcn
 
-    @cached_property
+    @property
     def created(self) -> str:
-        return self.created_datetime.isoformat()
+        created = self._created
+        if created is None:
+            created = self._created = self.created_datetime.isoformat()
+        return created
 
-    @cached_property
+    @property
     def modified(self) -> str:
-        return self.modified_datetime.isoformat()
+        modified = self._modified
+        if modified is None:
+            modified = self._modified = self.modified_datetime.isoformat()
+        return modified
 
-    @cached_property
+    @property
     def semver(self) -> VersionInfo:
-        return VersionInfo.parse(self.version)
+        semver = self._semver
+        if semver is None:
+            semver = self._semver = parse_version(self.version)
+        return semver
 
-    @cached_property
+    @property
+    def sort_key(self) -> tuple:
+        sort_key = self._sort_key
+        if sort_key is None:
+            sort_key = self._sort_key = _sort_key(self.semver)
+        return sort_key
+
+    @property
     def is_prerelease(self) -> bool:
         return self.semver.prerelease is not None
 
@@ -108,12 +250,18 @@ class CollectionGroup(UserDict):
     versions of a single collection. The keys are
     VersionInfo objects and the values are
     CollectionData objects.
+
+    Iteration is in version order, using the same ordering
+    as CollectionData, where all prereleases sort before
+    all releases.
     """
-    latest: CollectionData = None
+    _etag: t.Optional[str] = None
 
     def __init__(self, *, namespace: str, name: str):
         self.namespace = namespace
         self.name = name
+        # (sort key, version) of each version, kept in order so that we can bisect
+        self._order: t.List[t.Tuple[tuple, VersionInfo]] = []
         super().__init__()
 
     @classmethod
@@ -122,23 +270,114 @@ class CollectionGroup(UserDict):
         instance.add(collection)
         return instance
 
+    @classmethod
+    def from_collections(cls, collections: t.Iterable[CollectionData]):
+        """
+        Builds a group in bulk, sorting the versions once instead of on every insert.
+        The collections must all be versions of the same collection; this is not validated.
+        When a version appears more than once, the last one wins, the same as with add.
+        """
+        versions = {}
+        for collection in collections:
+            versions[collection.semver] = collection
+
+        first = next(iter(versions.values()))
+        instance = cls(namespace=first.namespace, name=first.name)
+        instance.data = versions
+        instance._order = sorted((collection.sort_key, key) for key, collection in versions.items())
+        return instance
+
     @property
     def versions(self) -> t.Dict[VersionInfo, CollectionData]:
-        return self.data
+        """
+        A new dict of the versions, in version order.
+        """
+        return {key: self.data[key] for _, key in self._order}
+
+    @property
+    def latest(self) -> t.Optional[CollectionData]:
+        if not self._order:
+            return None
+        return self.data[self._order[-1][1]]
+
+    @property
+    def latest_stable(self) -> t.Optional[CollectionData]:
+        # releases sort after prereleases, so if there is a release it's the last item
+        if not self._order or not self._order[-1][0][0]:
+            return None
+        return self.data[self._order[-1][1]]
 
     @cached_property
     def fqcn(self) -> str:
         return f"{self.namespace}.{self.name}"
 
+    @property
+    def etag(self) -> str:
+        """
+        A digest of the sha256 and modified time of every version, for use as an HTTP entity tag.
+        It is the same for equal groups regardless of the order their versions were added in.
+        """
+        etag = self._etag
+        if etag is None:
+            etag = self._etag = _digest(
+                f"{c.sha256}:{c.modified}" for c in sorted(self.values(), key=lambda c: (c.sha256, c.modified))
+            )
+        return etag
+
     def add(self, collection: CollectionData) -> None:
         self[collection.semver] = collection
 
+    def version_range(
+        self,
+        minimum: t.Union[str, VersionInfo, None] = None,
+        maximum: t.Union[str, VersionInfo, None] = None,
+    ) -> t.List[CollectionData]:
+        """
+        Returns the versions that are >= minimum and < maximum by semantic version precedence,
+        in the group's order (prereleases first). Bounds may be prereleases, and a range
+        between two releases includes the prereleases that fall between them.
+        """
+        # The group is ordered by (is release, precedence), so the prereleases and the releases
+        # are each ordered by precedence, and the range is bisected in each of them.
+        # A 1-tuple sorts before any 2-tuple that starts with the same sort key.
+        low = None if minimum is None else version_key(self._get_key(minimum))
+        high = None if maximum is None else version_key(self._get_key(maximum))
+        split = bisect_left(self._order, ((True,),))
+        ret = []
+        for is_release, lo, hi in ((False, 0, split), (True, split, len(self._order))):
+            start = lo if low is None else bisect_left(self._order, ((is_release, low),), lo, hi)
+            stop = hi if high is None else bisect_left(self._order, ((is_release, high),), lo, hi)
+            ret.extend(self.data[key] for _, key in self._order[start:stop])
+        return ret
+
+    def by_precedence(self, reverse: bool = False) -> t.Iterator[CollectionData]:
+        """
+        Iterates over the versions by semantic version precedence, where prereleases come between
+        releases instead of before all of them. The prereleases and the releases are each already
+        in order, and are merged lazily, so taking the first n versions is O(n).
+        """
+        order = self._order
+        split = bisect_left(order, ((True,),))
+        if reverse:
+            runs = (range(split - 1, -1, -1), range(len(order) - 1, split - 1, -1))
+        else:
+            runs = (range(split), range(split, len(order)))
+
+        merged = merge(*((order[i] for i in run) for run in runs), key=lambda entry: entry[0][1], reverse=reverse)
+        return (self.data[key] for _, key in merged)
+
+    def copy(self) -> 'CollectionGroup':
+        ret = self.__class__(namespace=self.namespace, name=self.name)
+        ret.data = self.data.copy()
+        ret._order = self._order.copy()
+        return ret
+
     @staticmethod
     def _get_key(key: t.Union[str, VersionInfo], *, raises: bool = True) -> VersionInfo:
         if isinstance(key, VersionInfo):
             return key
         elif isinstance(key, str):
-            return VersionInfo.parse(key)
+            return parse_version(key)
         else:
             if raises:
                 raise TypeError("Only valid semantic versions can be used as keys.")
@@ -155,17 +394,26 @@ class CollectionGroup(UserDict):
         if self.name != item.name or self.namespace != item.namespace:
             raise ValueError(f"Attempted to add collection '{item.namespace}.{item.name}' to group for '{self.namespace}.{self.name}'.")
 
-        if self.latest is None or item > self.latest:
-            self.latest = item
+        dkey = self._get_key(key)
+        if dkey not in self.data:
+            sort_key = item.sort_key if dkey is item.semver else _sort_key(dkey)
+            insort(self._order, (sort_key, dkey))
 
-        return super().__setitem__(self._get_key(key), item)
+        self._etag = None
+        return super().__setitem__(dkey, item)
 
     def __delitem__(self, key: t.Union[str, VersionInfo]) -> None:
         dkey = self._get_key(key)
         super().__delitem__(dkey)
+        self._etag = None
+
+        del self._order[bisect_left(self._order, (_sort_key(dkey),))]
+
+    def __iter__(self) -> t.Iterator[VersionInfo]:
+        return (key for _, key in self._order)
 
-        if self.latest == dkey:
-            self.latest = max(self.values(), default=None)
+    def __reversed__(self) -> t.Iterator[VersionInfo]:
+        return (key for _, key in reversed(self._order))
 
     def __contains__(self, key: t.Union[str, VersionInfo]) -> bool:
         return super().__contains__(self._get_key(key, raises=False))
@@ -179,18 +427,73 @@ class CollectionCollection(UserDict):
     """
     A Dict[str, CollectionGroup] object where the keys are FQCNs.
     """
+    _sorted_keys: t.Optional[t.List[str]] = None
+    _etag: t.Optional[str] = None
+
     @classmethod
     def from_collections(cls, collections: t.Iterable[CollectionData]):
-        instance = cls()
+        """
+        Builds the collection in bulk, grouping the collections by FQCN in a single pass
+        and then building each group at once, which skips the validation done by add.
+        The collections are expected to be well formed, like those from discovery or a snapshot.
+        """
+        grouped: t.Dict[str, t.List[CollectionData]] = {}
         for collection in collections:
-            instance.add(collection)
+            group = grouped.get(collection.fqcn)
+            if group is None:
+                group = grouped[collection.fqcn] = []
+            group.append(collection)
+
+        instance = cls()
+        instance.data = {fqcn: CollectionGroup.from_collections(group) for fqcn, group in grouped.items()}
         return instance
 
     def add(self, collection: CollectionData) -> None:
         if collection.fqcn in self.data:
             self.data[collection.fqcn].add(collection)
+            self._etag = None
         else:
-            self.data[collection.fqcn] = CollectionGroup.from_collection(collection)
+            self[collection.fqcn] = CollectionGroup.from_collection(collection)
+
+    def sorted_keys(self) -> t.List[str]:
+        """
+        The FQCNs in sorted order, for stable pagination. The sorted list is
+        kept until an FQCN is added or removed, so it must not be modified.
+        """
+        keys = self._sorted_keys
+        if keys is None:
+            keys = self._sorted_keys = sorted(self.data)
+        return keys
+
+    @property
+    def etag(self) -> str:
+        """
+        A digest of the etags of every group, for use as an HTTP entity tag.
+        Like the sorted keys, it is kept until a group is added, replaced, or removed,
+        so groups must not be modified in place other than through add.
+        """
+        etag = self._etag
+        if etag is None:
+            etag = self._etag = _digest(f"{fqcn}:{self.data[fqcn].etag}" for fqcn in self.sorted_keys())
+        return etag
+
+    def copy(self) -> 'CollectionCollection':
+        # UserDict.copy briefly empties self while copying, which readers of a shared instance would see.
+        ret = self.__class__()
+        ret.data = self.data.copy()
+        ret._sorted_keys = self._sorted_keys
+        ret._etag = self._etag
+        return ret
+
+    def __setitem__(self, key: str, item: CollectionGroup) -> None:
+        if key not in self.data:
+            self._sorted_keys = None
+        self._etag = None
+        return super().__setitem__(key, item)
+
+    def __delitem__(self, key: str) -> None:
+        super().__delitem__(key)
+        self._sorted_keys = self._etag = None
 
     # re-define for the type hints
     def values(self) -> ValuesView[CollectionGroup]:
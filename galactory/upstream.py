@@ -3,36 +3,103 @@
 
 import requests
 import json
-
+import gzip
+import zlib
+import brotli
+import hashlib
+import typing as t
+
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from contextlib import contextmanager
-from io import StringIO
+from functools import partial
+from queue import Queue, Empty, Full
+from threading import Lock, Thread
+from io import BytesIO
+from tempfile import NamedTemporaryFile
+from math import ceil
+from urllib.parse import urlsplit, urlunsplit, parse_qsl, urlencode
 from datetime import datetime, timedelta
 from artifactory import ArtifactoryException
 
-from flask import current_app, abort, Response, url_for
+from flask import Flask, current_app, abort, Response, url_for
 
 from . import constants as C
-from .utilities import _session_with_retries, DateTimeIsoFormatJSONProvider
+from .utilities import scoped_session, single_flight, _concurrent_map, DateTimeIsoFormatJSONProvider
+
+# A compressed cache entry starts with the magic, followed by a format version byte,
+# and the name of the compression, up to a newline. The rest is the compressed JSON.
+# Anything else is read as plain JSON, which is how all entries used to be written.
+_ENVELOPE_MAGIC = b'GALACTORY-CACHE'
+_ENVELOPE_VERSION = 1
+_COMPRESSIONS = {
+    'gzip': (gzip.compress, gzip.decompress),
+    # higher qualities are much slower to compress, for little gain on JSON
+    'brotli': (partial(brotli.compress, quality=5), brotli.decompress),
+}
+
+
+def _wrap(payload: bytes, compression: t.Optional[str] = None) -> bytes:
+    if compression is None or compression == 'none':
+        return payload
+
+    compress = _COMPRESSIONS[compression][0]
+    return b''.join([_ENVELOPE_MAGIC, bytes([_ENVELOPE_VERSION]), compression.encode(), b'\n', compress(payload)])
+
+
+def _unwrap(raw: t.Union[bytes, str]) -> t.Union[bytes, str]:
+    if isinstance(raw, str) or not raw.startswith(_ENVELOPE_MAGIC):
+        return raw
+
+    if len(raw) <= len(_ENVELOPE_MAGIC):
+        raise ValueError("Truncated cache entry envelope.")
+
+    version = raw[len(_ENVELOPE_MAGIC)]
+    if version != _ENVELOPE_VERSION:
+        raise ValueError(f"Unsupported cache entry format version {version}.")
+
+    start = len(_ENVELOPE_MAGIC) + 1
+    end = raw.index(b'\n', start)
+    compression = raw[start:end].decode()
+    try:
+        decompress = _COMPRESSIONS[compression][1]
+    except KeyError:
+        raise ValueError(f"Unsupported cache entry compression '{compression}'.")
+
+    try:
+        return decompress(raw[end + 1:])
+    except (OSError, EOFError, zlib.error, brotli.error) as e:
+        raise ValueError(f"Could not decompress cache entry with '{compression}': {e!r}") from e
+
+
+_METADATA_DATETIME_FIELDS = ('created', 'expires')
+_DOWNLOAD_CHUNK_SIZE = 64 * 1024
+# The number of differently rendered copies of its data that an entry keeps;
+# usually there is only one, for the URL root that clients use.
+_MAX_RENDERED = 4
+
 
 class _CacheEntry:
     _raw = {}
 
     @classmethod
     def from_file(cls, f, **kwargs):
-        def _time_decoder(pairs):
-            d = {}
-            for k, v in pairs:
-                try:
-                    nv = datetime.fromisoformat(v)
-                except (ValueError, TypeError):
-                    d[k] = v
-                else:
-                    d[k] = nv
+        return cls.from_json(_unwrap(f.read()), **kwargs)
 
-            return d
+    @classmethod
+    def from_json(cls, s, **kwargs):
+        loaded = json.loads(s)
+        # Only these metadata fields are datetimes, so the data, which can be large, is decoded as is.
+        metadata = loaded['metadata']
+        for field in _METADATA_DATETIME_FIELDS:
+            value = metadata.get(field)
+            if isinstance(value, str):
+                try:
+                    metadata[field] = datetime.fromisoformat(value)
+                except ValueError:
+                    pass
 
-        loaded = json.load(f, object_pairs_hook=_time_decoder)
-        return cls(data=loaded['data'], metadata=loaded['metadata'], **kwargs)
+        return cls(data=loaded['data'], metadata=metadata, **kwargs)
 
     def __init__(self, expiry_delta, data=None, metadata=None, calculate_expiry_on_read=True) -> None:
         raw = {'metadata': {}, 'data': {}}
@@ -45,10 +112,23 @@ class _CacheEntry:
             raw['metadata'] = metadata.copy()
 
         self._raw = raw
+        self._rendered = {}
 
     @property
     def empty(self) -> bool:
-        return not (self._raw.get('data') and self._raw.get('metadata'))
+        # a negative entry has no data, but is not empty
+        return not (self._raw.get('metadata') and (self._raw.get('data') or self.negative))
+
+    @property
+    def negative(self) -> bool:
+        return self.metadata.get('negative', False)
+
+    def set_negative(self, expiry_delta) -> None:
+        """
+        Marks this entry as a cached upstream 404, which expires after expiry_delta instead.
+        """
+        self._expiry_delta = expiry_delta
+        self.metadata['negative'] = True
 
     @property
     def created(self) -> datetime:
@@ -87,11 +167,62 @@ class _CacheEntry:
     def data(self, value) -> None:
         self._raw['data'] = value
         self.metadata['dirty'] = True
+        self.metadata.pop('digest', None)
+        self._rendered = {}
+
+    def rendered(self, key: t.Hashable, render: t.Callable[[dict], dict]) -> dict:
+        """
+        Returns render(data), computed once for each key, so that an entry kept in memory
+        is not rendered again on every hit. The result is shared and must not be modified.
+        """
+        rendered = self._rendered.get(key)
+        if rendered is None:
+            rendered = render(self.data)
+            if len(self._rendered) < _MAX_RENDERED:
+                self._rendered[key] = rendered
+
+        return rendered
+
+    @property
+    def digest(self) -> str:
+        # Stored in the metadata so that it doesn't have to be recomputed when read back from the cache.
+        digest = self.metadata.get('digest')
+        if digest is None:
+            serialized = json.dumps(self.data, sort_keys=True, separators=(',', ':'), default=DateTimeIsoFormatJSONProvider.default)
+            digest = self.metadata['digest'] = hashlib.sha256(serialized.encode()).hexdigest()
+        return digest
 
     @property
     def dirty(self) -> bool:
         return self.metadata.get('dirty', False)
 
+    @property
+    def upstream_etag(self) -> t.Optional[str]:
+        return self.metadata.get('upstream_etag')
+
+    @property
+    def upstream_last_modified(self) -> t.Optional[str]:
+        return self.metadata.get('upstream_last_modified')
+
+    def set_validators(self, headers: t.Mapping[str, str]) -> None:
+        """
+        Keeps the validators from the headers of an upstream response, for a conditional request when the entry expires.
+        """
+        for header, key in (('ETag', 'upstream_etag'), ('Last-Modified', 'upstream_last_modified')):
+            value = headers.get(header)
+            if value is not None:
+                self.metadata[key] = value
+
+    def renewed(self) -> '_CacheEntry':
+        """
+        Returns a copy of this entry with the same data, that expires as if it was just created.
+        """
+        entry = _CacheEntry(expiry_delta=self._expiry_delta, data=self.data, metadata=self.metadata, calculate_expiry_on_read=self._calc_on_read)
+        entry.update(force=True)
+        # the data is the same, so it renders the same
+        entry._rendered = self._rendered.copy()
+        return entry
+
     def update(self, force=False):
         if not (force or self.dirty):
             return
@@ -100,6 +231,8 @@ class _CacheEntry:
         self.metadata['created'] = now
         self.metadata['expires'] = now + self._expiry_delta
         self.metadata['dirty'] = False
+        # computing the digest stores it in the metadata, so it is written with the entry
+        self.digest
 
     def _to_serializable_dict(self):
         o = {
@@ -109,9 +242,248 @@ class _CacheEntry:
         o['metadata'].pop('dirty')
         return o
 
+    def to_bytes(self, compression: t.Optional[str] = None) -> bytes:
+        payload = json.dumps(self._to_serializable_dict(), default=DateTimeIsoFormatJSONProvider.default).encode()
+        return _wrap(payload, compression)
+
+
+class MemoryCache:
+    """
+    A thread-safe, in-process LRU of cache entries that sits in front of the
+    cache in Artifactory. It is bounded by both the number of entries and their
+    approximate size in bytes (the size of their JSON), and expired entries are
+    never returned, so that a fresher entry can be read from Artifactory instead.
+    """
+    def __init__(self, max_entries: int, max_bytes: int) -> None:
+        self._max_entries = max_entries
+        self._max_bytes = max_bytes
+        self._entries: 't.OrderedDict[str, t.Tuple[_CacheEntry, int]]' = OrderedDict()
+        self._bytes = 0
+        self._lock = Lock()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    @property
+    def size(self) -> int:
+        return self._bytes
+
+    def get(self, key: str) -> t.Optional[_CacheEntry]:
+        with self._lock:
+            item = self._entries.get(key)
+            if item is None:
+                return None
+
+            entry = item[0]
+            if entry.empty or entry.expired:
+                self._remove(key)
+                return None
+
+            self._entries.move_to_end(key)
+            return entry
+
+    def set(self, key: str, entry: _CacheEntry, size: int) -> None:
+        with self._lock:
+            self._remove(key)
+            if size > self._max_bytes:
+                return
+
+            self._entries[key] = (entry, size)
+            self._bytes += size
+            while len(self._entries) > self._max_entries or self._bytes > self._max_bytes:
+                self._remove(next(iter(self._entries)))
+
+    def _remove(self, key: str) -> None:
+        item = self._entries.pop(key, None)
+        if item is not None:
+            self._bytes -= item[1]
+
+
+def _deploy_cache(path, cache: _CacheEntry, compression: t.Optional[str] = None) -> None:
+    with BytesIO(cache.to_bytes(compression)) as buffer:
+        path.deploy(buffer, quote_parameters=True)
+
+
+_STOP = object()
+
+
+class CacheWriter(Thread):
+    """
+    A daemon thread that writes upstream cache entries to Artifactory from a bounded queue,
+    so that responses do not wait for the upload. Each batch writes only the latest entry
+    for each path. When the queue is full, entries are dropped and counted; they will be
+    fetched from the upstream again on the next miss.
+    """
+    def __init__(self, app: Flask, max_queued: int, batch_size: int = 32) -> None:
+        super().__init__(name='galactory-cache-writer', daemon=True)
+        self._app = app
+        self._queue = Queue(maxsize=max_queued)
+        self._batch_size = batch_size
+        self._lock = Lock()
+        self.written = 0
+        self.failed = 0
+        self.dropped = 0
+
+    @property
+    def stats(self) -> t.Dict[str, int]:
+        return {
+            'queued': self._queue.qsize(),
+            'written': self.written,
+            'failed': self.failed,
+            'dropped': self.dropped,
+        }
+
+    def submit(self, path, cache: _CacheEntry, compression: t.Optional[str] = None) -> bool:
+        try:
+            self._queue.put_nowait((path, cache, compression))
+        except Full:
+            with self._lock:
+                self.dropped += 1
+                dropped = self.dropped
+            self._app.logger.warning(f"Cache write queue is full, dropped the entry for {path} ({dropped} dropped so far).")
+            return False
+
+        return True
+
+    def run(self) -> None:
+        stopping = False
+        while not stopping:
+            batch = {}
+            item = self._queue.get()
+            count = 1
+            while True:
+                if item is _STOP:
+                    stopping = True
+                    break
+
+                # a later entry for the same path replaces an earlier one
+                batch[str(item[0])] = item
+                if count >= self._batch_size:
+                    break
+
+                try:
+                    item = self._queue.get_nowait()
+                except Empty:
+                    break
+                count += 1
+
+            try:
+                self._write(batch.values())
+            finally:
+                for _ in range(count):
+                    self._queue.task_done()
+
+    def _write(self, batch: t.Iterable[t.Tuple[t.Any, _CacheEntry, t.Optional[str]]]) -> None:
+        for path, cache, compression in batch:
+            try:
+                _deploy_cache(path, cache, compression)
+            except Exception:
+                self.failed += 1
+                self._app.logger.exception(f"Error writing cache entry: {path}")
+            else:
+                self.written += 1
+
+    def flush(self) -> None:
+        """
+        Waits until every entry queued so far has been written.
+        """
+        self._queue.join()
+
+    def close(self, timeout: t.Optional[float] = 30) -> None:
+        """
+        Writes the entries that are still queued, and stops the thread.
+        """
+        if not self.is_alive():
+            return
+
+        try:
+            self._queue.put(_STOP, timeout=timeout)
+        except Full:
+            self._app.logger.warning(f"Timed out waiting to flush the cache write queue, {self._queue.qsize()} entries were not written.")
+            return
+
+        self.join(timeout=timeout)
+
+
+class UpstreamRevalidator:
+    """
+    Refreshes expired upstream cache entries in background threads, so that
+    an expired entry can be served right away for up to stale_seconds past
+    its expiry. At most one refresh is in flight for each key.
+    """
+    def __init__(self, app: Flask, stale_seconds: float, max_workers: int = 4) -> None:
+        self._app = app
+        self._stale_delta = timedelta(seconds=stale_seconds)
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='galactory-upstream-revalidator')
+        self._in_flight = set()
+        self._lock = Lock()
+
+    def can_serve(self, entry: _CacheEntry) -> bool:
+        if entry.empty or not entry.expired:
+            return False
+
+        return datetime.utcnow() < entry.expires + self._stale_delta
+
+    def submit(self, key: str, func: t.Callable[[], None]) -> bool:
+        with self._lock:
+            if key in self._in_flight:
+                return False
+            self._in_flight.add(key)
+
+        try:
+            self._executor.submit(self._run, key, func)
+        except RuntimeError:
+            # the executor has been shut down
+            self._done(key)
+            return False
+
+        return True
+
+    def _run(self, key: str, func: t.Callable[[], None]) -> None:
+        try:
+            with self._app.app_context():
+                func()
+        except Exception:
+            # the stale entry keeps being served, and the next request will try again
+            self._app.logger.exception("Error revalidating upstream cache entry: %s", key)
+        finally:
+            self._done(key)
+
+    def _done(self, key: str) -> None:
+        with self._lock:
+            self._in_flight.discard(key)
+
+    def shutdown(self, wait: bool = True) -> None:
+        self._executor.shutdown(wait=wait)
+
+
+class UpstreamResult(dict):
+    """
+    The (rewritten) data from an upstream response, along with the digest of the
+    upstream data it came from, which can be used to build an HTTP entity tag.
+    Only the top level is a copy; nested values are shared with the cache.
+    """
+    def __init__(self, data, digest: str) -> None:
+        super().__init__(data)
+        self.digest = digest
+
+
+def _with_query(req, **params):
+    url = urlsplit(req.url)
+    query = [(k, v) for k, v in parse_qsl(url.query, keep_blank_values=True) if k not in params]
+    query.extend((k, str(v)) for k, v in params.items())
+
+    ret = req.copy()
+    ret.url = urlunsplit(url._replace(query=urlencode(query)))
+    # the validators are for the first page only
+    ret.headers.pop('If-None-Match', None)
+    ret.headers.pop('If-Modified-Since', None)
+    return ret
+
 
 class ProxyUpstream:
     _cache_path = '_cache'
+    _page_size = 100
 
     def __init__(self, repository, upstream_url, read_cache, write_cache, cache_expiry_minutes) -> None:
         self._repository = repository
@@ -121,6 +493,23 @@ class ProxyUpstream:
         self._cache_expiry_delta = timedelta(minutes=cache_expiry_minutes)
 
 
+    @property
+    def _memory_cache(self) -> t.Optional[MemoryCache]:
+        if not self._read_cache:
+            return None
+        return current_app.extensions.get(C.EXTENSION_UPSTREAM_MEMORY_CACHE)
+
+    @property
+    def _compression(self) -> t.Optional[str]:
+        return current_app.config.get('CACHE_COMPRESSION')
+
+    @property
+    def _negative_expiry_delta(self) -> t.Optional[timedelta]:
+        minutes = current_app.config.get('NEGATIVE_CACHE_MINUTES')
+        if not minutes:
+            return None
+        return timedelta(minutes=minutes)
+
     def _get_cache(self, request, expiry_delta=None, **kwargs) -> _CacheEntry:
         path = self._repository / self._cache_path / request.path / 'data.json'
 
@@ -130,22 +519,191 @@ class ProxyUpstream:
         if not self._read_cache:
             return _CacheEntry(expiry_delta=expiry_delta, **kwargs)
 
+        memory_cache = self._memory_cache
+        if memory_cache is not None:
+            cache = memory_cache.get(str(path))
+            if cache is not None:
+                return cache
+
         try:
             with path.open() as f:
-                return _CacheEntry.from_file(f, expiry_delta=expiry_delta, **kwargs)
+                raw = f.read()
         except ArtifactoryException:
             return _CacheEntry(expiry_delta=expiry_delta, **kwargs)
 
-    def _set_cache(self, request, cache) -> None:
+        try:
+            payload = _unwrap(raw)
+            cache = _CacheEntry.from_json(payload, expiry_delta=expiry_delta, **kwargs)
+        except (ValueError, OSError) as e:
+            # treated as a miss, so that the entry is replaced
+            current_app.logger.warning(f"Could not read cache entry {path}: {e}")
+            return _CacheEntry(expiry_delta=expiry_delta, **kwargs)
+
+        if cache.negative:
+            negative_expiry_delta = self._negative_expiry_delta
+            if negative_expiry_delta is None:
+                # negative caching has been turned off since the entry was written
+                return _CacheEntry(expiry_delta=expiry_delta, **kwargs)
+            cache.set_negative(negative_expiry_delta)
+
+        if memory_cache is not None:
+            # the size in memory is closer to the size of the JSON than to the size of a compressed entry
+            memory_cache.set(str(path), cache, len(payload))
+
+        return cache
+
+    def _set_cache(self, request_path, cache) -> None:
         if not self._write_cache:
             return
 
-        path = self._repository / self._cache_path / request.path / 'data.json'
-        with StringIO() as buffer:
+        path = self._repository / self._cache_path / request_path / 'data.json'
+        cache.update()
+
+        writer: t.Optional[CacheWriter] = current_app.extensions.get(C.EXTENSION_CACHE_WRITER)
+        if writer is not None and writer.is_alive():
+            writer.submit(path, cache, self._compression)
+        else:
+            _deploy_cache(path, cache, self._compression)
+
+    def _fetch(self, req, cache: t.Optional[_CacheEntry] = None, not_found_ok: bool = False) -> t.Optional[requests.Response]:
+        if cache is not None and not cache.empty:
+            # only the validators of the cached entry apply; the client's were removed when rewriting
+            if cache.upstream_etag is not None:
+                req.headers['If-None-Match'] = cache.upstream_etag
+            if cache.upstream_last_modified is not None:
+                req.headers['If-Modified-Since'] = cache.upstream_last_modified
+
+        with scoped_session() as s:
+            try:
+                # Merge environment settings into session
+                settings = s.merge_environment_settings(req.url, proxies={}, stream=None, verify=None, cert=None)
+                resp = s.send(req, **settings)
+                resp.raise_for_status()
+            except requests.exceptions.HTTPError:
+                infoer = current_app.logger.debug if resp.status_code == C.HTTP_NOT_FOUND else current_app.logger.warning
+                infoer("Upstream results not available, got HTTP %i: %s", resp.status_code, resp.text)
+                if not_found_ok and resp.status_code == C.HTTP_NOT_FOUND:
+                    return resp
+                return None
+
+        return resp
+
+    def _store(self, request_path, cache, size) -> None:
+        if self._write_cache:
+            self._set_cache(request_path, cache)
+
+        memory_cache = self._memory_cache
+        if memory_cache is not None:
+            path = self._repository / self._cache_path / request_path / 'data.json'
+            memory_cache.set(str(path), cache, size)
+
+    def _refresh(self, req, request_path, previous: t.Optional[_CacheEntry] = None) -> t.Optional[_CacheEntry]:
+        negative_expiry_delta = self._negative_expiry_delta
+        # a not found response doesn't replace upstream data we already have, which is served expired instead
+        has_data = previous is not None and not previous.empty and not previous.negative
+        resp = self._fetch(req, previous, not_found_ok=negative_expiry_delta is not None and not has_data)
+        if resp is None:
+            return None
+
+        if resp.status_code == C.HTTP_NOT_FOUND:
+            cache = _CacheEntry(expiry_delta=self._cache_expiry_delta)
+            cache.set_negative(negative_expiry_delta)
+            cache.update(force=True)
+            current_app.logger.info(f"Caching upstream not found: {req.url}")
+            size = len(cache.to_bytes())
+        elif resp.status_code == C.HTTP_NOT_MODIFIED and previous is not None and not previous.empty:
+            # a new entry, because the previous one may be in use by other requests
+            cache = previous.renewed()
+            cache.set_validators(resp.headers)
+            current_app.logger.info(f"Upstream not modified: {req.url}")
+            size = len(json.dumps(cache.data, default=DateTimeIsoFormatJSONProvider.default))
+        else:
+            data = resp.json()
+            size = len(resp.content) + self._merge_pages(req, data)
+            cache = _CacheEntry(expiry_delta=self._cache_expiry_delta)
+            cache.data = data
+            cache.set_validators(resp.headers)
             cache.update()
-            json.dump(cache._to_serializable_dict(), buffer, default=DateTimeIsoFormatJSONProvider.default)
-            buffer.seek(0)
-            path.deploy(buffer, quote_parameters=True)
+
+        self._store(request_path, cache, size)
+        return cache
+
+    def _page_requests(self, req, data) -> t.Tuple[t.Optional[str], list]:
+        """
+        Returns the key of the items in a paginated upstream response (v3 or v2),
+        and the requests for the pages after the first.
+        """
+        if not isinstance(data, dict):
+            return None, []
+
+        meta = data.get('meta')
+        if isinstance(meta, dict) and isinstance(data.get('data'), list):
+            key, count = 'data', meta.get('count')
+        elif isinstance(data.get('results'), list):
+            key, count = 'results', data.get('count')
+        else:
+            return None, []
+
+        # the upstream may return fewer items per page than we asked for
+        size = len(data[key])
+        if not isinstance(count, int) or not size or count <= size:
+            return key, []
+
+        if key == 'data':
+            pages = [_with_query(req, limit=size, offset=offset) for offset in range(size, count, size)]
+        else:
+            pages = [_with_query(req, page_size=size, page=page) for page in range(2, ceil(count / size) + 1)]
+
+        return key, pages
+
+    def _merge_pages(self, req, data) -> int:
+        """
+        Fetches the remaining pages of a paginated upstream response concurrently, and adds
+        their items to data, so that the cache entry has all of them.
+        Returns the size of the pages that were added. If any page can't be fetched, data is
+        left with the first page only.
+        """
+        key, pages = self._page_requests(req, data)
+        if not pages:
+            return 0
+
+        app = current_app._get_current_object()
+        concurrency = max(current_app.config.get('UPSTREAM_PAGE_CONCURRENCY') or 1, 1)
+
+        def _fetch_page(item):
+            index, page = item
+            with app.app_context():
+                try:
+                    resp = self._fetch(page)
+                    if resp is None:
+                        return index, None, 0
+                    items = resp.json()[key]
+                    if not isinstance(items, list):
+                        raise TypeError(f"expected a list of {key}, got {type(items).__name__}")
+                except (requests.exceptions.RequestException, ValueError, KeyError, TypeError) as exc:
+                    current_app.logger.warning(f"Could not fetch upstream page {page.url}: {exc!r}")
+                    return index, None, 0
+                return index, items, len(resp.content)
+
+        pages_fetched = sorted(_concurrent_map(_fetch_page, enumerate(pages), min(concurrency, len(pages))), key=lambda r: r[0])
+        if any(items is None for _, items, _ in pages_fetched):
+            current_app.logger.warning(f"Could not fetch all {len(pages) + 1} upstream pages, using the first page only: {req.url}")
+            return 0
+
+        for _, items, _ in pages_fetched:
+            data[key].extend(items)
+
+        if key == 'data':
+            data.setdefault('links', {})['next'] = None
+        else:
+            data['next'] = None
+
+        current_app.logger.info(f"Merged {len(pages) + 1} upstream pages: {req.url}")
+        return sum(size for _, _, size in pages_fetched)
+
+    def _revalidate(self, req, request_path, previous: _CacheEntry) -> None:
+        if self._refresh(req, request_path, previous) is not None:
+            current_app.logger.info(f"Cache revalidated: {req.url}")
 
     @contextmanager
     def proxy_download(self, request):
@@ -156,7 +714,7 @@ class ProxyUpstream:
             upstream_url = self._upstream
 
         req = self._rewrite_to_upstream(request, upstream_url, no_rewrite=no_rewrite, no_paginate=True)
-        with _session_with_retries() as s:
+        with scoped_session() as s:
             try:
                 # Merge environment settings into session
                 settings = s.merge_environment_settings(req.url, proxies={}, stream=True, verify=None, cert=None)
@@ -170,40 +728,65 @@ class ProxyUpstream:
                 finally:
                     resp.close()
 
+    def download(self, request) -> t.BinaryIO:
+        """
+        Returns a new read handle on an upstream download. Concurrent downloads of the same URL are coalesced,
+        so that only one of them is fetched from the upstream into a temporary file, and each caller
+        opens its own handle on that file, or gets the leader's error.
+        """
+        def _download():
+            tmp = NamedTemporaryFile()
+            try:
+                with self.proxy_download(request) as resp:
+                    for chunk in resp.iter_content(_DOWNLOAD_CHUNK_SIZE):
+                        tmp.write(chunk)
+                tmp.flush()
+            except BaseException:
+                tmp.close()
+                raise
+            return tmp
+
+        tmp, shared = single_flight(('download', request.url), _download)
+        if shared:
+            current_app.logger.info(f"Download coalesced: {request.url}")
+
+        # The file is deleted when the last caller drops tmp, after it has opened its own handle,
+        # which stays readable after the file is deleted.
+        return open(tmp.name, 'rb')
+
     def proxy(self, request):
         cache = self._get_cache(request)
         scheme = current_app.config.get('PREFERRED_URL_SCHEME')
+        revalidator: t.Optional[UpstreamRevalidator] = current_app.extensions.get(C.EXTENSION_UPSTREAM_REVALIDATOR)
 
-        if cache.empty or cache.expired:
+        if revalidator is not None and revalidator.can_serve(cache):
             req = self._rewrite_to_upstream(request, self._upstream)
-            with _session_with_retries() as s:
-                try:
-                    # Merge environment settings into session
-                    settings = s.merge_environment_settings(req.url, proxies={}, stream=None, verify=None, cert=None)
-                    resp = s.send(req, **settings)
-                    resp.raise_for_status()
-                except requests.exceptions.HTTPError:
-                    infoer = current_app.logger.debug if resp.status_code == C.HTTP_NOT_FOUND else current_app.logger.warning
-                    infoer("Upstream results not available, got HTTP %i: %s", resp.status_code, resp.text)
-                    if cache.expired:
-                        current_app.logger.info(f"Cache hit (expired, upstream error): {request.url}")
-                        return cache.data
-                    # else:
-                        # abort(Response(resp.text, resp.status_code))
-
-                else:
-                    if self._read_cache:
-                        current_app.logger.info(f"Cache miss: {request.url}")
-
-                    data = resp.json()
-                    cache.data = data
+            key = str(self._repository / self._cache_path / request.path)
+            revalidator.submit(key, partial(self._revalidate, req, request.path, cache))
+            current_app.logger.info(f"Cache hit (expired, revalidating): {request.url}")
+        elif cache.empty or cache.expired:
+            req = self._rewrite_to_upstream(request, self._upstream)
+            # concurrent misses for the same upstream URL wait for a single upstream request
+            fresh, shared = single_flight(('proxy', req.url), partial(self._refresh, req, request.path, cache))
+            if fresh is None:
+                if cache.expired:
+                    current_app.logger.info(f"Cache hit (expired, upstream error): {request.url}")
+                    return UpstreamResult(cache.data, digest=cache.digest)
+                # else:
+                    # abort(Response(resp.text, resp.status_code))
+            else:
+                if self._read_cache:
+                    current_app.logger.info(f"Cache miss{' (coalesced)' if shared else ''}: {request.url}")
 
-                    if self._write_cache:
-                        self._set_cache(request, cache)
+                cache = fresh
         else:
             current_app.logger.info(f"Cache hit: {request.url}")
 
-        return self._rewrite_upstream_response(cache.data, url_for('root.index', _external=True, _scheme=scheme))
+        url_root = url_for('root.index', _external=True, _scheme=scheme)
+        return UpstreamResult(
+            cache.rendered((self._upstream, url_root), partial(self._rewrite_upstream_response, url_root=url_root)),
+            digest=cache.digest,
+        )
 
     def _rewrite_upstream_response(self, response_data, url_root) -> dict:
         # Remove these keys from the response.
@@ -259,11 +842,15 @@ class ProxyUpstream:
             params = request.args.copy()
             if not no_paginate:
                 if 'v2' in this_url:
-                    params['page_size'] = 100
+                    params['page_size'] = self._page_size
+                    # the response is cached by path only, so it must always be the first page
+                    params.pop('page', None)
                 else:
-                    params['limit'] = 100
+                    params['limit'] = self._page_size
+                    # the response is cached by path only, so it must always be the first page
+                    params.pop('offset', None)
 
-        headers = {k: v for k, v in request.headers.items() if k not in ['Authorization', 'Host']}
+        headers = {k: v for k, v in request.headers.items() if k not in ['Authorization', 'Host', 'If-None-Match', 'If-Modified-Since']}
         headers['Accept'] = 'application/json, */*'
 
         req = requests.Request(method=request.method, url=rewritten, headers=headers, data=request.data, params=params)
@@ -8,20 +8,28 @@ import gzip
 
 import typing as t
 
-from datetime import datetime
+from collections import OrderedDict
+from contextlib import contextmanager
+from http.cookiejar import DefaultCookiePolicy
+from datetime import datetime, timezone
 from tempfile import SpooledTemporaryFile
+from itertools import islice
+from threading import Event, Lock
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
 from urllib3 import Retry
-from requests.adapters import HTTPAdapter
+from requests.adapters import HTTPAdapter, DEFAULT_POOLSIZE
 from requests import Session
+from requests.auth import AuthBase
 from base64io import Base64IO
 
 from flask import current_app, abort, Response, Request
 from flask.json.provider import DefaultJSONProvider
+from werkzeug.http import is_resource_modified, quote_etag, http_date
 from artifactory import ArtifactoryPath, ArtifactoryException
 from dohq_artifactory.auth import XJFrogArtApiAuth, XJFrogArtBearerAuth
 
 from . import constants as C
-from .models import CollectionData
+from .models import CollectionData, _digest
 from .iter_tar import iter_tar
 
 
@@ -34,11 +42,12 @@ class DateTimeIsoFormatJSONProvider(DefaultJSONProvider):
         return super().default(o)
 
 
-def _session_with_retries(retry=None, auth=None) -> Session:
+def _session_with_retries(retry=None, auth=None, pool_maxsize=None) -> Session:
     if retry is None:
         retry = Retry(connect=5, read=3, redirect=2, status=6, other=3, backoff_factor=0.1, raise_on_status=False)
 
-    adapter = HTTPAdapter(max_retries=retry)
+    # Concurrent discovery shares one session, so the pool needs room for at least that many connections.
+    adapter = HTTPAdapter(max_retries=retry, pool_maxsize=max(pool_maxsize or 0, DEFAULT_POOLSIZE))
     session = Session()
     session.auth = auth
     session.mount('http://', adapter)
@@ -47,30 +56,133 @@ def _session_with_retries(retry=None, auth=None) -> Session:
     return session
 
 
+def _auth_key(auth: t.Optional[AuthBase]) -> t.Hashable:
+    if auth is None:
+        return None
+
+    # the auth classes compare by value but are not hashable, so key them by their attributes
+    return (type(auth), tuple(sorted(vars(auth).items())))
+
+
+class SessionRegistry:
+    """
+    Process-wide HTTP sessions, shared between requests so that the connections in their pools
+    (one pool per host) are reused. There is one session per credential, and past max_sessions
+    the least recently used session is dropped.
+    """
+    def __init__(self, pool_maxsize: t.Optional[int] = None, max_sessions: int = 128) -> None:
+        self._pool_maxsize = pool_maxsize
+        self._max_sessions = max_sessions
+        self._sessions: 't.OrderedDict[t.Hashable, Session]' = OrderedDict()
+        self._lock = Lock()
+
+    def __len__(self) -> int:
+        return len(self._sessions)
+
+    def get(self, auth: t.Optional[AuthBase] = None) -> Session:
+        key = _auth_key(auth)
+        with self._lock:
+            session = self._sessions.get(key)
+            if session is not None:
+                self._sessions.move_to_end(key)
+                return session
+
+            session = self._sessions[key] = _session_with_retries(auth=auth, pool_maxsize=self._pool_maxsize)
+            # the session is shared by many clients, so cookies set by a response must not be sent with the others
+            session.cookies.set_policy(DefaultCookiePolicy(allowed_domains=[]))
+            if len(self._sessions) > self._max_sessions:
+                # not closed, because it may still be in use; its connections are closed when it is collected
+                self._sessions.popitem(last=False)
+
+            return session
+
+
+def shared_session(auth: t.Optional[AuthBase] = None, retry=None) -> Session:
+    """
+    Returns the shared session for auth, or a new session when sessions are not shared or a retry is given.
+    """
+    sessions: t.Optional[SessionRegistry] = current_app.extensions.get(C.EXTENSION_SESSIONS)
+    if sessions is None or retry is not None:
+        return _session_with_retries(retry=retry, auth=auth, pool_maxsize=current_app.config.get('DISCOVERY_CONCURRENCY'))
+
+    return sessions.get(auth)
+
+
+@contextmanager
+def scoped_session(auth: t.Optional[AuthBase] = None) -> t.Iterator[Session]:
+    """
+    Yields the shared session for auth, or when sessions are not shared, a new session that is closed afterwards.
+    """
+    sessions: t.Optional[SessionRegistry] = current_app.extensions.get(C.EXTENSION_SESSIONS)
+    if sessions is not None:
+        yield sessions.get(auth)
+        return
+
+    with _session_with_retries(auth=auth, pool_maxsize=current_app.config.get('DISCOVERY_CONCURRENCY')) as session:
+        yield session
+
+
+def configured_auth(config: t.Mapping[str, t.Any]) -> t.Optional[AuthBase]:
+    accesstoken = config.get('ARTIFACTORY_ACCESS_TOKEN')
+    apikey = config.get('ARTIFACTORY_API_KEY')
+    if accesstoken is not None:
+        return XJFrogArtBearerAuth(accesstoken)
+    elif apikey is not None:
+        return XJFrogArtApiAuth(apikey)
+
+    return None
+
+
+def _galaxy_auth_applies(request: Request, auth: t.Optional[AuthBase]) -> bool:
+    return (
+        current_app.config['USE_GALAXY_AUTH']
+        and (not current_app.config['PREFER_CONFIGURED_AUTH'] or auth is None)
+        and bool(request.headers.get('Authorization'))
+    )
+
+
+def uses_configured_auth(request: Request) -> bool:
+    return not _galaxy_auth_applies(request, configured_auth(current_app.config))
+
+
 def authorize(request: Request, artifactory_path: ArtifactoryPath, retry=None, skip_configured_auth: bool = False) -> ArtifactoryPath:
     auth = None
     if not skip_configured_auth:
-        accesstoken = current_app.config['ARTIFACTORY_ACCESS_TOKEN']
-        apikey = current_app.config['ARTIFACTORY_API_KEY']
-        if accesstoken is not None:
-            auth = XJFrogArtBearerAuth(accesstoken)
-        elif apikey is not None:
-            auth = XJFrogArtApiAuth(apikey)
-
-    if current_app.config['USE_GALAXY_AUTH'] and (not current_app.config['PREFER_CONFIGURED_AUTH'] or auth is None):
+        auth = configured_auth(current_app.config)
+
+    if _galaxy_auth_applies(request, auth):
         galaxy_auth_type = current_app.config['GALAXY_AUTH_TYPE']
-        authorization = request.headers.get('Authorization')
-        if authorization:
-            token = authorization.split(' ')[1]
-            if galaxy_auth_type == 'access_token':
-                auth = XJFrogArtBearerAuth(token)
-            elif galaxy_auth_type == 'api_key':
-                auth = XJFrogArtApiAuth(token)
-            else:
-                raise ValueError(f"Unknown galaxy auth type '{galaxy_auth_type}'.")
+        token = request.headers['Authorization'].split(' ')[1]
+        if galaxy_auth_type == 'access_token':
+            auth = XJFrogArtBearerAuth(token)
+        elif galaxy_auth_type == 'api_key':
+            auth = XJFrogArtApiAuth(token)
+        else:
+            raise ValueError(f"Unknown galaxy auth type '{galaxy_auth_type}'.")
+
+    return ArtifactoryPath(artifactory_path, session=shared_session(auth=auth, retry=retry))
+
+
+def combine_etags(*etags: t.Optional[str]) -> str:
+    return _digest(etag or '' for etag in etags)
+
 
-    session = _session_with_retries(retry=retry, auth=auth)
-    return ArtifactoryPath(artifactory_path, session=session)
+def conditional_headers(request: Request, etag: str, last_modified: t.Optional[datetime] = None) -> t.Dict[str, str]:
+    """
+    Aborts with 304 Not Modified if the request's conditional headers match,
+    before any time is spent building the response body.
+    Otherwise returns the headers that should be sent with the response.
+    last_modified should only be given for a single version; the latest modification
+    time of a list does not change when a version is deleted, or when an older one is added.
+    """
+    headers = {'ETag': quote_etag(etag)}
+    if last_modified is not None:
+        headers['Last-Modified'] = http_date(last_modified)
+
+    if not is_resource_modified(request.environ, etag=etag, last_modified=last_modified):
+        abort(Response(status=C.HTTP_NOT_MODIFIED, headers=headers))
+
+    return headers
 
 
 def load_manifest_from_archive(handle, seek_to_zero_after=True):
@@ -83,42 +195,135 @@ def load_manifest_from_archive(handle, seek_to_zero_after=True):
                 return data
 
 
+_AQL_INCLUDE_FIELDS = ['repo', 'path', 'name', 'created', 'modified', 'size', 'sha256', 'property']
+
+
+def _aql_criteria(repo: ArtifactoryPath, namespace: str = None, name: str = None, version: str = None) -> t.Dict[str, t.Any]:
+    criteria = {
+        'repo': repo.repo,
+        # AQL uses '.' for the repository root, and paths have no leading slash.
+        'path': repo.path_in_repo.strip('/') or '.',
+        'type': 'file',
+        'name': {'$match': '*.tar.gz'},
+    }
+
+    for key, value in (('namespace', namespace), ('name', name), ('version', version)):
+        if value:
+            criteria[f"@{key}"] = value
+
+    return criteria
+
+
+def _format_aql_datetime(value: datetime) -> str:
+    if value.tzinfo is not None:
+        value = value.astimezone(timezone.utc)
+    return value.strftime('%Y-%m-%dT%H:%M:%S.') + f"{value.microsecond // 1000:03d}Z"
+
+
+def discover_collections_aql(
+    repo: ArtifactoryPath,
+    namespace: str = None,
+    name: str = None,
+    version: str = None,
+    modified_since: datetime = None,
+):
+    criteria = _aql_criteria(repo, namespace, name, version)
+    if modified_since is not None:
+        # Property changes (like those from the property fallback) change 'updated' but not 'modified'.
+        since = _format_aql_datetime(modified_since)
+        criteria['$or'] = [{'modified': {'$gte': since}}, {'updated': {'$gte': since}}]
+
+    # AQL does not support sort/offset/limit when properties are included,
+    # so this is a single query that returns everything we need for every artifact.
+    results = repo.aql('items.find', criteria, '.include', _AQL_INCLUDE_FIELDS)
+
+    for result in results:
+        if not any(prop['key'] == 'collection_info' and prop.get('value') for prop in result.get('properties', [])):
+            continue
+
+        yield CollectionData.from_aql_result(result)
+
+
+def list_collection_filenames_aql(repo: ArtifactoryPath) -> t.Set[str]:
+    return {result['name'] for result in repo.aql('items.find', _aql_criteria(repo), '.include', ['name'])}
+
+
+def _collection_from_path(path: ArtifactoryPath) -> t.Optional[CollectionData]:
+    info = path.stat()
+    if info.is_dir:
+        return None
+
+    props = path.properties
+    if not props.get('collection_info'):
+        return None
+
+    return CollectionData.from_artifactory_path(path=path, properties=props, stat=info)
+
+
+def _concurrent_map(func: t.Callable, iterable: t.Iterable, concurrency: int) -> t.Iterator:
+    # Results are yielded as they complete, not in the order of the iterable.
+    # No more than concurrency items are in flight at once, so an abandoned
+    # generator doesn't leave a large backlog of requests behind it.
+    items = iter(iterable)
+    with ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix='galactory-discovery') as executor:
+        pending = {executor.submit(func, item) for item in islice(items, concurrency)}
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                for item in islice(items, 1):
+                    pending.add(executor.submit(func, item))
+                yield future.result()
+
+
 def discover_collections(
     repo: ArtifactoryPath,
     namespace: str = None,
     name: str = None,
     version: str = None,
     fast_detection: bool = True,
+    use_aql: bool = False,
+    concurrency: int = 1,
 ):
-    for p in repo:
-        if fast_detection:
-            # we're going to use the naming convention to eliminate candidates early,
-            # to avoid excessive additional requests for properties and stat that slow
-            # down the listing immensely as the number of collections grows.
-            try:
-                f_namespace, f_name, f_version = p.name.replace('.tar.gz', '').split('-', maxsplit=2)
-            except ValueError:
-                pass
-            else:
-                if not all(
-                    (
-                        not namespace or f_namespace == namespace,
-                        not name or f_name == name,
-                        not version or f_version == version
-                    )
-                ):
-                    continue
-
-        info = p.stat()
-        if info.is_dir:
-            continue
+    if use_aql:
+        try:
+            collections = list(discover_collections_aql(repo, namespace=namespace, name=name, version=version))
+        except ArtifactoryException as exc:
+            current_app.logger.warning("AQL query failed, falling back to iterating the repository: %s", exc)
+        else:
+            yield from collections
+            return
+
+    def _candidates():
+        for p in repo:
+            if fast_detection:
+                # we're going to use the naming convention to eliminate candidates early,
+                # to avoid excessive additional requests for properties and stat that slow
+                # down the listing immensely as the number of collections grows.
+                try:
+                    f_namespace, f_name, f_version = p.name.replace('.tar.gz', '').split('-', maxsplit=2)
+                except ValueError:
+                    pass
+                else:
+                    if not all(
+                        (
+                            not namespace or f_namespace == namespace,
+                            not name or f_name == name,
+                            not version or f_version == version
+                        )
+                    ):
+                        continue
+
+            yield p
+
+    if concurrency > 1:
+        collections = _concurrent_map(_collection_from_path, _candidates(), concurrency)
+    else:
+        collections = map(_collection_from_path, _candidates())
 
-        props = p.properties
-        if not props.get('collection_info'):
+    for coldata in collections:
+        if coldata is None:
             continue
 
-        coldata = CollectionData.from_artifactory_path(path=p, properties=props, stat=info)
-
         if all(
             (
                 not namespace or coldata.namespace == namespace,
@@ -129,6 +334,61 @@ def discover_collections(
             yield coldata
 
 
+class _Flight:
+    __slots__ = ('done', 'result', 'error')
+
+    def __init__(self) -> None:
+        self.done = Event()
+        self.result = None
+        self.error = None
+
+
+class SingleFlight:
+    """
+    Coalesces concurrent calls for the same key, so that only the first caller (the leader)
+    runs the function, and the others wait for it and share its result, or its exception.
+    """
+    def __init__(self) -> None:
+        self._flights: t.Dict[t.Hashable, _Flight] = {}
+        self._lock = Lock()
+
+    def do(self, key: t.Hashable, func: t.Callable[[], t.Any]) -> t.Tuple[t.Any, bool]:
+        """
+        Returns the result of func, and whether that result was shared from another caller.
+        """
+        with self._lock:
+            flight = self._flights.get(key)
+            leader = flight is None
+            if leader:
+                flight = self._flights[key] = _Flight()
+
+        if not leader:
+            flight.done.wait()
+            if flight.error is not None:
+                raise flight.error
+            return flight.result, True
+
+        try:
+            flight.result = func()
+        except BaseException as e:
+            flight.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._flights[key]
+            flight.done.set()
+
+        return flight.result, False
+
+
+def single_flight(key: t.Hashable, func: t.Callable[[], t.Any]) -> t.Tuple[t.Any, bool]:
+    flights: t.Optional[SingleFlight] = current_app.extensions.get(C.EXTENSION_SINGLE_FLIGHT)
+    if flights is None:
+        return func(), False
+
+    return flights.do(key, func)
+
+
 def lcm(a, b, *more):
     z = lcm(b, *more) if more else b
     return abs(a * z) // math.gcd(a, z)
@@ -230,4 +490,14 @@ def upload_collection_from_hashed_tempfile(artifact: ArtifactoryPath, tmpfile: H
         if property_fallback:
             artifact.properties = props
 
+    index = current_app.extensions.get(C.EXTENSION_COLLECTION_INDEX)
+    if index is not None:
+        # Make the new collection visible in the index right away instead of waiting for it to expire.
+        try:
+            stat = artifact.stat()
+        except (ArtifactoryException, FileNotFoundError):
+            index.invalidate()
+        else:
+            index.add(CollectionData.from_artifactory_path(path=artifact, properties={k: [v] for k, v in props.items()}, stat=stat))
+
     return props
@@ -3,7 +3,24 @@
 
 import pytest
 
+from galactory import create_app
+
 
 @pytest.fixture(params=['/', ''])
 def trailer(request):
     return lambda v: f"{v.rstrip('/')}{request.param}"
+
+
+@pytest.fixture
+def app(request: pytest.FixtureRequest):
+    # the minimum configuration that the API endpoints need
+    config = dict(
+        ARTIFACTORY_PATH=None,
+        PROXY_UPSTREAM=None,
+        NO_PROXY_NAMESPACES=[],
+        CACHE_MINUTES=0,
+        CACHE_READ=False,
+        CACHE_WRITE=False,
+    )
+    config.update(getattr(request, 'param', None) or {})
+    return create_app(**config)
@@ -0,0 +1,122 @@
+# -*- coding: utf-8 -*-
+# (c) 2023 Brian Scholer (@briantist)
+
+import pytest
+from unittest import mock
+from datetime import datetime, timezone
+
+from galactory import constants as C
+from galactory.models import CollectionCollection
+from galactory.upstream import UpstreamResult
+
+
+@pytest.fixture
+def colcol(collection_data_factory):
+    return CollectionCollection.from_collections(
+        collection_data_factory(
+            namespace='ns',
+            name='n',
+            version=f"1.{i}.0",
+            sha256=str(i),
+            modified_datetime=datetime(2023, 1, 1 + i, tzinfo=timezone.utc),
+        )
+        for i in range(3)
+    )
+
+
+@pytest.fixture(params=['v2', 'v3'])
+def api_version(request):
+    return request.param
+
+
+@pytest.fixture
+def mock_load(app, api_version, colcol):
+    module = f"galactory.api.{api_version}.collections"
+    with mock.patch(f"{module}.authorize"), \
+            mock.patch(f"{module}.load_collections", return_value=colcol) as load, \
+            mock.patch(f"{module}.load_collection_version", return_value=colcol['ns.n']['1.2.0']):
+        yield load
+
+
+@pytest.mark.parametrize('path', [
+    'collections/',
+    'collections/ns/n/',
+    'collections/ns/n/versions/',
+    'collections/ns/n/versions/1.2.0/',
+])
+def test_conditional_etag(client, mock_load, api_version, path):
+    url = f"/api/{api_version}/{path}"
+
+    response = client.get(url)
+    assert response.status_code == C.HTTP_OK
+    etag = response.headers['ETag']
+
+    response = client.get(url, headers={'If-None-Match': etag})
+    assert response.status_code == C.HTTP_NOT_MODIFIED
+    assert response.headers['ETag'] == etag
+    assert not response.data
+
+    response = client.get(url, headers={'If-None-Match': '"something-else"'})
+    assert response.status_code == C.HTTP_OK
+    assert response.headers['ETag'] == etag
+
+
+def test_conditional_last_modified(client, mock_load, api_version):
+    # only a single version has a modification time that changes with it
+    url = f"/api/{api_version}/collections/ns/n/versions/1.2.0/"
+
+    response = client.get(url)
+    assert response.headers['Last-Modified'] == 'Tue, 03 Jan 2023 00:00:00 GMT'
+
+    response = client.get(url, headers={'If-Modified-Since': 'Tue, 03 Jan 2023 00:00:00 GMT'})
+    assert response.status_code == C.HTTP_NOT_MODIFIED
+
+
+@pytest.mark.parametrize('path', [
+    'collections/',
+    'collections/ns/n/',
+    'collections/ns/n/versions/',
+])
+def test_conditional_no_last_modified_for_lists(client, mock_load, api_version, colcol, path):
+    url = f"/api/{api_version}/{path}"
+
+    response = client.get(url)
+    assert response.status_code == C.HTTP_OK
+    assert 'Last-Modified' not in response.headers
+
+    # deleting a version does not move the latest modification time, so it can't be used to validate a list
+    del colcol['ns.n']['1.0.0']
+    response = client.get(url, headers={'If-Modified-Since': 'Tue, 03 Jan 2023 00:00:00 GMT'})
+    assert response.status_code == C.HTTP_OK
+
+
+def test_conditional_etag_changes(client, mock_load, api_version, colcol, collection_data_factory):
+    url = f"/api/{api_version}/collections/ns/n/versions/"
+    etag = client.get(url).headers['ETag']
+
+    colcol.add(collection_data_factory(namespace='ns', name='n', version='2.0.0', sha256='new'))
+
+    response = client.get(url, headers={'If-None-Match': etag})
+    assert response.status_code == C.HTTP_OK
+    assert response.headers['ETag'] != etag
+
+
+@pytest.mark.parametrize('app', [dict(PROXY_UPSTREAM='https://galaxy.example.com/')], indirect=True)
+def test_conditional_etag_upstream(client, mock_load, api_version):
+    url = f"/api/{api_version}/collections/ns/n/versions/"
+    key = 'data' if api_version == 'v3' else 'results'
+
+    with mock.patch(f"galactory.api.{api_version}.collections.ProxyUpstream") as proxy:
+        proxy.return_value.proxy.return_value = UpstreamResult({key: [{'version': '3.0.0'}]}, digest='one')
+        response = client.get(url)
+        etag = response.headers['ETag']
+        # the upstream data has no modification time
+        assert 'Last-Modified' not in response.headers
+
+        response = client.get(url, headers={'If-None-Match': etag})
+        assert response.status_code == C.HTTP_NOT_MODIFIED
+
+        proxy.return_value.proxy.return_value = UpstreamResult({key: [{'version': '3.0.1'}]}, digest='two')
+        response = client.get(url, headers={'If-None-Match': etag})
+        assert response.status_code == C.HTTP_OK
+        assert response.headers['ETag'] != etag
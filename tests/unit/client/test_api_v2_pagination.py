@@ -0,0 +1,154 @@
+# -*- coding: utf-8 -*-
+# (c) 2023 Brian Scholer (@briantist)
+
+import pytest
+from unittest import mock
+from urllib.parse import urlparse, parse_qs
+
+from galactory import constants as C
+from galactory.models import CollectionCollection
+from galactory.upstream import UpstreamResult
+
+
+@pytest.fixture
+def colcol(collection_data_factory):
+    return CollectionCollection.from_collections(
+        collection_data_factory(namespace=f"ns{i % 3}", name=f"n{i}", version=f"1.{i}.0", sha256=str(i))
+        for i in range(7)
+    )
+
+
+@pytest.fixture
+def versions(collection_data_factory):
+    return CollectionCollection.from_collections(
+        collection_data_factory(namespace='ns', name='n', version=f"1.{i}.0", sha256=str(i))
+        for i in range(12)
+    )
+
+
+@pytest.fixture
+def mock_load(app):
+    with mock.patch('galactory.api.v2.collections.authorize'), \
+            mock.patch('galactory.api.v2.collections.load_collections') as load:
+        yield load
+
+
+def _page(link):
+    if link is None:
+        return None
+    return int(parse_qs(urlparse(link).query)['page'][0])
+
+
+def test_v2_collections_unpaginated(client, mock_load, colcol):
+    mock_load.return_value = colcol
+
+    response = client.get('/api/v2/collections/')
+    data = response.json
+
+    assert response.status_code == C.HTTP_OK
+    assert data['count'] == 7
+    assert [f"{c['namespace']['name']}.{c['name']}" for c in data['results']] == colcol.sorted_keys()
+    for k in ('next', 'next_link', 'previous', 'previous_link'):
+        assert data[k] is None
+
+
+@pytest.mark.parametrize(['page_size', 'page', 'expected_next', 'expected_previous'], [
+    (3, 1, 2, None),
+    (3, 2, 3, 1),
+    (3, 3, None, 2),
+    (7, 1, None, None),
+    (100, 1, None, None),
+])
+def test_v2_collections_paginated(client, mock_load, colcol, page_size, page, expected_next, expected_previous):
+    mock_load.return_value = colcol
+
+    response = client.get(f"/api/v2/collections/?page_size={page_size}&page={page}")
+    data = response.json
+
+    start = (page - 1) * page_size
+    assert response.status_code == C.HTTP_OK
+    assert data['count'] == 7
+    assert [f"{c['namespace']['name']}.{c['name']}" for c in data['results']] == colcol.sorted_keys()[start:start + page_size]
+    assert _page(data['next']) == _page(data['next_link']) == expected_next
+    assert _page(data['previous']) == _page(data['previous_link']) == expected_previous
+
+    if data['next'] is not None:
+        assert urlparse(data['next']).scheme
+        assert not urlparse(data['next_link']).scheme
+        assert parse_qs(urlparse(data['next']).query)['page_size'] == [str(page_size)]
+
+
+def test_v2_collections_follow_next(client, mock_load, colcol):
+    mock_load.return_value = colcol
+
+    seen = []
+    link = '/api/v2/collections/?page_size=2'
+    while link is not None:
+        data = client.get(link).json
+        seen.extend(f"{c['namespace']['name']}.{c['name']}" for c in data['results'])
+        link = data['next_link']
+
+    assert seen == colcol.sorted_keys()
+
+
+@pytest.mark.parametrize(['query', 'status'], [
+    ('page_size=0', C.HTTP_BAD_REQUEST),
+    ('page_size=x', C.HTTP_BAD_REQUEST),
+    ('page=0&page_size=2', C.HTTP_BAD_REQUEST),
+    ('page=-1&page_size=2', C.HTTP_BAD_REQUEST),
+    ('page=5&page_size=2', C.HTTP_NOT_FOUND),
+])
+def test_v2_collections_bad_pagination(client, mock_load, colcol, query, status):
+    mock_load.return_value = colcol
+
+    response = client.get(f"/api/v2/collections/?{query}")
+    assert response.status_code == status
+
+
+def test_v2_versions_paginated(client, mock_load, versions):
+    mock_load.return_value = versions
+
+    response = client.get('/api/v2/collections/ns/n/versions/?page_size=5&page=2')
+    data = response.json
+
+    assert response.status_code == C.HTTP_OK
+    assert data['count'] == 12
+    assert [v['version'] for v in data['results']] == [f"1.{i}.0" for i in range(6, 1, -1)]
+    assert _page(data['previous_link']) == 1
+    assert _page(data['next_link']) == 3
+    assert urlparse(data['next_link']).path == '/api/v2/collections/ns/n/versions/'
+
+
+def test_v2_versions_prereleases(client, mock_load, collection_data_factory):
+    mock_load.return_value = CollectionCollection.from_collections(
+        collection_data_factory(namespace='ns', name='n', version=v, sha256=v)
+        for v in ['1.0.0', '2.0.0-beta', '1.5.0', '2.0.0', '2.0.0-alpha', '0.9.0']
+    )
+
+    response = client.get('/api/v2/collections/ns/n/versions/?page_size=3&page=1')
+    data = response.json
+
+    # prereleases are ordered between releases, by precedence
+    assert data['count'] == 6
+    assert [v['version'] for v in data['results']] == ['2.0.0', '2.0.0-beta', '2.0.0-alpha']
+
+
+@pytest.mark.parametrize('app', [dict(PROXY_UPSTREAM='https://galaxy.example.com/')], indirect=True)
+def test_v2_versions_merge_upstream(client, mock_load, versions):
+    mock_load.return_value = versions
+    upstream = {
+        'results': [
+            {'version': '1.11.0', 'href': 'upstream'},
+            {'version': '2.0.0', 'href': 'upstream'},
+        ],
+    }
+
+    with mock.patch('galactory.api.v2.collections.ProxyUpstream') as proxy:
+        proxy.return_value.proxy.return_value = UpstreamResult(upstream, digest='upstream')
+        response = client.get('/api/v2/collections/ns/n/versions/?page_size=3')
+
+    data = response.json
+    assert data['count'] == 13
+    assert [v['version'] for v in data['results']] == ['2.0.0', '1.11.0', '1.10.0']
+    assert data['results'][0]['href'] == 'upstream'
+    assert data['results'][1]['href'] != 'upstream'
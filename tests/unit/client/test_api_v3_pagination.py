@@ -0,0 +1,152 @@
+# -*- coding: utf-8 -*-
+# (c) 2023 Brian Scholer (@briantist)
+
+import pytest
+from unittest import mock
+from urllib.parse import urlparse, parse_qs
+
+from galactory import constants as C
+from galactory.models import CollectionCollection
+from galactory.upstream import UpstreamResult
+
+
+@pytest.fixture
+def colcol(collection_data_factory):
+    return CollectionCollection.from_collections(
+        collection_data_factory(namespace=f"ns{i % 3}", name=f"n{i}", version=f"1.{i}.0", sha256=str(i))
+        for i in range(7)
+    )
+
+
+@pytest.fixture
+def versions(collection_data_factory):
+    return CollectionCollection.from_collections(
+        collection_data_factory(namespace='ns', name='n', version=f"1.{i}.0", sha256=str(i))
+        for i in range(12)
+    )
+
+
+@pytest.fixture
+def mock_load(app):
+    with mock.patch('galactory.api.v3.collections.authorize'), \
+            mock.patch('galactory.api.v3.collections.load_collections') as load:
+        yield load
+
+
+def _offset(link):
+    if link is None:
+        return None
+    return int(parse_qs(urlparse(link).query)['offset'][0])
+
+
+def test_v3_collections_unpaginated(client, mock_load, colcol):
+    mock_load.return_value = colcol
+
+    response = client.get('/api/v3/collections/')
+    data = response.json
+
+    assert response.status_code == C.HTTP_OK
+    assert data['meta']['count'] == 7
+    assert [f"{c['namespace']}.{c['name']}" for c in data['data']] == colcol.sorted_keys()
+    assert data['links']['next'] is None
+    assert data['links']['previous'] is None
+    assert data['links']['first'] == data['links']['last']
+
+
+@pytest.mark.parametrize(['limit', 'offset', 'expected'], [
+    (3, 0, dict(first=0, previous=None, next=3, last=6)),
+    (3, 3, dict(first=0, previous=0, next=6, last=6)),
+    (3, 6, dict(first=0, previous=3, next=None, last=6)),
+    (3, 1, dict(first=0, previous=0, next=4, last=6)),
+    (7, 0, dict(first=0, previous=None, next=None, last=0)),
+    (100, 0, dict(first=0, previous=None, next=None, last=0)),
+    (2, 10, dict(first=0, previous=8, next=None, last=6)),
+])
+def test_v3_collections_paginated(client, mock_load, colcol, limit, offset, expected):
+    mock_load.return_value = colcol
+
+    response = client.get(f"/api/v3/collections/?limit={limit}&offset={offset}")
+    data = response.json
+
+    assert response.status_code == C.HTTP_OK
+    assert data['meta']['count'] == 7
+    assert [f"{c['namespace']}.{c['name']}" for c in data['data']] == colcol.sorted_keys()[offset:offset + limit]
+    assert {k: _offset(v) for k, v in data['links'].items()} == expected
+
+    for link in data['links'].values():
+        if link is not None:
+            assert parse_qs(urlparse(link).query)['limit'] == [str(limit)]
+
+
+def test_v3_collections_follow_next(client, mock_load, colcol):
+    mock_load.return_value = colcol
+
+    seen = []
+    link = '/api/v3/collections/?limit=2'
+    while link is not None:
+        data = client.get(link).json
+        seen.extend(f"{c['namespace']}.{c['name']}" for c in data['data'])
+        link = data['links']['next']
+
+    assert seen == colcol.sorted_keys()
+
+
+@pytest.mark.parametrize('query', ['limit=0', 'limit=-1', 'limit=x', 'offset=-1', 'offset=x'])
+def test_v3_collections_bad_pagination(client, mock_load, colcol, query):
+    mock_load.return_value = colcol
+
+    response = client.get(f"/api/v3/collections/?{query}")
+    assert response.status_code == C.HTTP_BAD_REQUEST
+    mock_load.assert_not_called()
+
+
+def test_v3_versions_paginated(client, mock_load, versions):
+    mock_load.return_value = versions
+
+    response = client.get('/api/v3/collections/ns/n/versions/?limit=5&offset=5')
+    data = response.json
+
+    assert response.status_code == C.HTTP_OK
+    assert data['meta']['count'] == 12
+    assert [v['version'] for v in data['data']] == [f"1.{i}.0" for i in range(6, 1, -1)]
+    assert _offset(data['links']['previous']) == 0
+    assert _offset(data['links']['next']) == 10
+    assert _offset(data['links']['last']) == 10
+    assert urlparse(data['links']['next']).path.endswith('/ns/n/versions/')
+
+
+def test_v3_versions_prereleases(client, mock_load, collection_data_factory):
+    mock_load.return_value = CollectionCollection.from_collections(
+        collection_data_factory(namespace='ns', name='n', version=v, sha256=v)
+        for v in ['1.0.0', '2.0.0-beta', '1.5.0', '2.0.0', '2.0.0-alpha', '0.9.0']
+    )
+
+    response = client.get('/api/v3/collections/ns/n/versions/?limit=3&offset=1')
+    data = response.json
+
+    # prereleases are ordered between releases, by precedence
+    assert data['meta']['count'] == 6
+    assert [v['version'] for v in data['data']] == ['2.0.0-beta', '2.0.0-alpha', '1.5.0']
+
+
+@pytest.mark.parametrize('app', [dict(PROXY_UPSTREAM='https://galaxy.example.com/')], indirect=True)
+def test_v3_versions_merge_upstream(client, mock_load, versions):
+    mock_load.return_value = versions
+    upstream = {
+        'data': [
+            {'version': '1.11.0', 'href': 'upstream'},
+            {'version': '2.0.0', 'href': 'upstream'},
+            {'version': '1.5.1', 'href': 'upstream'},
+        ],
+    }
+
+    with mock.patch('galactory.api.v3.collections.ProxyUpstream') as proxy:
+        proxy.return_value.proxy.return_value = UpstreamResult(upstream, digest='upstream')
+        response = client.get('/api/v3/collections/ns/n/versions/?limit=4')
+
+    data = response.json
+    assert data['meta']['count'] == 14
+    assert [v['version'] for v in data['data']] == ['2.0.0', '1.11.0', '1.10.0', '1.9.0']
+    assert data['data'][0]['href'] == 'upstream'
+    # local versions take precedence
+    assert data['data'][1]['href'] != 'upstream'
@@ -0,0 +1,117 @@
+# -*- coding: utf-8 -*-
+# (c) 2023 Brian Scholer (@briantist)
+
+import pytest
+from io import BytesIO
+from unittest import mock
+from datetime import datetime, timezone
+from threading import Event, Thread
+
+from galactory import constants as C
+
+# the artifact itself is returned by the patched authorize
+_CONFIG = dict(ARTIFACTORY_PATH=mock.MagicMock(), PROXY_UPSTREAM='https://galaxy.example.com/')
+
+
+@pytest.fixture
+def upload():
+    """
+    Serves an artifact that is missing from Artifactory until it has been uploaded, and counts the uploads.
+    """
+    uploaded = []
+
+    def _stat():
+        if not uploaded:
+            raise FileNotFoundError()
+        return mock.Mock(mtime=datetime.now(timezone.utc))
+
+    artifact = mock.MagicMock(**{
+        'name': 'ns-n-1.0.0.tar.gz',
+        'stat.side_effect': _stat,
+        'open.side_effect': lambda: BytesIO(b'from artifactory'),
+    })
+    upload = mock.Mock(side_effect=lambda *args, **kwargs: uploaded.append(1))
+
+    with mock.patch('galactory.download.download.authorize', return_value=artifact), \
+            mock.patch('galactory.download.download.upload_collection_from_hashed_tempfile', upload):
+        yield upload
+
+
+@pytest.fixture
+def upstream():
+    """
+    An upstream whose first response is held until it is released, and which counts its requests.
+    """
+    started = Event()
+    release = Event()
+
+    def _send(req, **kwargs):
+        started.set()
+        release.wait(timeout=5)
+        return mock.Mock(
+            status_code=send.status_code,
+            content=b'from upstream',
+            text='upstream error',
+            **{
+                'iter_content.side_effect': lambda size: iter([b'from upstream']),
+                'raise_for_status.side_effect': None if send.status_code == C.HTTP_OK else RuntimeError('upstream error'),
+            },
+        )
+
+    send = mock.Mock(side_effect=_send)
+    send.status_code = C.HTTP_OK
+    send.started = started
+    send.release = release
+    session = mock.Mock(send=send, **{'merge_environment_settings.return_value': {}})
+
+    with mock.patch('galactory.upstream.scoped_session', **{'return_value.__enter__.return_value': session}):
+        yield send
+
+
+def _concurrent_downloads(app, upstream, counting_event, count):
+    responses = []
+
+    def _download():
+        responses.append(app.test_client().get('/download/ns-n-1.0.0.tar.gz'))
+
+    leader = Thread(target=_download)
+    leader.start()
+    assert upstream.started.wait(timeout=5)
+
+    followers = [Thread(target=_download) for _ in range(count - 1)]
+    for thread in followers:
+        thread.start()
+
+    counting_event.wait_for_waiters(count - 1)
+    upstream.release.set()
+    for thread in [leader] + followers:
+        thread.join(timeout=5)
+
+    return responses
+
+
+@pytest.mark.parametrize('app, content', [
+    (dict(_CONFIG, CACHE_WRITE=True), b'from artifactory'),
+    (dict(_CONFIG, CACHE_WRITE=False), b'from upstream'),
+], indirect=['app'])
+def test_download_coalesces_misses(app, upload, upstream, counting_event, content):
+    responses = _concurrent_downloads(app, upstream, counting_event, 4)
+
+    upstream.assert_called_once()
+    assert upload.call_count == (1 if app.config['CACHE_WRITE'] else 0)
+    assert [r.status_code for r in responses] == [C.HTTP_OK] * 4
+    assert [r.data for r in responses] == [content] * 4
+
+
+@pytest.mark.parametrize('app', [
+    dict(_CONFIG, CACHE_WRITE=True),
+    dict(_CONFIG, CACHE_WRITE=False),
+], indirect=True)
+def test_download_shares_errors(app, upload, upstream, counting_event):
+    upstream.status_code = C.HTTP_INTERNAL_SERVER_ERROR
+    responses = _concurrent_downloads(app, upstream, counting_event, 4)
+
+    # the followers get the leader's error, without asking the upstream again
+    upstream.assert_called_once()
+    upload.assert_not_called()
+    assert [(r.status_code, r.data) for r in responses] == [(C.HTTP_INTERNAL_SERVER_ERROR, b'upstream error')] * 4
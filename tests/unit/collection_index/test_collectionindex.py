@@ -0,0 +1,303 @@
+# -*- coding: utf-8 -*-
+# (c) 2023 Brian Scholer (@briantist)
+
+import time
+import pytest
+from unittest import mock
+from datetime import datetime, timedelta, timezone
+
+from artifactory import ArtifactoryException
+
+from galactory import constants as C
+from galactory.models import CollectionCollection
+from galactory.collection_index import CollectionIndex, CollectionIndexRefresher, get_collection_index
+
+
+@pytest.fixture
+def collections(collection_data_factory):
+    return [
+        collection_data_factory(namespace='ns1', name='n1', version='1.0.0', sha256='A'),
+        collection_data_factory(namespace='ns1', name='n1', version='2.0.0', sha256='B'),
+        collection_data_factory(namespace='ns1', name='n2', version='1.0.0', sha256='C'),
+        collection_data_factory(namespace='ns2', name='n1', version='1.0.0', sha256='D'),
+    ]
+
+
+@pytest.fixture
+def mock_discover(collections, app_request_context):
+    with mock.patch('galactory.collection_index.discover_collections', return_value=collections) as discover:
+        yield discover
+
+
+def test_collectionindex_ttl(mock_discover):
+    index = CollectionIndex(mock.sentinel.repository, ttl_seconds=60)
+    assert index.expired
+
+    colcol = index.collections()
+    assert isinstance(colcol, CollectionCollection)
+    assert len(colcol) == 3
+    assert not index.expired
+    mock_discover.assert_called_once_with(mock.sentinel.repository, use_aql=False, concurrency=1)
+
+    assert index.collections() is colcol
+    mock_discover.assert_called_once()
+
+    index._built = datetime.utcnow() - timedelta(seconds=61)
+    assert index.expired
+    assert index.collections() is not colcol
+    assert mock_discover.call_count == 2
+
+    index.invalidate()
+    assert index.expired
+
+
+def test_collectionindex_background_refresh(mock_discover):
+    index = CollectionIndex(mock.sentinel.repository, ttl_seconds=0)
+    index.background_refresh = True
+
+    # the first access still has to build the index
+    colcol = index.collections()
+    assert index.expired
+    assert index.last_rebuild_seconds is not None
+
+    # but after that, an expired index is served as is
+    assert index.collections() is colcol
+    mock_discover.assert_called_once()
+
+    assert index.rebuild() is not colcol
+    assert index.collections() is not colcol
+
+
+def test_collectionindex_add_during_rebuild(mock_discover, collections, collection_data_factory):
+    index = CollectionIndex(mock.sentinel.repository, ttl_seconds=60)
+    new = collection_data_factory(namespace='ns1', name='n1', version='3.0.0', sha256='E')
+
+    def _discover(*args, **kwargs):
+        # simulates a publish that finishes while the scan is running, but wasn't found by the scan
+        index.add(new)
+        return collections
+
+    mock_discover.side_effect = _discover
+    index.rebuild()
+
+    assert index.get('ns1', 'n1', '3.0.0') is new
+
+
+def test_collectionindex_refresher(app, mock_discover):
+    index = CollectionIndex(mock.sentinel.repository, ttl_seconds=0)
+    refresher = CollectionIndexRefresher(app, index, interval_seconds=0.01, jitter_seconds=0.01)
+    assert index.background_refresh
+
+    refresher.start()
+    try:
+        for _ in range(100):
+            if mock_discover.call_count >= 2:
+                break
+            time.sleep(0.01)
+    finally:
+        refresher.stop()
+        refresher.join(timeout=5)
+
+    assert not refresher.is_alive()
+    assert mock_discover.call_count >= 2
+
+
+def test_collectionindex_refresher_survives_errors(app, mock_discover):
+    index = CollectionIndex(mock.sentinel.repository, ttl_seconds=0)
+    refresher = CollectionIndexRefresher(app, index, interval_seconds=0.01)
+    mock_discover.side_effect = RuntimeError('oh no')
+
+    refresher.start()
+    try:
+        for _ in range(100):
+            if mock_discover.call_count >= 2:
+                break
+            time.sleep(0.01)
+    finally:
+        refresher.stop()
+        refresher.join(timeout=5)
+
+    assert mock_discover.call_count >= 2
+    assert index._collections is None
+
+
+def test_collectionindex_find(mock_discover):
+    index = CollectionIndex(mock.sentinel.repository, ttl_seconds=60)
+
+    assert set(index.find()) == {'ns1.n1', 'ns1.n2', 'ns2.n1'}
+    assert set(index.find(namespace='ns1')) == {'ns1.n1', 'ns1.n2'}
+    assert set(index.find(name='n1')) == {'ns1.n1', 'ns2.n1'}
+    assert set(index.find(namespace='ns1', name='n1')) == {'ns1.n1'}
+    assert len(index.find(namespace='ns1', name='fake')) == 0
+
+    # the whole index is only discovered once
+    mock_discover.assert_called_once()
+
+
+def test_collectionindex_get(mock_discover, collections):
+    index = CollectionIndex(mock.sentinel.repository, ttl_seconds=60)
+
+    assert index.get('ns1', 'n1', '2.0.0') is collections[1]
+    assert index.get('ns1', 'n1', '3.0.0') is None
+    assert index.get('ns1', 'n1', 'not-a-version') is None
+    assert index.get('fake', 'n1', '1.0.0') is None
+
+
+def test_collectionindex_get_does_not_parse_versions(mock_discover, collections):
+    index = CollectionIndex(mock.sentinel.repository, ttl_seconds=60)
+    index.collections()
+
+    with mock.patch('galactory.models.VersionInfo.parse', side_effect=AssertionError('parsed')):
+        assert index.get('ns1', 'n1', '1.0.0') is collections[0]
+        assert index.get('ns1', 'n1', '1.0.1') is None
+        assert index.get('fake', 'fake', '1.0.0') is None
+
+
+def test_collectionindex_add(mock_discover, collection_data_factory):
+    index = CollectionIndex(mock.sentinel.repository, ttl_seconds=60)
+
+    # adding before the index is built does nothing; it will be found when built
+    index.add(collection_data_factory(namespace='ns1', name='n1', version='3.0.0', sha256='E'))
+    mock_discover.assert_not_called()
+
+    before = index.collections()
+    group_before = before['ns1.n1']
+
+    new = collection_data_factory(namespace='ns1', name='n1', version='3.0.0', sha256='E')
+    index.add(new)
+    after = index.collections()
+
+    assert after is not before
+    assert after['ns1.n1'] is not group_before
+    assert after['ns1.n1'].latest is new
+    assert '3.0.0' not in group_before
+    assert after['ns1.n2'] is before['ns1.n2']
+
+    newcol = collection_data_factory(namespace='ns3', name='n1', version='0.1.0', sha256='F')
+    index.add(newcol)
+    assert index.get('ns3', 'n1', '0.1.0') is newcol
+    mock_discover.assert_called_once()
+
+
+@pytest.mark.parametrize('app', [
+    dict(USE_GALAXY_AUTH=False, PREFER_CONFIGURED_AUTH=False, ARTIFACTORY_API_KEY='key'),
+    dict(USE_GALAXY_AUTH=True, PREFER_CONFIGURED_AUTH=True, ARTIFACTORY_API_KEY='key'),
+    dict(USE_GALAXY_AUTH=True, PREFER_CONFIGURED_AUTH=False, ARTIFACTORY_API_KEY='key'),
+    dict(USE_GALAXY_AUTH=True, PREFER_CONFIGURED_AUTH=True),
+], indirect=True)
+@pytest.mark.parametrize('authorization', [None, 'Bearer token'])
+def test_get_collection_index(app, authorization):
+    index = mock.sentinel.index
+    app.extensions[C.EXTENSION_COLLECTION_INDEX] = index
+    headers = {'Authorization': authorization} if authorization else {}
+
+    galaxy_auth = (
+        authorization is not None
+        and app.config['USE_GALAXY_AUTH']
+        and (not app.config['PREFER_CONFIGURED_AUTH'] or app.config.get('ARTIFACTORY_API_KEY') is None)
+    )
+
+    with app.test_request_context(headers=headers) as ctx:
+        if galaxy_auth:
+            assert get_collection_index(ctx.request) is None
+        else:
+            assert get_collection_index(ctx.request) is index
+
+
+def test_collectionindex_incremental_update(mock_discover, collections, collection_data_factory):
+    index = CollectionIndex(mock.sentinel.repository, ttl_seconds=0, use_aql=True, full_refresh_seconds=3600)
+    for i, c in enumerate(collections):
+        c.filename = f"file{i}.tar.gz"
+        c.modified_datetime = datetime(2023, 1, 1 + i, tzinfo=timezone.utc)
+
+    before = index.refresh()
+    mock_discover.assert_called_once()
+    assert index.high_water_mark == datetime(2023, 1, 4, tzinfo=timezone.utc)
+
+    new = collection_data_factory(namespace='ns1', name='n1', version='3.0.0', sha256='E', filename='new.tar.gz')
+    new.modified_datetime = datetime(2023, 2, 1, tzinfo=timezone.utc)
+    # file1 was re-deployed with a different version
+    redeployed = collection_data_factory(namespace='ns1', name='n1', version='2.0.1', sha256='F', filename='file1.tar.gz')
+    redeployed.modified_datetime = datetime(2023, 1, 15, tzinfo=timezone.utc)
+    # file2 (the only version of ns1.n2) was deleted
+    present = {'file0.tar.gz', 'file1.tar.gz', 'file3.tar.gz', 'new.tar.gz'}
+
+    with mock.patch('galactory.collection_index.discover_collections_aql', return_value=[new, redeployed]) as aql, \
+            mock.patch('galactory.collection_index.list_collection_filenames_aql', return_value=present):
+        after = index.refresh()
+
+    aql.assert_called_once_with(mock.sentinel.repository, modified_since=datetime(2023, 1, 4, tzinfo=timezone.utc))
+    mock_discover.assert_called_once()
+    assert index.high_water_mark == new.modified_datetime
+
+    assert after is not before
+    assert set(after) == {'ns1.n1', 'ns2.n1'}
+    assert set(str(v) for v in after['ns1.n1']) == {'1.0.0', '2.0.1', '3.0.0'}
+    assert after['ns1.n1'].latest is new
+    assert after['ns2.n1'] is before['ns2.n1']
+    # with a TTL of 0 every access would refresh again
+    index.background_refresh = True
+    assert index.get('ns1', 'n1', '2.0.0') is None
+    assert index.get('ns1', 'n1', '2.0.1') is redeployed
+    assert index.get('ns1', 'n2', '1.0.0') is None
+    # the previous index was not changed
+    assert set(before) == {'ns1.n1', 'ns1.n2', 'ns2.n1'}
+    assert set(str(v) for v in before['ns1.n1']) == {'1.0.0', '2.0.0'}
+
+
+def test_collectionindex_add_during_incremental_update(mock_discover, collections, collection_data_factory):
+    index = CollectionIndex(mock.sentinel.repository, ttl_seconds=60, use_aql=True, full_refresh_seconds=3600)
+    for i, c in enumerate(collections):
+        c.filename = f"file{i}.tar.gz"
+        c.modified_datetime = datetime(2023, 1, 1 + i, tzinfo=timezone.utc)
+    index.refresh()
+
+    new = collection_data_factory(namespace='ns1', name='n1', version='3.0.0', sha256='E', filename='new.tar.gz')
+    new.modified_datetime = datetime(2023, 2, 1, tzinfo=timezone.utc)
+
+    def _discover(*args, **kwargs):
+        # simulates a publish that finishes while the query is running, but wasn't found by the query
+        index.add(new)
+        return []
+
+    present = {f"file{i}.tar.gz" for i in range(len(collections))}
+    with mock.patch('galactory.collection_index.discover_collections_aql', side_effect=_discover), \
+            mock.patch('galactory.collection_index.list_collection_filenames_aql', return_value=present):
+        index.refresh()
+
+    assert index.get('ns1', 'n1', '3.0.0') is new
+
+
+def test_collectionindex_incremental_update_full_refresh(mock_discover):
+    index = CollectionIndex(mock.sentinel.repository, ttl_seconds=0, use_aql=True, full_refresh_seconds=3600)
+    index.refresh()
+
+    index._last_full = datetime.utcnow() - timedelta(seconds=3601)
+    with mock.patch('galactory.collection_index.discover_collections_aql') as aql:
+        index.refresh()
+
+    aql.assert_not_called()
+    assert mock_discover.call_count == 2
+
+
+def test_collectionindex_incremental_update_error(mock_discover):
+    index = CollectionIndex(mock.sentinel.repository, ttl_seconds=0, use_aql=True, full_refresh_seconds=3600)
+    index.refresh()
+
+    with mock.patch('galactory.collection_index.discover_collections_aql', side_effect=ArtifactoryException('nope')) as aql:
+        index.refresh()
+
+    aql.assert_called_once()
+    assert mock_discover.call_count == 2
+
+
+@pytest.mark.parametrize('full_refresh_seconds', [0, 3600])
+def test_collectionindex_no_incremental_update_without_aql(mock_discover, full_refresh_seconds):
+    index = CollectionIndex(mock.sentinel.repository, ttl_seconds=0, use_aql=False, full_refresh_seconds=full_refresh_seconds)
+    index.refresh()
+
+    with mock.patch('galactory.collection_index.discover_collections_aql') as aql:
+        index.refresh()
+
+    aql.assert_not_called()
+    assert mock_discover.call_count == 2
@@ -0,0 +1,146 @@
+# -*- coding: utf-8 -*-
+# (c) 2023 Brian Scholer (@briantist)
+
+import pytest
+from io import BytesIO
+from unittest import mock
+from datetime import datetime, timezone
+
+from artifactory import ArtifactoryException
+
+from galactory.collection_index import CollectionIndex
+
+
+class FakeRepositoryPath:
+    """
+    Just enough of an ArtifactoryPath to read and write files in memory.
+    """
+    def __init__(self, store: dict, path: str = '') -> None:
+        self.store = store
+        self.path = path
+
+    def __truediv__(self, other):
+        return FakeRepositoryPath(self.store, f"{self.path}/{other}")
+
+    def open(self):
+        try:
+            return BytesIO(self.store[self.path])
+        except KeyError:
+            raise ArtifactoryException(f"404: {self.path}")
+
+    def deploy(self, fobj, **kwargs):
+        self.store[self.path] = fobj.read()
+
+
+@pytest.fixture
+def store():
+    return {}
+
+
+@pytest.fixture
+def repository(store):
+    return FakeRepositoryPath(store)
+
+
+@pytest.fixture
+def collections(collection_data_factory):
+    ret = [
+        collection_data_factory(namespace='ns1', name='n1', version='1.0.0', sha256='A', collection_info={'a': 1}),
+        collection_data_factory(namespace='ns1', name='n1', version='2.0.0-dev0', sha256='B'),
+        collection_data_factory(namespace='ns2', name='n1', version='1.0.0', sha256='C'),
+    ]
+    for i, c in enumerate(ret):
+        c.modified_datetime = datetime(2023, 1, 1 + i, tzinfo=timezone.utc)
+    return ret
+
+
+@pytest.fixture
+def mock_discover(collections, app_request_context):
+    with mock.patch('galactory.collection_index.discover_collections', return_value=collections) as discover:
+        yield discover
+
+
+def test_collectionindex_snapshot_roundtrip(repository, store, mock_discover, collections):
+    writer = CollectionIndex(repository, ttl_seconds=60, snapshot_write=True)
+    writer.collections()
+
+    assert set(store) == {'/_index/collections.json.gz', '/_index/generation.json'}
+    assert writer.generation == 1
+    mock_discover.assert_called_once()
+
+    reader = CollectionIndex(repository, ttl_seconds=60, snapshot_read=True)
+    colcol = reader.collections()
+
+    # loaded from the snapshot, not discovered
+    mock_discover.assert_called_once()
+    assert reader.generation == 1
+    assert reader.high_water_mark == writer.high_water_mark == collections[-1].modified_datetime
+
+    for c in collections:
+        loaded = colcol[c.fqcn][c.version]
+        assert loaded == c
+        assert loaded is not c
+        for field in ('namespace', 'name', 'version', 'filename', 'size', 'mime_type', 'created_datetime', 'modified_datetime', 'collection_info'):
+            assert getattr(loaded, field) == getattr(c, field)
+
+
+def test_collectionindex_snapshot_generations(repository, mock_discover):
+    writer1 = CollectionIndex(repository, ttl_seconds=60, snapshot_write=True)
+    writer2 = CollectionIndex(repository, ttl_seconds=60, snapshot_write=True)
+
+    writer1.rebuild()
+    writer2.rebuild()
+    writer1.rebuild()
+
+    assert writer1.generation == 3
+    assert writer2.generation == 2
+
+
+def test_collectionindex_snapshot_newer_replaces_rebuild(repository, mock_discover):
+    writer = CollectionIndex(repository, ttl_seconds=60, snapshot_write=True)
+    reader = CollectionIndex(repository, ttl_seconds=0, snapshot_read=True)
+
+    # nothing saved yet, so the reader has to build
+    reader.refresh()
+    assert mock_discover.call_count == 1
+    assert reader.generation == 0
+
+    writer.rebuild()
+    assert mock_discover.call_count == 2
+
+    # the writer's snapshot is newer than the reader's last full rebuild
+    reader.refresh()
+    assert mock_discover.call_count == 2
+    assert reader.generation == 1
+
+    # it's the same generation now, so the reader must rebuild on its own
+    reader.refresh()
+    assert mock_discover.call_count == 3
+
+
+@pytest.mark.parametrize('contents', [b'not gzip', None])
+def test_collectionindex_snapshot_bad(repository, store, mock_discover, contents):
+    if contents is not None:
+        store['/_index/collections.json.gz'] = contents
+
+    reader = CollectionIndex(repository, ttl_seconds=60, snapshot_read=True)
+    colcol = reader.collections()
+
+    mock_discover.assert_called_once()
+    assert len(colcol) == 2
+
+
+def test_collectionindex_snapshot_then_incremental(repository, mock_discover, collection_data_factory):
+    writer = CollectionIndex(repository, ttl_seconds=60, snapshot_write=True)
+    writer.rebuild()
+
+    new = collection_data_factory(namespace='ns3', name='n1', version='1.0.0', sha256='D')
+    reader = CollectionIndex(repository, ttl_seconds=0, use_aql=True, full_refresh_seconds=3600, snapshot_read=True)
+    with mock.patch('galactory.collection_index.discover_collections_aql', return_value=[new]) as aql, \
+            mock.patch('galactory.collection_index.list_collection_filenames_aql', return_value={'fake-file'}):
+        colcol = reader.collections()
+
+    # loaded from the snapshot, then caught up with an incremental update
+    mock_discover.assert_called_once()
+    aql.assert_called_once_with(repository, modified_since=writer.high_water_mark)
+    assert 'ns3.n1' in colcol
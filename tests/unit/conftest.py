@@ -4,13 +4,19 @@
 import pytest
 import json
 import sys
+import time
+import typing as t
 
 from pathlib import Path
 from unittest import mock
+from datetime import datetime, timezone
+from functools import partial
+from threading import Event
 from shutil import copytree
 from artifactory import _ArtifactoryAccessor, _FakePathTemplate, ArtifactoryPath
 
 from galactory import create_app
+from galactory.models import CollectionData
 
 from galactory.utilities import discover_collections as original_discover_collections
 
@@ -32,6 +38,32 @@ def client(app):
     return app.test_client()
 
 
+class CountingEvent(Event):
+    """
+    Counts the threads waiting on the event, so that tests can wait for the followers of a flight.
+    """
+    waiting = 0
+
+    def wait(self, timeout=None):
+        type(self).waiting += 1
+        return super().wait(timeout=timeout)
+
+    @classmethod
+    def wait_for_waiters(cls, count):
+        for _ in range(500):
+            if cls.waiting >= count:
+                return
+            time.sleep(0.01)
+        raise AssertionError(f"Only {cls.waiting} of {count} threads are waiting.")
+
+
+@pytest.fixture
+def counting_event():
+    CountingEvent.waiting = 0
+    with mock.patch('galactory.utilities.Event', CountingEvent):
+        yield CountingEvent
+
+
 @pytest.fixture
 def virtual_fs_repo(fixture_finder, tmp_path: Path):
     repo = tmp_path / 'repo'
@@ -166,3 +198,26 @@ def discover_collections(manifest_loader):
     _discover = mock.Mock(wraps=original_discover_collections)
     with mock.patch('galactory.utilities.discover_collections', _discover):
         yield _discover
+
+
+@pytest.fixture
+def collection_data_factory() -> t.Callable[[], CollectionData]:
+    values = dict(
+        collection_info={},
+        namespace='ns',
+        name='name',
+        created_datetime=datetime.now(timezone.utc),
+        modified_datetime=datetime.now(timezone.utc),
+        filename='fake-file',
+        mime_type='fake-file',
+        sha256='m-m-m-my-sha-',
+        size=0,
+        version='0.0.0',
+    )
+    return partial(CollectionData, **values)
+
+
+@pytest.fixture
+def collection_data(request, collection_data_factory) -> CollectionData:
+    overrides = getattr(request, 'param', {})
+    return collection_data_factory(**overrides)
@@ -1,7 +1,9 @@
 # -*- coding: utf-8 -*-
 # (c) 2023 Brian Scholer (@briantist)
 
+import sys
 from itertools import product
+from threading import Event, Thread
 
 from galactory.models import CollectionCollection
 
@@ -42,3 +44,116 @@ def test_collectioncollection_from_collections(collection_data_factory):
     for cg in cc.values():
         assert len(cg.versions) == len(versions)
         assert cg.latest.version == '9.8.7'
+
+
+def test_collectioncollection_sorted_keys(collection_data_factory):
+    cc = CollectionCollection()
+    for ns, n in [('ns2', 'n1'), ('ns1', 'n2'), ('ns1', 'n1')]:
+        cc.add(collection_data_factory(namespace=ns, name=n, sha256=f"{ns}{n}"))
+
+    keys = cc.sorted_keys()
+    assert keys == ['ns1.n1', 'ns1.n2', 'ns2.n1']
+    assert cc.sorted_keys() is keys
+
+    # a new version of an existing collection doesn't change the keys
+    cc.add(collection_data_factory(namespace='ns1', name='n1', version='9.9.9', sha256='new'))
+    assert cc.sorted_keys() is keys
+
+    cc.add(collection_data_factory(namespace='ns0', name='n1', sha256='ns0'))
+    assert cc.sorted_keys() == ['ns0.n1', 'ns1.n1', 'ns1.n2', 'ns2.n1']
+
+    del cc['ns1.n2']
+    assert cc.sorted_keys() == ['ns0.n1', 'ns1.n1', 'ns2.n1']
+
+    copied = cc.copy()
+    copied.add(collection_data_factory(namespace='ns3', name='n1', sha256='ns3'))
+    assert copied.sorted_keys() == ['ns0.n1', 'ns1.n1', 'ns2.n1', 'ns3.n1']
+    assert cc.sorted_keys() == ['ns0.n1', 'ns1.n1', 'ns2.n1']
+
+
+def test_collectioncollection_copy_while_reading(collection_data_factory):
+    cc = CollectionCollection.from_collections(
+        collection_data_factory(namespace='ns', name=f"c{i}", sha256=str(i)) for i in range(10)
+    )
+    done = Event()
+    missing = []
+
+    def _read():
+        while not done.is_set():
+            if cc.get('ns.c5') is None:
+                missing.append(1)
+
+    interval = sys.getswitchinterval()
+    sys.setswitchinterval(1e-6)
+    reader = Thread(target=_read)
+    reader.start()
+    try:
+        for _ in range(2000):
+            copied = cc.copy()
+    finally:
+        done.set()
+        reader.join(timeout=5)
+        sys.setswitchinterval(interval)
+
+    # copying never modifies the original, so concurrent readers always see every group
+    assert missing == []
+    assert copied.data == cc.data
+    assert copied.data is not cc.data
+
+
+def test_collectioncollection_etag(collection_data_factory):
+    cc = CollectionCollection()
+    cc.add(collection_data_factory(namespace='ns1', name='n1', sha256='A'))
+    cc.add(collection_data_factory(namespace='ns2', name='n1', sha256='B'))
+
+    etag = cc.etag
+    assert cc.etag == etag
+
+    copied = cc.copy()
+    assert copied.etag == etag
+
+    # a new version in an existing group changes the etag
+    cc.add(collection_data_factory(namespace='ns1', name='n1', version='1.0.0', sha256='C'))
+    assert cc.etag != etag
+    assert copied.etag == etag
+
+    new = cc.etag
+    del cc['ns2.n1']
+    assert cc.etag != new
+
+
+def test_collectioncollection_from_collections_matches_add(collection_data_factory):
+    namespaces = ['ns2', 'ns1']
+    names = ['n2', 'n1']
+    versions = ['1.2.3', '1.2.3-dev0', '9.8.7', '0.0.0', '1.2.3']
+
+    collections = [
+        collection_data_factory(namespace=d[0], name=d[1], version=d[2], sha256=str(i))
+        for i, d in enumerate(product(namespaces, names, versions))
+    ]
+
+    bulk = CollectionCollection.from_collections(collections)
+    added = CollectionCollection()
+    for c in collections:
+        added.add(c)
+
+    assert list(bulk) == list(added)
+    for fqcn, group in bulk.items():
+        other = added[fqcn]
+        assert (group.namespace, group.name) == (other.namespace, other.name)
+        assert list(group) == list(other)
+        assert list(group.values()) == list(other.values())
+        assert group.latest is other.latest
+        # the last duplicate wins
+        assert group['1.2.3'] is other['1.2.3']
+        assert group['1.2.3'].sha256 == str(max(int(c.sha256) for c in collections if c.fqcn == fqcn and c.version == '1.2.3'))
+
+    # groups built in bulk can still be modified
+    group = bulk['ns1.n1']
+    group.add(collection_data_factory(namespace='ns1', name='n1', version='10.0.0', sha256='new'))
+    del group['0.0.0']
+    assert [str(k) for k in group] == ['1.2.3-dev0', '1.2.3', '9.8.7', '10.0.0']
+
+
+def test_collectioncollection_from_collections_empty():
+    assert len(CollectionCollection.from_collections([])) == 0
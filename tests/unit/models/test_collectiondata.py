@@ -2,6 +2,7 @@
 # (c) 2023 Brian Scholer (@briantist)
 
 import sys
+import json
 import pytest
 
 import semver
@@ -197,3 +198,24 @@ def test_from_artifactory_repository(mocker: MockFixture, repository: Artifactor
             spy.reset_mock()
 
     assert col is not None, "Error, no collections found."
+
+
+def test_collectiondata_lazy_collection_info(mocker: MockFixture, collection_data_factory):
+    raw = '{"namespace": "ns", "name": "name", "version": "0.0.0"}'
+    loads = mocker.spy(json, 'loads')
+
+    data = collection_data_factory(collection_info=raw)
+    assert not hasattr(data, '__dict__')
+    assert data.fqcn == 'ns.name'
+    assert data.collection_info_json == raw
+    loads.assert_not_called()
+
+    info = data.collection_info
+    assert info == json.loads(raw)
+    assert data.collection_info is info
+    assert loads.call_count == 2
+
+    assert json.loads(data.collection_info_json) == info
+
+    data.collection_info = {'other': 1}
+    assert data.collection_info == {'other': 1}
@@ -6,6 +6,7 @@ import pytest
 import re
 from semver import VersionInfo
 from pytest_mock import MockFixture
+from datetime import datetime, timezone
 
 from galactory.models import CollectionData, CollectionGroup
 
@@ -155,3 +156,115 @@ def test_collectiongroup_get_key_bad_version_types(version, raises):
     else:
         k = CollectionGroup._get_key(version, raises=raises)
         assert k is version
+
+
+def test_collectiongroup_etag(collection_data_factory):
+    c1 = collection_data_factory(version='1.0.0', sha256='A', modified_datetime=datetime(2023, 1, 1, tzinfo=timezone.utc))
+    c2 = collection_data_factory(version='2.0.0', sha256='B', modified_datetime=datetime(2023, 1, 2, tzinfo=timezone.utc))
+
+    g1 = CollectionGroup(namespace=c1.namespace, name=c1.name)
+    g1.add(c1)
+    g1.add(c2)
+    g2 = CollectionGroup(namespace=c1.namespace, name=c1.name)
+    g2.add(c2)
+    g2.add(c1)
+
+    etag = g1.etag
+    assert etag == g2.etag
+
+    copied = g1.copy()
+    assert copied.etag == etag
+
+    c3 = collection_data_factory(version='3.0.0', sha256='C', modified_datetime=datetime(2023, 1, 3, tzinfo=timezone.utc))
+    g1.add(c3)
+    assert g1.etag != etag
+    assert copied.etag == etag
+
+    del g1['3.0.0']
+    assert g1.etag == etag
+
+
+def test_collectiongroup_sorted(collection_data_factory):
+    versions = ['2.0.0', '1.0.0-dev0', '1.0.0', '3.0.0-beta1', '1.10.0', '1.2.0', '0.1.0']
+    expected = ['1.0.0-dev0', '3.0.0-beta1', '0.1.0', '1.0.0', '1.2.0', '1.10.0', '2.0.0']
+
+    colgroup = CollectionGroup(namespace='ns', name='name')
+    for i, v in enumerate(versions):
+        colgroup.add(collection_data_factory(version=v, sha256=str(i)))
+
+    assert [str(k) for k in colgroup] == expected
+    assert [c.version for c in colgroup.values()] == expected
+    assert [str(k) for k in reversed(colgroup)] == list(reversed(expected))
+    assert [str(k) for k in colgroup.versions] == expected
+    assert colgroup.latest.version == '2.0.0'
+    assert colgroup.latest_stable.version == '2.0.0'
+    assert colgroup.latest == max(colgroup.values())
+
+    # replacing a version doesn't duplicate it
+    replacement = collection_data_factory(version='1.2.0', sha256='new')
+    colgroup.add(replacement)
+    assert [str(k) for k in colgroup] == expected
+    assert colgroup['1.2.0'] is replacement
+
+    copied = colgroup.copy()
+    del colgroup['2.0.0']
+    del colgroup['1.0.0-dev0']
+    assert [str(k) for k in colgroup] == [v for v in expected if v not in ('2.0.0', '1.0.0-dev0')]
+    assert colgroup.latest.version == '1.10.0'
+    assert [str(k) for k in copied] == expected
+    assert copied.latest.version == '2.0.0'
+
+    bulk = CollectionGroup.from_collections(collection_data_factory(version=v, sha256=str(i)) for i, v in enumerate(versions))
+    assert [str(k) for k in bulk.versions] == expected
+
+
+def test_collectiongroup_by_precedence(collection_data_factory):
+    versions = ['2.0.0', '1.0.0-dev0', '1.0.0', '3.0.0-beta1', '1.10.0', '1.2.0', '0.1.0', '2.0.0-rc.2', '2.0.0-rc.10']
+    expected = ['0.1.0', '1.0.0-dev0', '1.0.0', '1.2.0', '1.10.0', '2.0.0-rc.2', '2.0.0-rc.10', '2.0.0', '3.0.0-beta1']
+
+    colgroup = CollectionGroup(namespace='ns', name='name')
+    for i, v in enumerate(versions):
+        colgroup.add(collection_data_factory(version=v, sha256=str(i)))
+
+    # prereleases are between releases, unlike the group's own order
+    assert [c.version for c in colgroup.by_precedence()] == expected
+    assert [c.version for c in colgroup.by_precedence(reverse=True)] == list(reversed(expected))
+    assert list(CollectionGroup(namespace='ns', name='name').by_precedence(reverse=True)) == []
+
+
+def test_collectiongroup_latest_stable(collection_data_factory):
+    colgroup = CollectionGroup(namespace='ns', name='name')
+    assert colgroup.latest is None
+    assert colgroup.latest_stable is None
+
+    colgroup.add(collection_data_factory(version='2.0.0-dev0', sha256='A'))
+    assert colgroup.latest.version == '2.0.0-dev0'
+    assert colgroup.latest_stable is None
+
+    colgroup.add(collection_data_factory(version='1.0.0', sha256='B'))
+    assert colgroup.latest.version == '1.0.0'
+    assert colgroup.latest_stable.version == '1.0.0'
+
+
+@pytest.mark.parametrize(['minimum', 'maximum', 'expected'], [
+    (None, None, ['1.0.0-dev0', '3.0.0-beta', '0.1.0', '1.0.0', '1.2.0', '2.0.0']),
+    ('1.0.0', '2.0.0', ['1.0.0', '1.2.0']),
+    ('1.0.1', None, ['3.0.0-beta', '1.2.0', '2.0.0']),
+    (None, '1.0.0', ['1.0.0-dev0', '0.1.0']),
+    (VersionInfo.parse('1.2.0'), '1.2.1', ['1.2.0']),
+    ('3.0.0', None, []),
+    ('0.0.0-a', '0.0.0', []),
+    # prerelease bounds, and prereleases between release bounds, use semantic version precedence
+    ('1.0.0-dev0', '1.0.0', ['1.0.0-dev0']),
+    ('1.0.0-dev1', None, ['3.0.0-beta', '1.0.0', '1.2.0', '2.0.0']),
+    (None, '1.0.0-dev0', ['0.1.0']),
+    ('2.0.0', '3.0.0-alpha', ['2.0.0']),
+    ('2.0.0', '3.0.0', ['3.0.0-beta', '2.0.0']),
+    ('3.0.0-alpha', '3.0.0-beta.1', ['3.0.0-beta']),
+])
+def test_collectiongroup_version_range(collection_data_factory, minimum, maximum, expected):
+    colgroup = CollectionGroup(namespace='ns', name='name')
+    for i, v in enumerate(['2.0.0', '1.0.0-dev0', '1.0.0', '3.0.0-beta', '1.2.0', '0.1.0']):
+        colgroup.add(collection_data_factory(version=v, sha256=str(i)))
+
+    assert [c.version for c in colgroup.version_range(minimum, maximum)] == expected
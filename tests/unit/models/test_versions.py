@@ -0,0 +1,59 @@
+# -*- coding: utf-8 -*-
+# (c) 2023 Brian Scholer (@briantist)
+
+import pytest
+
+from itertools import product
+from semver import VersionInfo
+
+from galactory.models import parse_version, version_key
+
+
+_VERSIONS = [
+    '0.0.0',
+    '0.1.0',
+    '1.0.0-alpha',
+    '1.0.0-alpha.1',
+    '1.0.0-alpha.beta',
+    '1.0.0-beta',
+    '1.0.0-beta.2',
+    '1.0.0-beta.11',
+    '1.0.0-rc.1',
+    '1.0.0-2',
+    '1.0.0-10',
+    '1.0.0-dev0',
+    '1.0.0',
+    '1.0.0+build5',
+    '1.0.1',
+    '1.2.0',
+    '1.10.0',
+    '2.0.0-0',
+    '2.0.0',
+]
+
+
+@pytest.mark.parametrize(['a', 'b'], list(product(_VERSIONS, _VERSIONS)))
+def test_version_key_matches_semver(a, b):
+    va = VersionInfo.parse(a)
+    vb = VersionInfo.parse(b)
+
+    assert (version_key(va) < version_key(vb)) == (va < vb)
+    assert (version_key(va) == version_key(vb)) == (va == vb)
+
+
+def test_version_key_sorted():
+    parsed = [VersionInfo.parse(v) for v in reversed(_VERSIONS)]
+    assert sorted(parsed, key=version_key) == sorted(parsed)
+
+
+def test_parse_version_interned():
+    v = parse_version('9.8.7-interned')
+    assert isinstance(v, VersionInfo)
+    assert v == VersionInfo.parse('9.8.7-interned')
+    assert parse_version('9.8.7-interned') is v
+
+
+@pytest.mark.parametrize('version', ['1.2.3dev0', 'nope'])
+def test_parse_version_invalid(version):
+    with pytest.raises(ValueError, match=rf"^{version} is not valid SemVer string$"):
+        parse_version(version)
@@ -0,0 +1,93 @@
+# -*- coding: utf-8 -*-
+# (c) 2023 Brian Scholer (@briantist)
+
+import json
+import pytest
+import requests
+from io import BytesIO
+from unittest import mock
+from datetime import timedelta
+
+from artifactory import ArtifactoryException
+
+from galactory import constants as C
+from galactory.upstream import _CacheEntry
+
+
+class CountingRepositoryPath:
+    def __init__(self, store: dict, opened: list, path: str = '') -> None:
+        self.store = store
+        self.opened = opened
+        self.path = path
+
+    def __truediv__(self, other):
+        return CountingRepositoryPath(self.store, self.opened, f"{self.path}/{other}")
+
+    def __str__(self) -> str:
+        return self.path
+
+    def open(self):
+        self.opened.append(self.path)
+        try:
+            return BytesIO(self.store[self.path])
+        except KeyError:
+            raise ArtifactoryException(f"404: {self.path}")
+
+
+@pytest.fixture
+def counting_repository():
+    """
+    A stand-in for a repository path that reads files from an in-memory store,
+    and records each path that was opened.
+    """
+    return CountingRepositoryPath({}, [])
+
+
+@pytest.fixture
+def cache_entry():
+    """
+    Returns a factory for cache entries with data, optionally with upstream validators
+    and created at some other time.
+    """
+    def _entry(data=None, minutes=5, created=None, validators=None):
+        entry = _CacheEntry(expiry_delta=timedelta(minutes=minutes))
+        entry.data = data or {'a': 1}
+        if validators is not None:
+            entry.set_validators(validators)
+        entry.update()
+        if created is not None:
+            entry.metadata['created'] = created
+        return entry
+
+    return _entry
+
+
+@pytest.fixture
+def upstream_response():
+    """
+    Returns a factory for upstream responses with JSON data. Error responses raise on raise_for_status.
+    """
+    def _response(data=None, status_code=C.HTTP_OK, headers=None):
+        content = json.dumps(data).encode() if data is not None else b''
+        resp = mock.Mock(
+            status_code=status_code,
+            content=content,
+            text=content.decode(),
+            headers=headers or {},
+            **{'json.return_value': data},
+        )
+        if status_code >= C.HTTP_BAD_REQUEST:
+            resp.raise_for_status.side_effect = requests.exceptions.HTTPError(str(status_code))
+        return resp
+
+    return _response
+
+
+@pytest.fixture
+def upstream_session():
+    """
+    Patches the session used for upstream requests; its send mock returns the upstream responses.
+    """
+    session = mock.Mock(**{'merge_environment_settings.return_value': {}})
+    with mock.patch('galactory.upstream.scoped_session', **{'return_value.__enter__.return_value': session}):
+        yield session
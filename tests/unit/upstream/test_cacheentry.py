@@ -0,0 +1,215 @@
+# -*- coding: utf-8 -*-
+# (c) 2023 Brian Scholer (@briantist)
+
+import json
+import gzip
+import brotli
+import pytest
+from unittest import mock
+from io import StringIO, BytesIO
+from datetime import datetime, timedelta
+
+from galactory import constants as C
+from galactory.upstream import _CacheEntry, _ENVELOPE_MAGIC, ProxyUpstream
+from galactory.utilities import DateTimeIsoFormatJSONProvider
+
+
+def test_cacheentry_digest():
+    entry = _CacheEntry(expiry_delta=timedelta(minutes=5))
+    entry.data = {'b': 1, 'a': [1, 2]}
+    digest = entry.digest
+
+    other = _CacheEntry(expiry_delta=timedelta(minutes=5), data={'a': [1, 2], 'b': 1})
+    assert other.digest == digest
+
+    entry.data = {'b': 2}
+    assert entry.digest != digest
+
+
+def test_cacheentry_digest_stored():
+    entry = _CacheEntry(expiry_delta=timedelta(minutes=5))
+    entry.data = {'a': 1}
+    entry.update()
+    digest = entry.digest
+
+    serialized = json.dumps(entry._to_serializable_dict(), default=DateTimeIsoFormatJSONProvider.default)
+    assert json.loads(serialized)['metadata']['digest'] == digest
+
+    loaded = _CacheEntry.from_file(StringIO(serialized), expiry_delta=timedelta(minutes=5))
+    assert loaded.metadata['digest'] == digest
+    assert loaded.digest == digest
+
+
+def test_cacheentry_validators_round_trip():
+    entry = _CacheEntry(expiry_delta=timedelta(minutes=5))
+    entry.data = {'a': 1}
+    entry.set_validators({'ETag': '"abc"', 'Last-Modified': 'Wed, 21 Oct 2015 07:28:00 GMT', 'Other': 'x'})
+    entry.update()
+    assert entry.upstream_etag == '"abc"'
+    assert entry.upstream_last_modified == 'Wed, 21 Oct 2015 07:28:00 GMT'
+
+    serialized = json.dumps(entry._to_serializable_dict(), default=DateTimeIsoFormatJSONProvider.default)
+    loaded = _CacheEntry.from_file(StringIO(serialized), expiry_delta=timedelta(minutes=5))
+    assert loaded.upstream_etag == '"abc"'
+    assert loaded.upstream_last_modified == 'Wed, 21 Oct 2015 07:28:00 GMT'
+
+    # missing validators don't remove the ones already kept
+    loaded.set_validators({})
+    assert loaded.upstream_etag == '"abc"'
+
+
+def test_cacheentry_renewed():
+    entry = _CacheEntry(expiry_delta=timedelta(minutes=5))
+    entry.data = {'a': 1}
+    entry.set_validators({'ETag': '"abc"'})
+    entry.update()
+    entry.metadata['created'] = datetime.utcnow() - timedelta(minutes=6)
+    assert entry.expired
+
+    renewed = entry.renewed()
+    assert not renewed.expired
+    assert entry.expired
+    assert renewed.data == entry.data
+    assert renewed.digest == entry.digest
+    assert renewed.upstream_etag == '"abc"'
+
+
+@pytest.mark.parametrize('compression', [None, 'none', 'gzip', 'brotli'])
+def test_cacheentry_compressed_round_trip(compression):
+    entry = _CacheEntry(expiry_delta=timedelta(minutes=5))
+    entry.data = {'data': [{'version': f"1.0.{i}"} for i in range(100)]}
+    entry.update()
+
+    raw = entry.to_bytes(compression)
+    if compression in (None, 'none'):
+        assert json.loads(raw)['data'] == entry.data
+    else:
+        assert raw.startswith(_ENVELOPE_MAGIC)
+        assert len(raw) < len(entry.to_bytes())
+
+    loaded = _CacheEntry.from_file(BytesIO(raw), expiry_delta=timedelta(minutes=5))
+    assert loaded.data == entry.data
+    assert loaded.created == entry.created
+    assert loaded.digest == entry.digest
+
+
+@pytest.mark.parametrize('raw', [
+    _ENVELOPE_MAGIC + bytes([99]) + b'gzip\n',
+    _ENVELOPE_MAGIC + bytes([1]) + b'zstd\n',
+    b'{"not": "complete',
+    # truncated envelopes and payloads
+    _ENVELOPE_MAGIC,
+    _ENVELOPE_MAGIC + bytes([1]) + b'gzip',
+    _ENVELOPE_MAGIC + bytes([1]) + b'gzip\n' + gzip.compress(b'{"a": 1}')[:10],
+    _ENVELOPE_MAGIC + bytes([1]) + b'brotli\n' + brotli.compress(b'{"a": 1}' * 100)[:10],
+    _ENVELOPE_MAGIC + bytes([1]) + b'brotli\n' + b'not brotli',
+])
+def test_cacheentry_unreadable(raw):
+    with pytest.raises(ValueError):
+        _CacheEntry.from_file(BytesIO(raw), expiry_delta=timedelta(minutes=5))
+
+
+@pytest.mark.parametrize('app', [dict(CACHE_MEMORY_ENTRIES=10)], indirect=True)
+def test_proxyupstream_unreadable_cache(app, counting_repository):
+    repository = counting_repository
+    repository.store[str(repository / '_cache' / '/api/v3/collections/ns/n' / 'data.json')] = _ENVELOPE_MAGIC + bytes([99])
+    proxy = ProxyUpstream(repository, 'https://galaxy.example.com/', True, False, 5)
+
+    with app.test_request_context('/api/v3/collections/ns/n') as ctx:
+        assert proxy._get_cache(ctx.request).empty
+
+
+@pytest.mark.parametrize('app', [dict(CACHE_COMPRESSION='brotli', CACHE_MEMORY_ENTRIES=10)], indirect=True)
+def test_proxyupstream_compressed_cache(app, counting_repository):
+    entry = _CacheEntry(expiry_delta=timedelta(minutes=5))
+    entry.data = {'a': 1}
+    repository = counting_repository
+    path = str(repository / '_cache' / '/api/v3/collections/ns/n' / 'data.json')
+    proxy = ProxyUpstream(repository, 'https://galaxy.example.com/', True, True, 5)
+
+    with mock.patch('galactory.upstream._deploy_cache') as deploy:
+        with app.test_request_context('/api/v3/collections/ns/n') as ctx:
+            proxy._set_cache(ctx.request.path, entry)
+
+    deploy.assert_called_once_with(mock.ANY, entry, 'brotli')
+    repository.store[path] = entry.to_bytes('brotli')
+
+    with app.test_request_context('/api/v3/collections/ns/n') as ctx:
+        loaded = proxy._get_cache(ctx.request)
+
+    assert loaded.data == {'a': 1}
+    # the memory tier is sized by the uncompressed JSON
+    assert app.extensions[C.EXTENSION_UPSTREAM_MEMORY_CACHE].size == len(entry.to_bytes())
+
+
+def test_cacheentry_only_metadata_datetimes():
+    entry = _CacheEntry(expiry_delta=timedelta(minutes=5), calculate_expiry_on_read=False)
+    entry.data = {'created_at': '2023-01-01T12:34:56.123456Z', 'items': [{'updated_at': '2023-01-02T00:00:00'}]}
+    entry.update()
+
+    loaded = _CacheEntry.from_file(BytesIO(entry.to_bytes()), expiry_delta=timedelta(minutes=5), calculate_expiry_on_read=False)
+
+    # the data comes back exactly as the upstream sent it
+    assert loaded.data == entry.data
+    assert loaded.digest == entry.digest
+    assert isinstance(loaded.created, datetime)
+    assert loaded.created == entry.created
+    assert isinstance(loaded.expires, datetime)
+    assert loaded.expires == entry.expires
+
+
+def test_cacheentry_rendered():
+    entry = _CacheEntry(expiry_delta=timedelta(minutes=5))
+    entry.data = {'a': 1}
+    render = mock.Mock(side_effect=lambda data: {'rendered': data['a']})
+
+    first = entry.rendered('one', render)
+    assert first == {'rendered': 1}
+    assert entry.rendered('one', render) is first
+    assert entry.rendered('two', render) is not first
+    assert render.call_count == 2
+
+    # renewing keeps the rendered data, changing the data does not
+    assert entry.renewed().rendered('one', render) is first
+    entry.data = {'a': 2}
+    assert entry.rendered('one', render) == {'rendered': 2}
+    assert render.call_count == 3
+
+
+def test_cacheentry_rendered_bounded():
+    entry = _CacheEntry(expiry_delta=timedelta(minutes=5))
+    entry.data = {'a': 1}
+    render = mock.Mock(side_effect=lambda data: dict(data))
+
+    for i in range(10):
+        entry.rendered(i, render)
+
+    assert len(entry._rendered) < 10
+    entry.rendered(9, render)
+    assert render.call_count == 11
+
+
+@pytest.mark.parametrize('app', [dict(CACHE_MEMORY_ENTRIES=10)], indirect=True)
+def test_proxyupstream_renders_once(app, counting_repository):
+    entry = _CacheEntry(expiry_delta=timedelta(minutes=5))
+    entry.data = {'id': 1, 'href': 'https://galaxy.example.com/api/v3/collections/ns/n/', 'nested': {'download_count': 5, 'a': 1}}
+    entry.update()
+    repository = counting_repository
+    repository.store[str(repository / '_cache' / '/api/v3/collections/ns/n' / 'data.json')] = entry.to_bytes()
+    proxy = ProxyUpstream(repository, 'https://galaxy.example.com/', True, False, 5)
+
+    with mock.patch.object(ProxyUpstream, '_rewrite_upstream_response', autospec=True, side_effect=ProxyUpstream._rewrite_upstream_response) as rewrite:
+        with app.test_request_context('/api/v3/collections/ns/n', base_url='http://one.example.com/') as ctx:
+            first = proxy.proxy(ctx.request)
+        with app.test_request_context('/api/v3/collections/ns/n', base_url='http://one.example.com/') as ctx:
+            second = proxy.proxy(ctx.request)
+        with app.test_request_context('/api/v3/collections/ns/n', base_url='http://two.example.com/') as ctx:
+            other = proxy.proxy(ctx.request)
+
+    assert first == second == {'href': 'http://one.example.com/api/v3/collections/ns/n/', 'nested': {'a': 1}}
+    assert other['href'] == 'http://two.example.com/api/v3/collections/ns/n/'
+    # each request gets its own top level, but the rendering is only done once for each host
+    assert first is not second
+    assert first['nested'] is second['nested']
+    # the nested dict is rendered recursively, so count the renderings of the whole document
+    assert len([c for c in rewrite.call_args_list if 'href' in c.args[1]]) == 2
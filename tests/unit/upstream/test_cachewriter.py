@@ -0,0 +1,109 @@
+# -*- coding: utf-8 -*-
+# (c) 2023 Brian Scholer (@briantist)
+
+import json
+import pytest
+
+from galactory import constants as C
+from galactory.upstream import CacheWriter, ProxyUpstream
+
+
+class DeployablePath:
+    def __init__(self, deployed: list, path: str = '', fail: bool = False) -> None:
+        self.deployed = deployed
+        self.path = path
+        self.fail = fail
+
+    def __truediv__(self, other):
+        return DeployablePath(self.deployed, f"{self.path}/{other}", self.fail)
+
+    def __str__(self) -> str:
+        return self.path
+
+    def deploy(self, buffer, quote_parameters=None):
+        if self.fail:
+            raise RuntimeError('oh no')
+        self.deployed.append((self.path, json.loads(buffer.read())))
+
+
+def test_cachewriter_writes(app, cache_entry):
+    deployed = []
+    writer = CacheWriter(app, max_queued=10)
+    writer.start()
+
+    assert writer.submit(DeployablePath(deployed, '/one'), cache_entry({'a': 1}))
+    writer.flush()
+
+    assert len(deployed) == 1
+    assert deployed[0][0] == '/one'
+    assert deployed[0][1]['data'] == {'a': 1}
+    assert 'dirty' not in deployed[0][1]['metadata']
+    assert writer.stats == {'queued': 0, 'written': 1, 'failed': 0, 'dropped': 0}
+
+    writer.close()
+    assert not writer.is_alive()
+
+
+def test_cachewriter_batches_by_path(app, cache_entry):
+    deployed = []
+    writer = CacheWriter(app, max_queued=10)
+
+    # queued before the thread starts, so they are all in one batch
+    for i in range(3):
+        writer.submit(DeployablePath(deployed, '/one'), cache_entry({'a': i}))
+    writer.submit(DeployablePath(deployed, '/two'), cache_entry({'b': 1}))
+
+    writer.start()
+    writer.close()
+
+    assert [(path, d['data']) for path, d in deployed] == [('/one', {'a': 2}), ('/two', {'b': 1})]
+    assert writer.written == 2
+
+
+def test_cachewriter_drops_on_overflow(app, cache_entry):
+    deployed = []
+    writer = CacheWriter(app, max_queued=2)
+
+    assert writer.submit(DeployablePath(deployed, '/one'), cache_entry({'a': 1}))
+    assert writer.submit(DeployablePath(deployed, '/two'), cache_entry({'a': 2}))
+    assert not writer.submit(DeployablePath(deployed, '/three'), cache_entry({'a': 3}))
+    assert writer.stats == {'queued': 2, 'written': 0, 'failed': 0, 'dropped': 1}
+
+    # closing flushes what was queued
+    writer.start()
+    writer.close()
+    assert [path for path, _ in deployed] == ['/one', '/two']
+
+
+def test_cachewriter_survives_errors(app, cache_entry):
+    deployed = []
+    writer = CacheWriter(app, max_queued=10)
+    writer.start()
+
+    writer.submit(DeployablePath(deployed, '/bad', fail=True), cache_entry({'a': 1}))
+    writer.submit(DeployablePath(deployed, '/good'), cache_entry({'a': 2}))
+    writer.close()
+
+    assert writer.failed == 1
+    assert writer.written == 1
+    assert [path for path, _ in deployed] == ['/good']
+
+
+@pytest.mark.parametrize('app', [dict(CACHE_WRITE_BEHIND=10), dict(CACHE_WRITE_BEHIND=0)], indirect=True)
+def test_proxyupstream_write_behind(app, cache_entry):
+    deployed = []
+    repository = DeployablePath(deployed)
+    proxy = ProxyUpstream(repository, 'https://galaxy.example.com/', True, True, 5)
+    writer = app.extensions.get(C.EXTENSION_CACHE_WRITER)
+
+    with app.test_request_context('/api/v3/collections/ns/n'):
+        proxy._set_cache('/api/v3/collections/ns/n', cache_entry({'a': 1}))
+
+    if writer is None:
+        assert len(deployed) == 1
+    else:
+        writer.close()
+        assert len(deployed) == 1
+        assert writer.written == 1
+
+    assert deployed[0][0] == '/_cache//api/v3/collections/ns/n/data.json'
@@ -0,0 +1,86 @@
+# -*- coding: utf-8 -*-
+# (c) 2023 Brian Scholer (@briantist)
+
+import pytest
+from unittest import mock
+from functools import partial
+from tempfile import NamedTemporaryFile
+
+from galactory import constants as C
+from galactory.upstream import ProxyUpstream
+
+
+def test_proxyupstream_coalesces_misses(app, counting_repository, cache_entry):
+    proxy = ProxyUpstream(counting_repository, 'https://galaxy.example.com/', True, False, 5)
+    fresh = cache_entry({'a': 2})
+
+    with mock.patch('galactory.upstream.single_flight', return_value=(fresh, True)) as flight, \
+            mock.patch.object(ProxyUpstream, '_fetch') as fetch:
+        with app.test_request_context('/api/v3/collections/ns/n') as ctx:
+            result = proxy.proxy(ctx.request)
+
+    # the result of the leader's request is used
+    fetch.assert_not_called()
+    assert flight.call_args.args[0] == ('proxy', 'https://galaxy.example.com/api/v3/collections/ns/n?limit=100')
+    assert result == {'a': 2}
+    assert result.digest == fresh.digest
+
+
+def test_proxyupstream_miss_leader(app, counting_repository):
+    proxy = ProxyUpstream(counting_repository, 'https://galaxy.example.com/', True, False, 5)
+    resp = mock.Mock(content=b'{"a": 2}', **{'json.return_value': {'a': 2}})
+
+    with mock.patch.object(ProxyUpstream, '_fetch', return_value=resp) as fetch:
+        with app.test_request_context('/api/v3/collections/ns/n') as ctx:
+            result = proxy.proxy(ctx.request)
+
+    fetch.assert_called_once()
+    assert result == {'a': 2}
+    assert not app.extensions[C.EXTENSION_SINGLE_FLIGHT]._flights
+
+
+def test_proxyupstream_coalesces_downloads(app, counting_repository, tmp_path):
+    proxy = ProxyUpstream(counting_repository, 'https://galaxy.example.com/', False, False, 5)
+    downloaded = tmp_path / 'downloaded'
+    downloaded.write_bytes(b'content')
+    leader_file = mock.Mock()
+    leader_file.name = str(downloaded)
+
+    with mock.patch('galactory.upstream.single_flight', return_value=(leader_file, True)) as flight, \
+            mock.patch.object(ProxyUpstream, 'proxy_download') as download:
+        with app.test_request_context('/download/ns-n-1.0.0.tar.gz') as ctx:
+            with proxy.download(ctx.request) as f:
+                content = f.read()
+
+    # the leader's download is read through a handle of our own
+    download.assert_not_called()
+    assert flight.call_args.args[0] == ('download', 'http://localhost/download/ns-n-1.0.0.tar.gz')
+    assert content == b'content'
+
+
+def test_proxyupstream_download_leader(app, counting_repository, tmp_path):
+    proxy = ProxyUpstream(counting_repository, 'https://galaxy.example.com/', False, False, 5)
+
+    with mock.patch.object(ProxyUpstream, 'proxy_download') as download, \
+            mock.patch('galactory.upstream.NamedTemporaryFile', partial(NamedTemporaryFile, dir=tmp_path)):
+        download.return_value.__enter__.return_value.iter_content.return_value = [b'con', b'tent']
+        with app.test_request_context('/download/ns-n-1.0.0.tar.gz') as ctx:
+            with proxy.download(ctx.request) as f:
+                # the file is already gone, but the handle can still be read
+                assert list(tmp_path.iterdir()) == []
+                assert f.read() == b'content'
+
+    download.assert_called_once()
+    assert not app.extensions[C.EXTENSION_SINGLE_FLIGHT]._flights
+
+
+def test_proxyupstream_download_error(app, counting_repository, tmp_path):
+    proxy = ProxyUpstream(counting_repository, 'https://galaxy.example.com/', False, False, 5)
+
+    with mock.patch.object(ProxyUpstream, 'proxy_download', side_effect=RuntimeError('oh no')), \
+            mock.patch('galactory.upstream.NamedTemporaryFile', partial(NamedTemporaryFile, dir=tmp_path)):
+        with app.test_request_context('/download/ns-n-1.0.0.tar.gz') as ctx:
+            with pytest.raises(RuntimeError):
+                proxy.download(ctx.request)
+
+    assert list(tmp_path.iterdir()) == []
@@ -0,0 +1,67 @@
+# -*- coding: utf-8 -*-
+# (c) 2023 Brian Scholer (@briantist)
+
+import pytest
+from datetime import datetime, timedelta
+
+from galactory import constants as C
+from galactory.upstream import _CacheEntry, ProxyUpstream
+
+
+@pytest.fixture
+def expired_entry(cache_entry):
+    validators = {'ETag': '"abc"', 'Last-Modified': 'Wed, 21 Oct 2015 07:28:00 GMT'}
+    return cache_entry(validators=validators, created=datetime.utcnow() - timedelta(minutes=6))
+
+
+@pytest.mark.parametrize('app', [dict(CACHE_MEMORY_ENTRIES=10)], indirect=True)
+def test_proxyupstream_not_modified(app, counting_repository, upstream_session, upstream_response, expired_entry):
+    previous = expired_entry
+    upstream_session.send.return_value = upstream_response(status_code=C.HTTP_NOT_MODIFIED, headers={'ETag': '"def"'})
+    proxy = ProxyUpstream(counting_repository, 'https://galaxy.example.com/', True, False, 5)
+
+    with app.test_request_context('/api/v3/collections/ns/n', headers={'If-None-Match': '"client"'}) as ctx:
+        req = proxy._rewrite_to_upstream(ctx.request, 'https://galaxy.example.com/')
+        cache = proxy._refresh(req, ctx.request.path, previous)
+
+    sent = upstream_session.send.call_args.args[0]
+    assert sent.headers['If-None-Match'] == '"abc"'
+    assert sent.headers['If-Modified-Since'] == 'Wed, 21 Oct 2015 07:28:00 GMT'
+
+    # the data is kept, only the expiry and validators change
+    assert cache is not previous
+    assert not cache.expired
+    assert previous.expired
+    assert cache.data == {'a': 1}
+    assert cache.digest == previous.digest
+    assert cache.upstream_etag == '"def"'
+    assert app.extensions[C.EXTENSION_UPSTREAM_MEMORY_CACHE].get(str(counting_repository / '_cache' / '/api/v3/collections/ns/n' / 'data.json')) is cache
+
+
+def test_proxyupstream_modified(app, counting_repository, upstream_session, upstream_response, expired_entry):
+    previous = expired_entry
+    upstream_session.send.return_value = upstream_response({'a': 2}, headers={'ETag': '"def"'})
+    proxy = ProxyUpstream(counting_repository, 'https://galaxy.example.com/', True, False, 5)
+
+    with app.test_request_context('/api/v3/collections/ns/n') as ctx:
+        req = proxy._rewrite_to_upstream(ctx.request, 'https://galaxy.example.com/')
+        cache = proxy._refresh(req, ctx.request.path, previous)
+
+    assert cache.data == {'a': 2}
+    assert cache.digest != previous.digest
+    assert cache.upstream_etag == '"def"'
+    assert cache.upstream_last_modified is None
+
+
+def test_proxyupstream_no_validators_without_cache(app, counting_repository, upstream_session, upstream_response):
+    upstream_session.send.return_value = upstream_response({'a': 2})
+    proxy = ProxyUpstream(counting_repository, 'https://galaxy.example.com/', True, False, 5)
+
+    with app.test_request_context('/api/v3/collections/ns/n', headers={'If-None-Match': '"client"'}) as ctx:
+        req = proxy._rewrite_to_upstream(ctx.request, 'https://galaxy.example.com/')
+        cache = proxy._refresh(req, ctx.request.path, _CacheEntry(expiry_delta=timedelta(minutes=5)))
+
+    sent = upstream_session.send.call_args.args[0]
+    assert 'If-None-Match' not in sent.headers
+    assert 'If-Modified-Since' not in sent.headers
+    assert cache.data == {'a': 2}
@@ -0,0 +1,95 @@
+# -*- coding: utf-8 -*-
+# (c) 2023 Brian Scholer (@briantist)
+
+import json
+import pytest
+from datetime import datetime, timedelta
+
+from galactory import constants as C
+from galactory.upstream import MemoryCache, ProxyUpstream
+
+
+def test_memorycache_lru_entries(cache_entry):
+    cache = MemoryCache(max_entries=2, max_bytes=1000)
+    one, two, three = cache_entry(), cache_entry(), cache_entry()
+
+    cache.set('one', one, 1)
+    cache.set('two', two, 1)
+    assert cache.get('one') is one
+
+    # two is the least recently used now
+    cache.set('three', three, 1)
+    assert len(cache) == 2
+    assert cache.get('two') is None
+    assert cache.get('one') is one
+    assert cache.get('three') is three
+
+
+def test_memorycache_lru_bytes(cache_entry):
+    cache = MemoryCache(max_entries=100, max_bytes=10)
+
+    cache.set('one', cache_entry(), 4)
+    cache.set('two', cache_entry(), 4)
+    assert cache.size == 8
+
+    cache.set('three', cache_entry(), 4)
+    assert cache.size == 8
+    assert cache.get('one') is None
+
+    # replacing an entry replaces its size
+    cache.set('two', cache_entry(), 2)
+    assert cache.size == 6
+
+    # entries that are too big on their own are not kept
+    cache.set('huge', cache_entry(), 11)
+    assert cache.get('huge') is None
+    assert cache.size == 6
+
+
+def test_memorycache_expired(cache_entry):
+    cache = MemoryCache(max_entries=10, max_bytes=1000)
+    cache.set('old', cache_entry(created=datetime.utcnow() - timedelta(minutes=6)), 5)
+
+    assert cache.get('old') is None
+    assert len(cache) == 0
+    assert cache.size == 0
+
+
+@pytest.mark.parametrize('app', [dict(CACHE_MEMORY_ENTRIES=10)], indirect=True)
+@pytest.mark.parametrize('read_cache', [True, False])
+def test_proxyupstream_memory_tier(app, counting_repository, read_cache, cache_entry):
+    entry = cache_entry()
+    raw = json.dumps(entry._to_serializable_dict(), default=str).encode()
+    repository = counting_repository
+    opened = repository.opened
+    repository.store[str(repository / '_cache' / '/api/v3/collections/ns/n' / 'data.json')] = raw
+    proxy = ProxyUpstream(repository, 'https://galaxy.example.com/', read_cache, False, 5)
+    memory = app.extensions[C.EXTENSION_UPSTREAM_MEMORY_CACHE]
+
+    with app.test_request_context('/api/v3/collections/ns/n') as ctx:
+        first = proxy._get_cache(ctx.request)
+        second = proxy._get_cache(ctx.request)
+
+    if read_cache:
+        assert len(opened) == 1
+        assert second is first
+        assert first.data == {'a': 1}
+        assert memory.size == len(raw)
+    else:
+        assert opened == []
+        assert first.empty
+        assert len(memory) == 0
+
+
+@pytest.mark.parametrize('app', [dict(CACHE_MEMORY_ENTRIES=10)], indirect=True)
+def test_proxyupstream_memory_tier_miss(app, counting_repository):
+    repository = counting_repository
+    opened = repository.opened
+    proxy = ProxyUpstream(repository, 'https://galaxy.example.com/', True, False, 5)
+
+    with app.test_request_context('/api/v3/collections/ns/n') as ctx:
+        assert proxy._get_cache(ctx.request).empty
+        assert proxy._get_cache(ctx.request).empty
+
+    # misses are not remembered, so they go to Artifactory each time
+    assert len(opened) == 2
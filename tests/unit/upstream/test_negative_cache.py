@@ -0,0 +1,101 @@
+# -*- coding: utf-8 -*-
+# (c) 2023 Brian Scholer (@briantist)
+
+import pytest
+from unittest import mock
+from datetime import datetime, timedelta
+
+from galactory import constants as C
+from galactory.upstream import _CacheEntry, ProxyUpstream
+
+
+@pytest.fixture
+def upstream_not_found(upstream_session, upstream_response):
+    upstream_session.send.return_value = upstream_response(status_code=C.HTTP_NOT_FOUND)
+    return upstream_session.send
+
+
+def _negative_entry(minutes_ago):
+    entry = _CacheEntry(expiry_delta=timedelta(minutes=60))
+    entry.set_negative(timedelta(minutes=5))
+    entry.update(force=True)
+    entry.metadata['created'] = datetime.utcnow() - timedelta(minutes=minutes_ago)
+    return entry
+
+
+def test_cacheentry_negative():
+    entry = _CacheEntry(expiry_delta=timedelta(minutes=60))
+    assert entry.empty
+    assert not entry.negative
+
+    entry.set_negative(timedelta(minutes=5))
+    entry.update(force=True)
+    assert not entry.empty
+    assert entry.negative
+    assert entry.data == {}
+    assert entry.expires == entry.created + timedelta(minutes=5)
+
+
+@pytest.mark.parametrize('app', [
+    dict(NEGATIVE_CACHE_MINUTES=5, CACHE_MEMORY_ENTRIES=10),
+    dict(NEGATIVE_CACHE_MINUTES=0, CACHE_MEMORY_ENTRIES=10),
+], indirect=True)
+def test_proxyupstream_negative_cache(app, counting_repository, upstream_not_found):
+    enabled = bool(app.config['NEGATIVE_CACHE_MINUTES'])
+    proxy = ProxyUpstream(counting_repository, 'https://galaxy.example.com/', True, False, 60)
+
+    for _ in range(3):
+        with app.test_request_context('/api/v3/collections/private/n/') as ctx:
+            result = proxy.proxy(ctx.request)
+        # no upstream result, either way
+        assert not result
+
+    assert upstream_not_found.call_count == (1 if enabled else 3)
+
+    if enabled:
+        path = str(counting_repository / '_cache' / '/api/v3/collections/private/n/' / 'data.json')
+        entry = app.extensions[C.EXTENSION_UPSTREAM_MEMORY_CACHE].get(path)
+        assert entry.negative
+        assert entry.expires == entry.created + timedelta(minutes=5)
+
+
+@pytest.mark.parametrize('app', [dict(NEGATIVE_CACHE_MINUTES=5, CACHE_MEMORY_ENTRIES=10)], indirect=True)
+def test_proxyupstream_not_found_keeps_expired_data(app, counting_repository, upstream_not_found, cache_entry):
+    repository = counting_repository
+    path = str(repository / '_cache' / '/api/v3/collections/ns/n/' / 'data.json')
+    expired = cache_entry({'a': 1}, created=datetime.utcnow() - timedelta(minutes=6))
+    repository.store[path] = expired.to_bytes()
+    proxy = ProxyUpstream(repository, 'https://galaxy.example.com/', True, True, 5)
+
+    with mock.patch('galactory.upstream._deploy_cache') as deploy:
+        with app.test_request_context('/api/v3/collections/ns/n/') as ctx:
+            result = proxy.proxy(ctx.request)
+
+    # the expired data is served, and not replaced by a negative entry
+    upstream_not_found.assert_called_once()
+    assert result == {'a': 1}
+    deploy.assert_not_called()
+    entry = app.extensions[C.EXTENSION_UPSTREAM_MEMORY_CACHE].get(path)
+    assert entry is None or not entry.negative
+
+
+@pytest.mark.parametrize('app, minutes_ago, hit', [
+    (dict(NEGATIVE_CACHE_MINUTES=5), 1, True),
+    (dict(NEGATIVE_CACHE_MINUTES=5), 6, False),
+    (dict(NEGATIVE_CACHE_MINUTES=10), 6, True),
+    (dict(NEGATIVE_CACHE_MINUTES=0), 1, False),
+], indirect=['app'])
+def test_proxyupstream_negative_cache_from_artifactory(app, counting_repository, minutes_ago, hit):
+    repository = counting_repository
+    repository.store[str(repository / '_cache' / '/api/v3/collections/private/n/' / 'data.json')] = _negative_entry(minutes_ago).to_bytes()
+    proxy = ProxyUpstream(repository, 'https://galaxy.example.com/', True, False, 60)
+
+    with app.test_request_context('/api/v3/collections/private/n/') as ctx:
+        cache = proxy._get_cache(ctx.request)
+
+    # the expiry of a negative entry comes from the current configuration, not --cache-minutes
+    if app.config['NEGATIVE_CACHE_MINUTES']:
+        assert cache.negative
+        assert cache.expired is not hit
+    else:
+        assert cache.empty
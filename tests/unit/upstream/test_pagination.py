@@ -0,0 +1,131 @@
+# -*- coding: utf-8 -*-
+# (c) 2023 Brian Scholer (@briantist)
+
+import pytest
+import requests
+from urllib.parse import urlsplit, parse_qs
+
+from galactory import constants as C
+from galactory.upstream import ProxyUpstream
+
+
+def _v3_page(url, count, limit=None):
+    query = parse_qs(urlsplit(url).query)
+    limit = limit or int(query['limit'][0])
+    offset = int(query.get('offset', ['0'])[0])
+    return {
+        'meta': {'count': count},
+        'links': {'next': 'next' if offset + limit < count else None},
+        'data': [{'version': f"1.0.{i}"} for i in range(offset, min(offset + limit, count))],
+    }
+
+
+def _v2_page(url, count, page_size=None):
+    query = parse_qs(urlsplit(url).query)
+    page_size = page_size or int(query['page_size'][0])
+    page = int(query.get('page', ['1'])[0])
+    start = (page - 1) * page_size
+    return {
+        'count': count,
+        'next': 'next' if start + page_size < count else None,
+        'results': [{'version': f"1.0.{i}"} for i in range(start, min(start + page_size, count))],
+    }
+
+
+@pytest.fixture
+def upstream(upstream_session):
+    """
+    Serves pages from a function of the request URL, and records the URLs requested.
+    """
+    requested = []
+
+    def _serve(page):
+        def _send(req, **kwargs):
+            requested.append(req.url)
+            return page(req.url)
+        upstream_session.send.side_effect = _send
+        return requested
+
+    return _serve
+
+
+@pytest.mark.parametrize('app', [dict(UPSTREAM_PAGE_CONCURRENCY=3)], indirect=True)
+@pytest.mark.parametrize('api, page, key', [
+    ('v3', _v3_page, 'data'),
+    ('v2', _v2_page, 'results'),
+])
+@pytest.mark.parametrize('count, pages', [(0, 1), (100, 1), (101, 2), (450, 5)])
+def test_proxyupstream_merges_pages(app, counting_repository, upstream, upstream_response, api, page, key, count, pages):
+    requested = upstream(lambda url: upstream_response(page(url, count)))
+    proxy = ProxyUpstream(counting_repository, 'https://galaxy.example.com/', False, False, 5)
+
+    with app.test_request_context(f"/api/{api}/collections/ns/n/versions/") as ctx:
+        req = proxy._rewrite_to_upstream(ctx.request, 'https://galaxy.example.com/')
+        cache = proxy._refresh(req, ctx.request.path)
+
+    assert len(requested) == pages
+    assert [item['version'] for item in cache.data[key]] == [f"1.0.{i}" for i in range(count)]
+    next_link = cache.data['links']['next'] if key == 'data' else cache.data['next']
+    assert next_link is None
+
+
+def test_proxyupstream_merges_smaller_pages(app, counting_repository, upstream, upstream_response):
+    # the upstream returns fewer items per page than were asked for
+    requested = upstream(lambda url: upstream_response(_v3_page(url, 120, limit=50)))
+    proxy = ProxyUpstream(counting_repository, 'https://galaxy.example.com/', False, False, 5)
+
+    with app.test_request_context('/api/v3/collections/ns/n/versions/') as ctx:
+        req = proxy._rewrite_to_upstream(ctx.request, 'https://galaxy.example.com/')
+        cache = proxy._refresh(req, ctx.request.path)
+
+    assert len(requested) == 3
+    assert len(cache.data['data']) == 120
+    assert len(set(item['version'] for item in cache.data['data'])) == 120
+
+
+def _http_error(response):
+    return response({}, status_code=C.HTTP_INTERNAL_SERVER_ERROR)
+
+
+def _connection_error(response):
+    raise requests.exceptions.ConnectionError('oh no')
+
+
+def _invalid_json(response):
+    resp = response({})
+    resp.json.side_effect = requests.exceptions.JSONDecodeError('oh no', '', 0)
+    return resp
+
+
+def _missing_items(response):
+    return response({'meta': {'count': 250}})
+
+
+@pytest.mark.parametrize('error', [_http_error, _connection_error, _invalid_json, _missing_items])
+def test_proxyupstream_page_error(app, counting_repository, upstream, upstream_response, error):
+    def _page(url):
+        if 'offset=200' in url:
+            return error(upstream_response)
+        return upstream_response(_v3_page(url, 250))
+
+    upstream(_page)
+    proxy = ProxyUpstream(counting_repository, 'https://galaxy.example.com/', False, False, 5)
+
+    with app.test_request_context('/api/v3/collections/ns/n/versions/') as ctx:
+        req = proxy._rewrite_to_upstream(ctx.request, 'https://galaxy.example.com/')
+        cache = proxy._refresh(req, ctx.request.path)
+
+    # the first page is kept on its own
+    assert len(cache.data['data']) == 100
+
+
+def test_proxyupstream_not_paginated(app, counting_repository, upstream, upstream_response):
+    requested = upstream(lambda url: upstream_response({'name': 'n', 'namespace': {'name': 'ns'}}))
+    proxy = ProxyUpstream(counting_repository, 'https://galaxy.example.com/', False, False, 5)
+
+    with app.test_request_context('/api/v3/collections/ns/n/') as ctx:
+        req = proxy._rewrite_to_upstream(ctx.request, 'https://galaxy.example.com/')
+        cache = proxy._refresh(req, ctx.request.path)
+
+    assert len(requested) == 1
+    assert cache.data == {'name': 'n', 'namespace': {'name': 'ns'}}
@@ -0,0 +1,103 @@
+# -*- coding: utf-8 -*-
+# (c) 2023 Brian Scholer (@briantist)
+
+import json
+import pytest
+from unittest import mock
+from threading import Event
+from datetime import datetime, timedelta
+
+from galactory import constants as C
+from galactory.upstream import _CacheEntry, UpstreamRevalidator, ProxyUpstream
+
+
+def test_revalidator_can_serve(app, cache_entry):
+    revalidator = UpstreamRevalidator(app, stale_seconds=60)
+    now = datetime.utcnow()
+
+    assert not revalidator.can_serve(_CacheEntry(expiry_delta=timedelta(minutes=5)))
+    assert not revalidator.can_serve(cache_entry())
+    assert revalidator.can_serve(cache_entry(created=now - timedelta(minutes=5, seconds=30)))
+    assert not revalidator.can_serve(cache_entry(created=now - timedelta(minutes=5, seconds=90)))
+
+
+def test_revalidator_one_refresh_per_key(app):
+    revalidator = UpstreamRevalidator(app, stale_seconds=60)
+    started = Event()
+    release = Event()
+    calls = []
+
+    def _refresh():
+        calls.append(1)
+        started.set()
+        release.wait(timeout=5)
+
+    assert revalidator.submit('key', _refresh)
+    assert started.wait(timeout=5)
+    assert not revalidator.submit('key', _refresh)
+    assert revalidator.submit('other', lambda: calls.append(2))
+
+    release.set()
+    revalidator.shutdown()
+    assert sorted(calls) == [1, 2]
+
+    # nothing is submitted after shutdown
+    assert not revalidator.submit('key', _refresh)
+
+
+def test_revalidator_errors_release_key(app):
+    revalidator = UpstreamRevalidator(app, stale_seconds=60, max_workers=1)
+    with mock.patch.object(app.logger, 'exception') as logged:
+        assert revalidator.submit('key', mock.Mock(side_effect=RuntimeError('oh no')))
+        revalidator._executor.submit(lambda: None).result(timeout=5)
+
+    logged.assert_called_once()
+    assert revalidator.submit('key', lambda: None)
+    revalidator.shutdown()
+
+
+@pytest.mark.parametrize('app', [dict(CACHE_STALE_WHILE_REVALIDATE=60, CACHE_MEMORY_ENTRIES=10)], indirect=True)
+def test_proxyupstream_stale_while_revalidate(app, counting_repository, cache_entry):
+    stale = cache_entry(data={'a': 1}, created=datetime.utcnow() - timedelta(minutes=5, seconds=30))
+    raw = json.dumps(stale._to_serializable_dict(), default=str).encode()
+    repository = counting_repository
+    path = str(repository / '_cache' / '/api/v3/collections/ns/n' / 'data.json')
+    repository.store[path] = raw
+    proxy = ProxyUpstream(repository, 'https://galaxy.example.com/', True, False, 5)
+    revalidator = app.extensions[C.EXTENSION_UPSTREAM_REVALIDATOR]
+    resp = mock.Mock(content=b'{"a": 2}', **{'json.return_value': {'a': 2}})
+
+    with mock.patch.object(ProxyUpstream, '_fetch', return_value=resp) as fetch:
+        with app.test_request_context('/api/v3/collections/ns/n') as ctx:
+            result = proxy.proxy(ctx.request)
+
+        revalidator.shutdown()
+
+    # the stale data was served, and refreshed in the background
+    assert result == {'a': 1}
+    assert result.digest == stale.digest
+    fetch.assert_called_once()
+
+    fresh = app.extensions[C.EXTENSION_UPSTREAM_MEMORY_CACHE].get(path)
+    assert fresh is not None
+    assert fresh.data == {'a': 2}
+    assert not fresh.expired
+
+
+@pytest.mark.parametrize('app', [dict(CACHE_STALE_WHILE_REVALIDATE=60)], indirect=True)
+def test_proxyupstream_stale_too_old(app, counting_repository, cache_entry):
+    stale = cache_entry(data={'a': 1}, created=datetime.utcnow() - timedelta(minutes=7))
+    repository = counting_repository
+    repository.store[str(repository / '_cache' / '/api/v3/collections/ns/n' / 'data.json')] = json.dumps(stale._to_serializable_dict(), default=str).encode()
+    proxy = ProxyUpstream(repository, 'https://galaxy.example.com/', True, False, 5)
+    resp = mock.Mock(content=b'{"a": 2}', **{'json.return_value': {'a': 2}})
+
+    with mock.patch.object(ProxyUpstream, '_fetch', return_value=resp) as fetch, \
+            mock.patch.object(UpstreamRevalidator, 'submit') as submit:
+        with app.test_request_context('/api/v3/collections/ns/n') as ctx:
+            result = proxy.proxy(ctx.request)
+
+    # past the stale window, the upstream is waited on as usual
+    submit.assert_not_called()
+    fetch.assert_called_once()
+    assert result == {'a': 2}
@@ -1,14 +1,17 @@
 # -*- coding: utf-8 -*-
 # (c) 2022 Brian Scholer (@briantist)
 
+import json
 import pytest
 from unittest import mock
 
-from datetime import datetime, timedelta
+from datetime import datetime, timedelta, timezone
 from types import GeneratorType
 import semver
 
-from galactory.utilities import discover_collections
+from artifactory import ArtifactoryException
+
+from galactory.utilities import discover_collections, discover_collections_aql, list_collection_filenames_aql
 from galactory.models import CollectionData
 
 
@@ -62,3 +65,127 @@ def test_discover_collections_any(repository, manifest_loader, namespace, collec
         assert namespace is None or c.namespace == namespace
         assert collection is None or c.name == collection
         assert version is None or c.version == version
+
+
+@pytest.fixture
+def aql_results(virtual_fs_repo):
+    results = []
+    for p in (virtual_fs_repo / 'subpath').glob('*.tar.gz'):
+        with (p / 'MANIFEST.json').open() as f:
+            ci = json.load(f)['collection_info']
+
+        props = {
+            'collection_info': json.dumps(ci),
+            'fqcn': f"{ci['namespace']}.{ci['name']}",
+            'namespace': ci['namespace'],
+            'name': ci['name'],
+            'version': ci['version'],
+        }
+        results.append({
+            'repo': 'repo',
+            'path': 'subpath',
+            'name': p.name,
+            'created': '2022-05-29T18:02:46.190Z',
+            'modified': '2022-05-29T17:59:04.998Z',
+            'size': 201178,
+            'sha256': p.name,
+            'properties': [{'key': k, 'value': v} for k, v in props.items()],
+        })
+
+    # an artifact without the collection properties should be skipped
+    results.append({
+        'repo': 'repo',
+        'path': 'subpath',
+        'name': 'unrelated-0.0.1.tar.gz',
+        'created': '2022-05-29T18:02:46.190Z',
+        'modified': '2022-05-29T17:59:04.998Z',
+        'size': 1,
+        'sha256': 'unrelated',
+    })
+
+    return results
+
+
+@pytest.mark.parametrize('namespace', [None, 'community'])
+@pytest.mark.parametrize('collection', [None, 'hashi_vault'])
+@pytest.mark.parametrize('version', [None, '3.0.0'])
+def test_discover_collections_aql(repository, aql_results, namespace, collection, version):
+    with mock.patch.object(repository.__class__, 'aql', return_value=aql_results) as aql:
+        collections = list(discover_collections_aql(repository, namespace, collection, version))
+
+    aql.assert_called_once()
+    criteria = aql.call_args.args[1]
+    assert criteria['repo'] == 'repo'
+    assert criteria['path'] == 'subpath'
+    assert criteria.get('@namespace') == namespace
+    assert criteria.get('@name') == collection
+    assert criteria.get('@version') == version
+
+    assert len(collections) == len(aql_results) - 1
+    for c in collections:
+        assert isinstance(c, CollectionData)
+        assert c.created_datetime.utcoffset() == timedelta(0)
+        assert c.modified_datetime.utcoffset() == timedelta(0)
+        assert c.sha256 == c.filename
+        assert c.size == 201178
+        assert c.fqcn == f"{c.namespace}.{c.name}"
+        assert isinstance(c.collection_info, dict)
+
+
+@pytest.mark.parametrize('concurrency', [2, 3, 8])
+def test_discover_collections_concurrency(repository, aql_results, concurrency, app_request_context):
+    # the mock repository's children can't be stat'ed on all python versions, so the per-artifact lookup is mocked
+    by_name = {r['name']: CollectionData.from_aql_result(r) for r in aql_results if r.get('properties')}
+    paths = []
+    for r in aql_results:
+        p = mock.Mock()
+        p.name = r['name']
+        paths.append(p)
+
+    with mock.patch('galactory.utilities._collection_from_path', side_effect=lambda p: by_name.get(p.name)) as from_path, \
+            mock.patch.object(repository.__class__, '__iter__', side_effect=lambda *a: iter(paths)):
+        gen = discover_collections(repository, fast_detection=False, concurrency=concurrency)
+        assert isinstance(gen, GeneratorType)
+        collections = list(gen)
+        sequential = list(discover_collections(repository, fast_detection=False))
+
+    assert from_path.call_count == 2 * len(paths)
+    assert len(collections) == len(by_name)
+    assert {c.filename for c in collections} == {c.filename for c in sequential}
+
+
+def test_discover_collections_use_aql(repository, aql_results, app_request_context):
+    with mock.patch.object(repository.__class__, 'aql', return_value=aql_results) as aql:
+        collections = list(discover_collections(repository, use_aql=True))
+
+    aql.assert_called_once()
+    assert len(collections) == len(aql_results) - 1
+
+
+def test_discover_collections_use_aql_fallback(repository, app_request_context):
+    with mock.patch.object(repository.__class__, 'aql', side_effect=ArtifactoryException('nope')) as aql:
+        collections = list(discover_collections(repository, use_aql=True))
+
+    aql.assert_called_once()
+    assert collections == list(discover_collections(repository))
+
+
+@pytest.mark.parametrize(('since', 'expected'), [
+    (datetime(2023, 4, 5, 6, 7, 8, 123456, tzinfo=timezone.utc), '2023-04-05T06:07:08.123Z'),
+    (datetime(2023, 4, 5, 6, 7, 8, 123456, tzinfo=timezone(timedelta(hours=2))), '2023-04-05T04:07:08.123Z'),
+    (datetime(2023, 4, 5, 6, 7, 8), '2023-04-05T06:07:08.000Z'),
+])
+def test_discover_collections_aql_modified_since(repository, aql_results, since, expected):
+    with mock.patch.object(repository.__class__, 'aql', return_value=aql_results) as aql:
+        list(discover_collections_aql(repository, modified_since=since))
+
+    criteria = aql.call_args.args[1]
+    assert criteria['$or'] == [{'modified': {'$gte': expected}}, {'updated': {'$gte': expected}}]
+
+
+def test_list_collection_filenames_aql(repository, aql_results):
+    with mock.patch.object(repository.__class__, 'aql', return_value=[{'name': r['name']} for r in aql_results]) as aql:
+        names = list_collection_filenames_aql(repository)
+
+    assert aql.call_args.args[2:] == ('.include', ['name'])
+    assert names == {r['name'] for r in aql_results}
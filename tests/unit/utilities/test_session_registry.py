@@ -0,0 +1,92 @@
+# -*- coding: utf-8 -*-
+# (c) 2023 Brian Scholer (@briantist)
+
+import pytest
+from unittest import mock
+from http.cookiejar import Cookie
+from urllib.request import Request
+from requests import Session
+from requests.auth import HTTPBasicAuth
+from dohq_artifactory.auth import XJFrogArtApiAuth, XJFrogArtBearerAuth
+
+from galactory import constants as C
+from galactory.utilities import SessionRegistry, authorize, shared_session, scoped_session
+
+
+def test_session_registry_per_credential():
+    sessions = SessionRegistry()
+
+    anonymous = sessions.get()
+    assert sessions.get(None) is anonymous
+
+    bearer = sessions.get(XJFrogArtBearerAuth('token'))
+    assert bearer is not anonymous
+    assert bearer.auth == XJFrogArtBearerAuth('token')
+    # equal credentials share a session, even as different objects
+    assert sessions.get(XJFrogArtBearerAuth('token')) is bearer
+    assert sessions.get(XJFrogArtBearerAuth('other')) is not bearer
+    assert sessions.get(XJFrogArtApiAuth('token')) is not bearer
+    assert sessions.get(HTTPBasicAuth('user', 'pass')) is sessions.get(HTTPBasicAuth('user', 'pass'))
+    assert len(sessions) == 5
+
+
+def test_session_registry_lru():
+    sessions = SessionRegistry(max_sessions=2)
+
+    one = sessions.get(XJFrogArtBearerAuth('one'))
+    two = sessions.get(XJFrogArtBearerAuth('two'))
+    assert sessions.get(XJFrogArtBearerAuth('one')) is one
+
+    # two is the least recently used now
+    sessions.get(XJFrogArtBearerAuth('three'))
+    assert len(sessions) == 2
+    assert sessions.get(XJFrogArtBearerAuth('one')) is one
+    assert sessions.get(XJFrogArtBearerAuth('two')) is not two
+
+
+def test_session_registry_pool_size():
+    session = SessionRegistry(pool_maxsize=42).get()
+    assert session.get_adapter('https://example.com')._pool_maxsize == 42
+
+
+def test_session_registry_no_cookies():
+    session = SessionRegistry().get()
+    cookie = Cookie(0, 'name', 'value', None, False, 'example.com', True, False, '/', True, False, None, False, None, None, {})
+
+    # shared sessions must not store cookies from one response and send them with another
+    assert not session.cookies._policy.set_ok(cookie, Request('https://example.com/'))
+
+
+@pytest.mark.parametrize('app', [dict(HTTP_KEEP_ALIVE=True), dict(HTTP_KEEP_ALIVE=False)], indirect=True)
+def test_shared_session(app):
+    keep_alive = app.config['HTTP_KEEP_ALIVE']
+    assert (C.EXTENSION_SESSIONS in app.extensions) is keep_alive
+
+    with app.app_context():
+        assert (shared_session() is shared_session()) is keep_alive
+        # sessions with their own retry settings are never shared
+        assert shared_session(retry=3) is not shared_session(retry=3)
+
+
+@pytest.mark.parametrize('app', [dict(HTTP_KEEP_ALIVE=True), dict(HTTP_KEEP_ALIVE=False)], indirect=True)
+def test_scoped_session(app):
+    keep_alive = app.config['HTTP_KEEP_ALIVE']
+
+    with app.app_context(), mock.patch.object(Session, 'close') as close:
+        with scoped_session() as session:
+            assert (session is shared_session()) is keep_alive
+            close.assert_not_called()
+
+    # only sessions that are not shared are closed
+    assert close.called is not keep_alive
+
+
+@pytest.mark.parametrize('app', [dict(USE_GALAXY_AUTH=True, PREFER_CONFIGURED_AUTH=False)], indirect=True)
+def test_authorize_shares_sessions(app):
+    with app.test_request_context(headers={'Authorization': 'Bearer token'}) as ctx:
+        app.config['GALAXY_AUTH_TYPE'] = 'access_token'
+        one = authorize(ctx.request, 'https://artifactory.example.com/artifactory/repo')
+        two = authorize(ctx.request, 'https://artifactory.example.com/artifactory/repo/file.tar.gz')
+
+    assert one.session is two.session
+    assert one.session.auth == XJFrogArtBearerAuth('token')
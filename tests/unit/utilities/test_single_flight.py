@@ -0,0 +1,91 @@
+# -*- coding: utf-8 -*-
+# (c) 2023 Brian Scholer (@briantist)
+
+import pytest
+from threading import Event, Thread
+
+from galactory import constants as C
+from galactory.utilities import SingleFlight, single_flight
+
+
+def _followers(flights, key, func, count):
+    results = []
+    errors = []
+
+    def _follow():
+        try:
+            results.append(flights.do(key, func))
+        except Exception as e:
+            errors.append(e)
+
+    threads = [Thread(target=_follow) for _ in range(count)]
+    for thread in threads:
+        thread.start()
+
+    return threads, results, errors
+
+
+def test_single_flight_coalesces(counting_event):
+    flights = SingleFlight()
+    started = Event()
+    release = Event()
+    calls = []
+
+    def _leader():
+        calls.append(1)
+        started.set()
+        release.wait(timeout=5)
+        return 'result'
+
+    leader, leader_results, _ = _followers(flights, 'key', _leader, 1)
+    assert started.wait(timeout=5)
+
+    threads, results, errors = _followers(flights, 'key', lambda: calls.append(2), 5)
+    # a different key is not coalesced
+    assert flights.do('other', lambda: 'other') == ('other', False)
+
+    counting_event.wait_for_waiters(5)
+    release.set()
+    for thread in leader + threads:
+        thread.join(timeout=5)
+
+    assert calls == [1]
+    assert leader_results == [('result', False)]
+    assert results == [('result', True)] * 5
+    assert errors == []
+
+    # once the leader is done, the next call runs again
+    assert flights.do('key', lambda: 'again') == ('again', False)
+
+
+def test_single_flight_shares_errors(counting_event):
+    flights = SingleFlight()
+    started = Event()
+    release = Event()
+
+    def _leader():
+        started.set()
+        release.wait(timeout=5)
+        raise RuntimeError('oh no')
+
+    leader, _, leader_errors = _followers(flights, 'key', _leader, 1)
+    assert started.wait(timeout=5)
+    threads, results, errors = _followers(flights, 'key', lambda: 'never', 3)
+
+    counting_event.wait_for_waiters(3)
+    release.set()
+    for thread in leader + threads:
+        thread.join(timeout=5)
+
+    assert results == []
+    assert len(leader_errors) == 1
+    assert errors == leader_errors * 3
+
+
+@pytest.mark.parametrize('registered', [True, False])
+def test_single_flight_extension(app, registered):
+    if not registered:
+        del app.extensions[C.EXTENSION_SINGLE_FLIGHT]
+
+    with app.app_context():
+        assert single_flight('key', lambda: 'value') == ('value', False)